@@ -1,9 +1,132 @@
 import requests
+import contextvars
+import functools
 import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+import disk_cache
+import telemetry
+import upstream
+
+PUBMED_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+RXNAV_URL = "https://rxnav.nlm.nih.gov/REST"
+MESH_URL = "https://id.nlm.nih.gov/mesh/sparql"
+OPENFDA_URL = "https://api.fda.gov/drug/event.json"
+
+# Throttling and transient server errors are retried with exponential backoff (0.3 s, 0.6 s, ...);
+# read timeouts are not, so a slow upstream costs one timeout and counts towards its circuit breaker
+HTTP_RETRY = Retry(total=3, read=0, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504),
+                   allowed_methods=frozenset(['GET']), respect_retry_after_header=True, raise_on_status=False)
+HTTP_TIMEOUT = 5
+
+# Requests per second each upstream allows per client IP (NCBI without an API key, OpenFDA's 240/min)
+RATE_LIMITS = {'pubmed': 3, 'rxnorm': 20, 'mesh': 5, 'openfda': 4}
+BREAKER_FAILURES = 5  # consecutive errors or timeouts before a source is skipped
+BREAKER_RESET = 30  # seconds before a skipped source is probed again
+
+# Calls allowed in flight per upstream across all sessions; NCBI allows 3 requests/s without an API key
+API_CONCURRENCY = {'search_pubmed': 2, 'search_rxnorm': 4, 'search_mesh': 4, 'search_openfda': 4}
+ENRICHMENT_DEADLINE = 8  # seconds for the whole fan-out, not per call
+
+# Persistent lookup cache shared by all app processes on the host (None disables it)
+API_CACHE_PATH = 'api_cache.sqlite3'
+API_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# How long each source's answers stay fresh; "not found" answers are kept for NEGATIVE_CACHE_TTL
+CACHE_TTL = {'pubmed': 24 * 3600, 'rxnorm': 30 * 24 * 3600, 'mesh': 30 * 24 * 3600, 'openfda': 7 * 24 * 3600}
+NEGATIVE_CACHE_TTL = 6 * 3600
+NOT_FOUND_ERRORS = {'No RxCUI found', 'No OpenFDA data found'}
+
+# One small pool per upstream, sized to its concurrency limit: queued calls wait in their own
+# upstream's queue without holding a thread, so a backed-up PubMed cannot starve the other APIs
+_executors = {name: ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f'enrichment-{name}')
+              for name, limit in API_CONCURRENCY.items()}
+_default_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='enrichment')
+_session = None
+_session_lock = threading.Lock()
+_cache = None
+_cache_lock = threading.Lock()
+_buckets = {source: upstream.TokenBucket(rate) for source, rate in RATE_LIMITS.items()}
+_breakers = {source: upstream.CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET) for source in RATE_LIMITS}
+
+def http_session():
+    """The process-wide keep-alive session all API calls share, sized for the enrichment pool."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=sum(API_CONCURRENCY.values()), max_retries=HTTP_RETRY)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+def _get(source, url, **kwargs):
+    """GET through the shared session, paced by the source's token bucket and guarded by its breaker."""
+    breaker = _breakers[source]
+    breaker.before_call()
+    try:
+        _buckets[source].acquire()
+    except upstream.RateLimited:
+        breaker.cancel()
+        raise
+    try:
+        with telemetry.span('http', source=source):
+            response = http_session().get(url, timeout=HTTP_TIMEOUT, **kwargs)
+    except Exception:
+        breaker.record_failure()
+        raise
+    if response.status_code >= 500 or response.status_code == 429:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
+
+def upstream_metrics():
+    """Breaker state and rate-limiter counters per source, for logs and dashboards."""
+    return {source: {'breaker': _breakers[source].metrics(), 'rate_limit': _buckets[source].metrics()}
+            for source in RATE_LIMITS}
+
+def api_cache():
+    """The process's handle on the shared lookup cache, or None when caching is off."""
+    global _cache
+    with _cache_lock:
+        if _cache is None and API_CACHE_PATH:
+            _cache = disk_cache.DiskCache(API_CACHE_PATH, max_bytes=API_CACHE_MAX_BYTES)
+        return _cache
+
+def _is_not_found(result):
+    return result.get('error') in NOT_FOUND_ERRORS or result.get('results') == [] or result.get('match_count') == 0
+
+def cached(source):
+    """Serve repeat lookups from the disk cache; transport failures are never cached."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            cache = api_cache()
+            if cache is None:
+                return fn(*args, **kwargs)
+            key = json.dumps([[a.strip().lower() if isinstance(a, str) else a for a in args], sorted(kwargs.items())])
+            found, result = cache.get(source, key)
+            if found:
+                return result
+            result = fn(*args, **kwargs)
+            not_found = _is_not_found(result)
+            if not_found:
+                cache.put(source, key, result, NEGATIVE_CACHE_TTL, negative=True)
+            elif 'error' not in result:
+                cache.put(source, key, result, CACHE_TTL[source])
+            return result
+        return wrapper
+    return decorate
+
+@telemetry.timed('api', function='search_pubmed')
+@cached('pubmed')
 def search_pubmed(query, num_results=5):
     """Search PubMed for articles and return summaries with calculated relevance (keyword count)."""
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
     params = {
         'db': 'pubmed',
         'term': query,
@@ -11,47 +134,53 @@ def search_pubmed(query, num_results=5):
         'retmode': 'json'
     }
     try:
-        response = requests.get(base_url, params=params, timeout=5)
+        response = _get('pubmed', f"{PUBMED_URL}/esearch.fcgi", params=params)
         response.raise_for_status()
         data = response.json()
         ids = data['esearchresult']['idlist']
         summaries = []
-        for id in ids:
-            summary_url = f"https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?db=pubmed&id={id}&retmode=json"
-            summary_response = requests.get(summary_url, timeout=5)
-            if summary_response.status_code == 200:
-                summary_data = summary_response.json()
-                title = summary_data['result'][id].get('title', 'No title')
+        if ids:
+            # One esummary call for all IDs instead of one per article
+            summary_response = _get('pubmed', f"{PUBMED_URL}/esummary.fcgi",
+                                    params={'db': 'pubmed', 'id': ','.join(ids), 'retmode': 'json'})
+            # A failed follow-up is an error, not an empty result that would be cached as not found
+            summary_response.raise_for_status()
+            summary_data = summary_response.json().get('result', {})
+            for id in ids:
+                if id not in summary_data:
+                    continue
+                title = summary_data[id].get('title', 'No title')
                 relevance = title.lower().count(query.lower())
                 summaries.append({'id': id, 'title': title, 'relevance': relevance})
         return {'results': summaries}
     except Exception as e:
         return {'error': f'PubMed search failed: {str(e)}'}
 
+@telemetry.timed('api', function='search_rxnorm')
+@cached('rxnorm')
 def search_rxnorm(drug_name):
     """Map drug to RxNorm codes and compute therapeutic classes."""
-    base_url = "https://rxnav.nlm.nih.gov/REST/rxcui.json"
     params = {'name': drug_name}
     try:
-        response = requests.get(base_url, params=params, timeout=5)
+        response = _get('rxnorm', f"{RXNAV_URL}/rxcui.json", params=params)
         response.raise_for_status()
         data = response.json()
         rxcui = data.get('idGroup', {}).get('rxnormId', [None])[0]
         if rxcui:
-            info_url = f"https://rxnav.nlm.nih.gov/REST/rxcui/{rxcui}/properties.json"
-            info_response = requests.get(info_url, timeout=5)
-            if info_response.status_code == 200:
-                info_data = info_response.json()
-                properties = info_data.get('properties', {})
-                classes = properties.get('therapeuticClasses', []) or ['Unknown']
-                return {'rxcui': rxcui, 'properties': properties, 'therapeutic_classes_count': len(classes)}
+            info_response = _get('rxnorm', f"{RXNAV_URL}/rxcui/{rxcui}/properties.json")
+            info_response.raise_for_status()
+            info_data = info_response.json()
+            properties = info_data.get('properties', {})
+            classes = properties.get('therapeuticClasses', []) or ['Unknown']
+            return {'rxcui': rxcui, 'properties': properties, 'therapeutic_classes_count': len(classes)}
         return {'error': 'No RxCUI found'}
     except Exception as e:
         return {'error': f'RxNorm search failed: {str(e)}'}
 
+@telemetry.timed('api', function='search_mesh')
+@cached('mesh')
 def search_mesh(term):
     """Link term to MeSH headings and calculate match count."""
-    base_url = "https://id.nlm.nih.gov/mesh/sparql"
     query = f"""
     PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
     PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
@@ -64,7 +193,7 @@ def search_mesh(term):
     """
     params = {'query': query, 'format': 'json'}
     try:
-        response = requests.get(base_url, params=params, timeout=5)
+        response = _get('mesh', MESH_URL, params=params)
         response.raise_for_status()
         data = response.json()
         terms = [{'uri': item['mesh']['value'], 'label': item['label']['value']} for item in data['results']['bindings']]
@@ -72,12 +201,13 @@ def search_mesh(term):
     except Exception as e:
         return {'error': f'MeSH search failed: {str(e)}'}
 
+@telemetry.timed('api', function='search_openfda')
+@cached('openfda')
 def search_openfda(drug_name, limit=5):
     """Fetch OpenFDA adverse events and calculate frequency stats."""
-    base_url = "https://api.fda.gov/drug/event.json"
     params = {'search': f'patient.drug.openfda.brand_name:"{drug_name}"', 'limit': limit}
     try:
-        response = requests.get(base_url, params=params, timeout=5)
+        response = _get('openfda', OPENFDA_URL, params=params)
         response.raise_for_status()
         data = response.json()
         if data['meta']['results']['total'] > 0:
@@ -87,4 +217,43 @@ def search_openfda(drug_name, limit=5):
             return {'events': events, 'unique_reactions_count': len(unique_reactions)}
         return {'error': 'No OpenFDA data found'}
     except Exception as e:
-        return {'error': f'OpenFDA search failed: {str(e)}'}
\ No newline at end of file
+        return {'error': f'OpenFDA search failed: {str(e)}'}
+
+def call_api(query, default_query):
+    """Run one LLM-generated API query, e.g. {'api': 'search_pubmed', 'query': '...', 'num_results': 5}."""
+    api_name = query.get('api')
+    if api_name == 'search_pubmed':
+        return search_pubmed(query.get('query', default_query), query.get('num_results', 5))
+    elif api_name == 'search_rxnorm':
+        return search_rxnorm(query.get('drug_name', ''))
+    elif api_name == 'search_mesh':
+        return search_mesh(query.get('term', default_query))
+    elif api_name == 'search_openfda':
+        return search_openfda(query.get('drug_name', ''), query.get('limit', 5))
+    return {'error': f'Unknown API: {api_name}'}
+
+def run_enrichment(queries, default_query, deadline=ENRICHMENT_DEADLINE):
+    """Run all API queries concurrently and yield (query, result, error) as each one finishes.
+
+    error is None on success, otherwise the exception text; calls still running when
+    the shared deadline passes are yielded with a timeout error and left to finish unobserved.
+    """
+    end = time.monotonic() + deadline
+    # Each call runs in a copy of the caller's context so its spans land in the caller's trace
+    pending = {_executors.get(query.get('api'), _default_executor).submit(
+                   contextvars.copy_context().run, call_api, query, default_query): query
+               for query in queries}
+    while pending:
+        done, _ = wait(pending, timeout=max(0.0, end - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            query = pending.pop(future)
+            try:
+                yield query, future.result(), None
+            except Exception as e:
+                yield query, {'error': str(e)}, str(e)
+    for future, query in pending.items():
+        future.cancel()
+        error = f'No response within the {deadline}s enrichment deadline'
+        yield query, {'error': error}, error
@@ -1,16 +1,20 @@
 import streamlit as st
-import pymysql
 import json
-import requests
-from sentence_transformers import SentenceTransformer
 import logging
 import boto3
 import folium
 from folium.plugins import MarkerCluster
 from streamlit_folium import folium_static
-import urllib.parse
-import pandas as pd
 import api_tools
+import db_pool
+import email_jobs
+import embedding_service
+import geocoding
+import match_pipeline
+import result_cache
+import telemetry
+import trial_search
+import upstream
 from openai import OpenAI
 import time
 
@@ -20,6 +24,121 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+# Load the embedding model once per process; reruns and other sessions reuse it
+embedding_service.start_background_warmup()
+
+TIDB_CONFIG = {
+    'host': ".aws.tidbcloud.com",       # add yout TiDB credentials
+    'port': 4000,
+    'user': ".root",
+    'password': "",
+    'database': "test",
+    'ssl': {'ca': '.pem'},
+}
+
+
+# 'tidb', 'local' (serve the clean_trials_data.py output in-process) or 'tidb+local' (local as fallback)
+SEARCH_BACKEND = 'tidb'
+LOCAL_CORPUS_DIR = 'preprocessed_trials'
+LOCAL_APPROXIMATE = False  # IVF index instead of an exact scan, for very large corpora
+
+METRICS_PORT = 9464  # Prometheus scrape endpoint on localhost (None disables it); only the first app process on a host binds it
+LLM_CACHE = True  # reuse Kimi's answers for the same trials, profile and enrichment data (stored in the API cache file)
+EMAIL_WORKERS = 2
+EMAIL_DEAD_LETTER_PATH = 'email_dead_letter.jsonl'  # reports that failed every retry, one JSON job per line
+NEAR_ME_RADIUS_KM = (10, 500, 100)  # min, max and default of the "near me" radius slider
+PLACE_LOOKUP_MAX_WAIT = 2.0  # seconds a search waits for a Nominatim request slot
+TRACE_DIR = None  # directory for one JSON trace per search, e.g. '/home/ubuntu/traces'
+
+
+@st.cache_resource
+def get_tidb_pool():
+    # One pool per process, shared by every session, so searches skip the TCP + TLS + auth handshake
+    return db_pool.ConnectionPool(TIDB_CONFIG, max_size=20)
+
+
+@st.cache_resource
+def get_search_backend():
+    if SEARCH_BACKEND == 'tidb':
+        return trial_search.TiDBSearchBackend(get_tidb_pool())
+    local = trial_search.LocalSearchBackend(LOCAL_CORPUS_DIR, approximate=LOCAL_APPROXIMATE)
+    if SEARCH_BACKEND == 'local':
+        return local
+    return trial_search.FallbackSearchBackend(trial_search.TiDBSearchBackend(get_tidb_pool()), local)
+
+
+@st.cache_resource
+def get_llm_client():
+    return OpenAI(
+        api_key='sk-',                          # Replace with ur api key
+        base_url='https://api.moonshot.ai/v1'
+    )
+
+
+@st.cache_resource
+def get_pipeline():
+    return match_pipeline.MatchPipeline(get_search_backend(), get_llm_client(),
+                                        llm_cache=api_tools.api_cache() if LLM_CACHE else None)
+
+
+@st.cache_resource
+def get_place_geocoder():
+    # Shared, so every session's place lookups together respect Nominatim's rate limit;
+    # a search gives up after PLACE_LOOKUP_MAX_WAIT rather than queueing behind other users
+    return geocoding.NominatimGeocoder(max_wait=PLACE_LOOKUP_MAX_WAIT)
+
+
+@st.cache_resource
+def get_result_cache():
+    # Shared by all sessions; flushed whenever the search backend reports a new corpus version
+    return result_cache.ResultCache(max_entries=256, ttl_seconds=6 * 3600, semantic_distance=0.05,
+                                    version_fn=get_search_backend().corpus_version)
+
+@st.cache_resource
+def get_email_queue():
+    # One Lambda client and worker pool per process; sessions only enqueue and poll
+    lambda_client = boto3.client(
+        'lambda',
+        region_name='us-east-1',              # Replace if different
+        aws_access_key_id='',                 # Replace
+        aws_secret_access_key='+'  # Replace
+    )
+
+    def send(payload):
+        response = lambda_client.invoke(
+            FunctionName='TiDB_hackathon',
+            InvocationType='RequestResponse',
+            Payload=payload
+        )
+        result = json.loads(response['Payload'].read().decode('utf-8'))
+        logging.info(f"Email Lambda stages: {json.dumps(result.get('timings_ms', {}))}")
+        return result
+
+    return email_jobs.EmailQueue(send, workers=EMAIL_WORKERS, dead_letter_path=EMAIL_DEAD_LETTER_PATH)
+
+
+@st.cache_resource
+def start_metrics():
+    # Once per process: gauges from the shared pools and caches alongside the span histograms
+    telemetry.register_collector('result_cache', get_result_cache().metrics)
+    telemetry.register_collector('api_upstream', api_tools.upstream_metrics)
+    telemetry.register_collector('email', get_email_queue().metrics)
+    if api_tools.api_cache() is not None:
+        telemetry.register_collector('api_cache', api_tools.api_cache().metrics)
+    if SEARCH_BACKEND != 'local':
+        telemetry.register_collector('tidb_pool', get_tidb_pool().metrics)
+    if not METRICS_PORT:
+        return None
+    try:
+        return telemetry.start_http_server(METRICS_PORT)
+    except OSError as e:
+        # Another app process on this host already serves the port; keep searching without an endpoint here
+        logging.warning(f"Metrics endpoint not started on port {METRICS_PORT}: {e}")
+        return None
+
+
+start_metrics()
+
 # Streamlit UI styling
 st.markdown("""
     <style>
@@ -40,6 +159,7 @@ st.sidebar.write("🧬 AI-powered trial matching using TiDB, Kimi AI, and AWS.")
 st.sidebar.write("📍 Maps powered by OpenStreetMap.")
 st.sidebar.markdown("**External Tools**: PubMed, RxNorm, MeSH, OpenFDA")
 st.sidebar.write("🔮 Future: Blockchain for secure data sharing.")
+st.sidebar.caption("🧠 AI model ready" if embedding_service.is_ready() else "🧠 AI model warming up...")
 
 st.sidebar.title("Navigation 📋")
 st.sidebar.markdown("""
@@ -64,6 +184,22 @@ st.sidebar.button("How to Use 😎", on_click=lambda: st.session_state.update({'
 st.sidebar.button("Tech Behind It 👩‍💻", on_click=lambda: st.session_state.update({'page': 'tech'}))
 st.sidebar.button("Contact Me 🤳", on_click=lambda: st.session_state.update({'page': 'contact'}))
 
+def show_progress(event):
+    """Render a pipeline ProgressEvent in the log area as soon as it is emitted."""
+    css = 'warning' if event.status in ('warning', 'failed') else 'success'
+    timing = f" ({event.duration_ms / 1000:.1f}s)" if event.duration_ms is not None and event.status != 'started' else ""
+    log_area.markdown(f'<div class="log-message"><span class="{css}">{event.message}{timing}</span></div>', unsafe_allow_html=True)
+    logging.info(f"Progress: {json.dumps(event.as_dict(), ensure_ascii=False)}")
+
+def answer_stream():
+    """on_token callback that shows Kimi's ranking and explanation in the answer area while they are generated."""
+    streamed = []
+    def show_token(text):
+        streamed.append(text)
+        answer_area.markdown(''.join(streamed))
+    return show_token
+
+
 # Page content based on button click
 if 'page' not in st.session_state:
     st.session_state['page'] = 'home'
@@ -76,9 +212,10 @@ elif st.session_state['page'] == 'howto':
     st.write("Welcome! This tool helps you find clinical trials that match your health needs. Here’s a simple guide:")
     st.write("- **Step 1**: Type your symptoms (e.g., 'diabetes fatigue') in the 'Symptoms/Conditions' box.")
     st.write("- **Step 2**: Pick your age group and sex from the dropdowns.")
-    st.write("- **Step 3**: (Optional) Add your email to get a detailed report.")
-    st.write("- **Step 4**: Click 'Find Trials' and wait for results to load with progress updates.")
-    st.write("- **Step 5**: Check the trial list, map, and explanation. Explore the map or email for more!")
+    st.write("- **Step 3**: (Optional) Tick 'Only trials near me', enter your city or coordinates and pick how far you can travel.")
+    st.write("- **Step 4**: (Optional) Add your email to get a detailed report.")
+    st.write("- **Step 5**: Click 'Find Trials' and wait for results to load with progress updates.")
+    st.write("- **Step 6**: Check the trial list, map, and explanation. Explore the map or email for more!")
     st.write("It’s easy and safe—try it with any health concern!")
 elif st.session_state['page'] == 'tech':
     st.title("Tech Behind the Tool 💻")
@@ -96,353 +233,156 @@ elif st.session_state['page'] == 'contact':
     st.write("- **Email**: pandeyaryaman187@gmail.com")
     st.write("Feel free to connect for questions or feedback!")
 
-# Log area
+# Log area, and the Kimi answer as it streams in
 log_area = st.empty()
+answer_area = st.empty()
 
 # Input form
 user_input = st.text_area("Symptoms/Conditions (e.g., 'diabetes fatigue') 💊", "diabetes symptoms fatigue")
 age_group = st.selectbox("Age Group 🎂", ["ADULT", "OLDER_ADULT", "CHILD", "ALL"])
 sex = st.selectbox("Sex 🚻", ["ALL", "MALE", "FEMALE"])
-email = st.text_input("Email (optional, to receive results directly in your inbox; this process may take up to a minute to complete) 📧", "")
+near_me = st.checkbox("Only trials near me 📍")
+if near_me:
+    location = st.text_input("Your location (city, or 'latitude, longitude') 🏠", "")
+    radius_km = st.slider("Within (km) 🚗", *NEAR_ME_RADIUS_KM, step=10)
+email = st.text_input("Email (optional, to receive results directly in your inbox; the report is sent in the background) 📧", "")
 if st.button("Find Trials 🔍"):
-    try:
-        if not user_input.strip():
-            raise ValueError("Please enter symptoms or conditions.")
-
-        logging.info(f"Processing query: {user_input}, Age: {age_group}, Sex: {sex}, Email: {email}")
-
-        # Log start
-        log_area.markdown(f'<div class="log-message"><span class="success">🚀 Starting trial search at {time.strftime("%H:%M:%S")}</span></div>', unsafe_allow_html=True)
-        time.sleep(1)
-
-        # Load model
-        model = SentenceTransformer('all-MiniLM-L6-v2')
-        log_area.markdown(f'<div class="log-message"><span class="success">🧠 Loading AI model...</span></div>', unsafe_allow_html=True)
-        time.sleep(1)
-
-        # Generate query embedding
-        query_embedding = model.encode(user_input).tolist()
-        if len(query_embedding) != 384:
-            raise ValueError("Embedding dimension mismatch.")
-        query_embedding_json = json.dumps(query_embedding)
-
-        log_area.markdown(f'<div class="log-message"><span class="success">📊 Generating query embedding...</span></div>', unsafe_allow_html=True)
-        time.sleep(1)
-
-        logging.info("Generated query embedding.")
-
-        # TiDB connection
-        conn = pymysql.connect(
-        host = ".aws.tidbcloud.com",       # add yout TiDB credentials
-        port = 4000,
-        user = ".root",
-        password = "",
-        database = "test",
-        ssl={'ca': '.pem'}
-        )
-        cursor = conn.cursor()
-        log_area.markdown(f'<div class="log-message"><span class="success">🔍 Searching TiDB database...</span></div>', unsafe_allow_html=True)
-        time.sleep(1)
-
-        # Vector search with filters
-        sql = """
-            SELECT nct_number, study_title, conditions, brief_summary, locations, interventions,
-            VEC_COSINE_DISTANCE(embedding, %s) AS distance
-            FROM clinical_trials_latest
-            WHERE sex = %s AND age LIKE %s AND VEC_COSINE_DISTANCE(embedding, %s) < 0.5
-            ORDER BY distance ASC
-            LIMIT 5
-        """
-        cursor.execute(sql, (query_embedding_json, sex, f'%{age_group}%', query_embedding_json))
-        results = cursor.fetchall()
-
-        if not results:
-            log_area.markdown(f'<div class="log-message"><span class="warning">⚠ No matching trials found for "{user_input}". Try different symptoms.</span></div>', unsafe_allow_html=True)
-            st.stop()  # Halt execution if no results
-        cursor.close()
-        conn.close()
-
-        log_area.markdown(f'<div class="log-message"><span class="success">✅ Found {len(results)} trials!</span></div>', unsafe_allow_html=True)
-        time.sleep(1)
-
-        # Kimi LLM chaining with tool-calling
-        client = OpenAI(
-            api_key='sk-',                          # Replace with ur api key
-            base_url='https://api.moonshot.ai/v1'
-        )
-
-        # Define tools for Kimi
-        tools = [
-            {
-                'type': 'function',
-                'function': {
-                    'name': 'search_pubmed',
-                    'description': 'Search PubMed for articles on a query.',
-                    'parameters': {
-                        'type': 'object',
-                        'properties': {
-                            'query': {'type': 'string', 'description': 'Search query.'},
-                            'num_results': {'type': 'integer', 'description': 'Number of results.', 'default': 5}
-                        },
-                        'required': ['query']
-                    }
-                }
-            },
-            {
-                'type': 'function',
-                'function': {
-                    'name': 'search_rxnorm',
-                    'description': 'Map drug to RxNorm codes and therapeutic classes.',
-                    'parameters': {
-                        'type': 'object',
-                        'properties': {
-                            'drug_name': {'type': 'string', 'description': 'Drug name to map.'}
-                        },
-                        'required': ['drug_name']
-                    }
-                }
-            },
-            {
-                'type': 'function',
-                'function': {
-                    'name': 'search_mesh',
-                    'description': 'Link term to MeSH headings and count matches.',
-                    'parameters': {
-                        'type': 'object',
-                        'properties': {
-                            'term': {'type': 'string', 'description': 'Medical term to search.'}
-                        },
-                        'required': ['term']
-                    }
-                }
-            },
-            {
-                'type': 'function',
-                'function': {
-                    'name': 'search_openfda',
-                    'description': 'Fetch OpenFDA adverse events and stats for a drug.',
-                    'parameters': {
-                        'type': 'object',
-                        'properties': {
-                            'drug_name': {'type': 'string', 'description': 'Drug name for adverse events.'},
-                            'limit': {'type': 'integer', 'description': 'Number of events.', 'default': 5}
-                        },
-                        'required': ['drug_name']
-                    }
-                }
-            }
-        ]
-
-        results_json = json.dumps([{
-            'nct_number': row[0],
-            'title': row[1],
-            'conditions': row[2],
-            'summary': row[3],
-            'interventions': row[5],
-            'distance': row[6]
-        } for row in results])
-
-        # Kimi call: Generate API queries and rank trials
-        log_area.markdown(f'<div class="log-message"><span class="success">🤖 Contacting Kimi AI for ranking...</span></div>', unsafe_allow_html=True)
-        time.sleep(1)
-
-        messages = [
-            {'role': 'system', 'content': 'You are Kimi, an AI assistant provided by Moonshot AI.'},
-            {'role': 'user', 'content': (
-                f"For query '{user_input}' for a {age_group} {sex} patient, generate search parameters for PubMed, RxNorm, MeSH, and OpenFDA APIs to enrich trial data. "
-                f"Trials: {results_json}. "
-                "Provide one query per API in JSON format (e.g., {'api': 'search_pubmed', 'query': '...', 'num_results': 5}). "
-                "Then rank trials based on relevance, using API data if available. Return ranking and queries."
-            )}
-        ]
-
-        completion = client.chat.completions.create(
-            model='kimi-k2-0905-preview',
-            messages=messages,
-            temperature=0.6
-        )
-
-        response_data = completion.choices[0].message
-        ranked_results = ""
-        api_results = {}
-        if response_data.content:
-            ranked_results += response_data.content + "\n"
-
+    with telemetry.trace(TRACE_DIR, age_group=age_group, sex=sex, email=bool(email)), telemetry.span('request'):
         try:
-            # Parse Kimi response for API queries
-            content = json.loads(response_data.content) if response_data.content else {}
-            queries = content.get('queries', [])
-            ranked_results = content.get('ranking', "No ranking provided.")
-            log_area.markdown(f'<div class="log-message"><span class="success">📝 Kimi generated ranking and API queries...</span></div>', unsafe_allow_html=True)
-            logging.info(f"Kimi generated API queries: {json.dumps(queries)}")
-        except json.JSONDecodeError:
-            queries = []
-            ranked_results = response_data.content or "No ranking provided."
-            log_area.markdown(f'<div class="log-message"><span class="warning">⚠ Failed to parse Kimi response...</span></div>', unsafe_allow_html=True)
-            logging.error("Failed to parse Kimi response as JSON.")
-
-        # Execute API calls
-        for query in queries:
-            api_name = query.get('api')
-            log_area.markdown(f'<div class="log-message"><span class="success">🌐 Fetching data from {api_name}...</span></div>', unsafe_allow_html=True)
-            time.sleep(1)
-            try:
-                if api_name == 'search_pubmed':
-                    result = api_tools.search_pubmed(query.get('query', user_input), query.get('num_results', 5))
-                elif api_name == 'search_rxnorm':
-                    result = api_tools.search_rxnorm(query.get('drug_name', ''))
-                elif api_name == 'search_mesh':
-                    result = api_tools.search_mesh(query.get('term', user_input))
-                elif api_name == 'search_openfda':
-                    result = api_tools.search_openfda(query.get('drug_name', ''), query.get('limit', 5))
-                else:
-                    result = {'error': f'Unknown API: {api_name}'}
-                api_results[api_name] = result
-                log_area.markdown(f'<div class="log-message"><span class="success">✅ {api_name} data retrieved!</span></div>', unsafe_allow_html=True)
-
-                logging.info(f"API call {api_name}: {json.dumps(result)}")
-            except Exception as e:
-                api_results[api_name] = {'error': str(e)}
-                log_area.markdown(f'<div class="log-message"><span class="warning">⚠ {api_name} failed: {str(e)}</span></div>', unsafe_allow_html=True)
-                logging.error(f"API call error for {api_name}: {str(e)}")
-
-        # Kimi call: Rank with API results
-        log_area.markdown(f'<div class="log-message"><span class="success">🤖 Finalizing ranking with API data...</span></div>', unsafe_allow_html=True)
-        time.sleep(1)
-        messages = [
-            {'role': 'system', 'content': 'You are Kimi, an AI assistant provided by Moonshot AI.'},
-            {'role': 'user', 'content': (
-                f"Rank trials for '{user_input}' ({age_group} {sex}) using: {results_json}. "
-                f"API results: {json.dumps(api_results)}. "
-                "Incorporate PubMed research, RxNorm drug mappings, MeSH terms, and OpenFDA safety data."
-            )}
-        ]
-
-        # Re-call Kimi with tool results for final ranking
-        completion = client.chat.completions.create(
-            model='kimi-k2-0905-preview',
-            messages=messages,
-            temperature=0.6
-        )
-
-        ranked_results = completion.choices[0].message.content or "No ranking provided after API calls."
-        log_area.markdown(f'<div class="log-message"><span class="success">🎉 Ranking complete!</span></div>', unsafe_allow_html=True)
-        logging.info(f"Kimi ranked results with API data: {ranked_results}")
-
-        log_area.markdown(f'<div class="log-message"><span class="success">🤖 Generating explanation...</span></div>', unsafe_allow_html=True)
-        time.sleep(1)
-
-        messages = [
-            {'role': 'system', 'content': 'You are Kimi, an AI assistant provided by Moonshot AI.'},
-            {'role': 'user', 'content': (
-                "Explain why these ranked trials "
-                f"({ranked_results}) match the query '{user_input}' for a {age_group} {sex} patient. "
-                "Incorporate tool data (PubMed, RxNorm, MeSH, OpenFDA). "
-                "Use simple, everyday language that a non-expert patient can understand. Avoid medical jargon (e.g., T2DM, MeSH, RxNorm, OpenFDA) and technical terms (e.g., r = 0.62, cytokine-release). Focus on clear benefits, risks, and why the trial fits their needs. Keep it short and friendly.If matches are poor, say 'No good matches found'"
-            )}
-        ]
-        completion = client.chat.completions.create(
-            model='kimi-k2-0905-preview',
-            messages=messages,
-            temperature=0.6
-        )
-
-        explanation = completion.choices[0].message.content or "No explanation provided."
-        log_area.markdown(f'<div class="log-message"><span class="success">✅ Explanation ready!</span></div>', unsafe_allow_html=True)
-        logging.info(f"Kimi generated explanation: {explanation}")
-
-        # Clear logs and display results
-        log_area.empty()
-
-        st.markdown("<h2 style='color: #ffffff;'><u>Matching Trials</u> 🧪</h2>", unsafe_allow_html=True)
-        for row in results:
-            st.markdown(f"<p style='margin: 10px 0;'><b>Trial ID:</b> {row[0]}</p>", unsafe_allow_html=True)
-            st.markdown(f"<p style='margin: 10px 0;'><b>Title:</b> {row[1]}</p>", unsafe_allow_html=True)
-            st.markdown(f"<p style='margin: 10px 0;'><b>Conditions:</b> {row[2]}</p>", unsafe_allow_html=True)
-            st.markdown(f"<p style='margin: 10px 0;'><b>Summary:</b> {row[3]}</p>", unsafe_allow_html=True)
-            st.markdown(f"<p style='margin: 10px 0;'><b>Similarity Score:</b> {row[6]:.4f}</p>", unsafe_allow_html=True)
-            st.markdown("<hr style='border: 1px solid #e0e0e0;'>", unsafe_allow_html=True)
-        st.markdown("<h2 style='color: #ffffff;'><u>Trial Location </u>📍</h2>", unsafe_allow_html=True)
-        static_map_url = ""
-        try:
-            locations = results[0][4] if results and pd.notna(results[0][4]) else ""
-            if locations:
-                locations = urllib.parse.quote(locations.strip().replace('|', ','))
-                geocode_url = f"https://nominatim.openstreetmap.org/search?q={locations}&format=json&limit=1"
-                headers_osm = {'User-Agent': 'TrialMatchingDemo/1.0 (your_email@example.com)'}  # Replace
-                geocode_response = requests.get(geocode_url, headers=headers_osm, timeout=5).json()
-                if geocode_response:
-                    lat = float(geocode_response[0]['lat'])
-                    lng = float(geocode_response[0]['lon'])
-                    m = folium.Map(location=[lat, lng], zoom_start=10, tiles='OpenStreetMap')
-                    MarkerCluster().add_to(m)
-                    folium.Marker([lat, lng], popup=results[0][1][:100]).add_to(m)
-                    folium_static(m, width=700, height=400)
-                    static_map_url = f"https://tile.openstreetmap.de/{lat},{lng},10/600x300.png"
-                else:
-                    st.warning("Could not geocode trial location.")
-                    m = folium.Map(location=[0, 0], zoom_start=2, tiles='OpenStreetMap')
-                    folium_static(m, width=700, height=400)
+            if not user_input.strip():
+                raise ValueError("Please enter symptoms or conditions.")
+
+            near = None
+            if near_me:
+                try:
+                    with telemetry.span('locate_patient'):
+                        point = geocoding.locate_place(location, get_place_geocoder(), api_tools.api_cache())
+                except upstream.RateLimited:
+                    raise ValueError("Location lookup is busy right now. Please try again in a moment, "
+                                     "or enter 'latitude, longitude'.")
+                except Exception as e:
+                    logging.error(f"Location lookup failed: {e}")
+                    raise ValueError("Could not look up that location right now. Try entering 'latitude, longitude'.")
+                if point is None:
+                    raise ValueError("Could not find that location. Try a nearby city or 'latitude, longitude'.")
+                # Rounded to ~1 km, so nearby repeats share result cache entries
+                near = (round(point[0], 2), round(point[1], 2), float(radius_km))
+
+            logging.info(f"Processing query: {user_input}, Age: {age_group}, Sex: {sex}, Near: {near}, Email: {email}")
+
+            # Log start
+            log_area.markdown(f'<div class="log-message"><span class="success">🚀 Starting trial search at {time.strftime("%H:%M:%S")}</span></div>', unsafe_allow_html=True)
+
+            # Repeat queries are answered from the result cache before any model, database or LLM work
+            pipeline = get_pipeline()
+            match_cache = get_result_cache()
+            with telemetry.span('result_cache', lookup='exact'):
+                match = match_cache.lookup_exact(user_input, age_group, sex, near)
+            from_cache = match is not None
+            if match is None:
+                # Shared model, already warm unless this is the very first search after startup
+                query_embedding = pipeline.embed(user_input, on_event=show_progress)
+                with telemetry.span('result_cache', lookup='semantic'):
+                    match = match_cache.lookup_similar(query_embedding, age_group, sex, near)
+                from_cache = match is not None
+                if match is None:
+                    match = pipeline.run(user_input, age_group, sex, query_embedding, on_event=show_progress,
+                                         on_token=answer_stream(), near=near)
+                    if SEARCH_BACKEND != 'local':
+                        logging.info(f"TiDB pool: {json.dumps(get_tidb_pool().metrics())}")
+                    if api_tools.api_cache() is not None:
+                        logging.info(f"API cache: {json.dumps(api_tools.api_cache().metrics())}")
+                    logging.info(f"API upstreams: {json.dumps(api_tools.upstream_metrics())}")
+                    if not match['results']:
+                        st.stop()  # Halt execution if no results; the warning is already in the log area
+                    match_cache.put(user_input, age_group, sex, query_embedding, match, near)
+            if from_cache:
+                log_area.markdown(f'<div class="log-message"><span class="success">⚡ Reusing results from a recent matching search!</span></div>', unsafe_allow_html=True)
+            logging.info(f"Result cache: {json.dumps(match_cache.metrics())}")
+            results = match['results']
+            ranked_results = match['ranked_results']
+            explanation = match['explanation']
+
+            # Clear logs and the streamed preview, and display results
+            log_area.empty()
+            answer_area.empty()
+
+            st.markdown("<h2 style='color: #ffffff;'><u>Matching Trials</u> 🧪</h2>", unsafe_allow_html=True)
+            for row in results:
+                st.markdown(f"<p style='margin: 10px 0;'><b>Trial ID:</b> {row[0]}</p>", unsafe_allow_html=True)
+                st.markdown(f"<p style='margin: 10px 0;'><b>Title:</b> {row[1]}</p>", unsafe_allow_html=True)
+                st.markdown(f"<p style='margin: 10px 0;'><b>Conditions:</b> {row[2]}</p>", unsafe_allow_html=True)
+                st.markdown(f"<p style='margin: 10px 0;'><b>Summary:</b> {row[3]}</p>", unsafe_allow_html=True)
+                st.markdown(f"<p style='margin: 10px 0;'><b>Similarity Score:</b> {row[6]:.4f}</p>", unsafe_allow_html=True)
+                if row[0] in match['site_distances']:
+                    st.markdown(f"<p style='margin: 10px 0;'><b>Nearest Site:</b> {match['site_distances'][row[0]]:.0f} km away</p>", unsafe_allow_html=True)
+                st.markdown("<hr style='border: 1px solid #e0e0e0;'>", unsafe_allow_html=True)
+            st.markdown("<h2 style='color: #ffffff;'><u>Trial Locations </u>📍</h2>", unsafe_allow_html=True)
+            static_map_url = ""
+            if match['map_points']:
+                # Coordinates were stored at ingestion, so every site of every result is drawn without geocoding
+                lat, lng = match['map_point']
+                m = folium.Map(location=[lat, lng], zoom_start=10, tiles='OpenStreetMap')
+                cluster = MarkerCluster().add_to(m)
+                for point in match['map_points']:
+                    folium.Marker([point['lat'], point['lng']], tooltip=point['nct'],
+                                  popup=f"{point['nct']}: {(point['title'] or '')[:100]}<br>{point['site']}").add_to(cluster)
+                corners = [(p['lat'], p['lng']) for p in match['map_points']]
+                if near:
+                    folium.Marker(near[:2], tooltip="You", icon=folium.Icon(color='red', icon='home')).add_to(m)
+                    folium.Circle(near[:2], radius=near[2] * 1000, color='#e74c3c', fill=False).add_to(m)
+                    corners.append(near[:2])
+                if len(corners) > 1:
+                    m.fit_bounds([[min(lat for lat, _ in corners), min(lng for _, lng in corners)],
+                                  [max(lat for lat, _ in corners), max(lng for _, lng in corners)]])
+                folium_static(m, width=700, height=400)
+                static_map_url = f"https://tile.openstreetmap.de/{lat},{lng},10/600x300.png"
             else:
-                st.warning("No valid location data for trial.")
+                st.warning(match['map_warning'])
                 m = folium.Map(location=[0, 0], zoom_start=2, tiles='OpenStreetMap')
                 folium_static(m, width=700, height=400)
+            st.markdown("<h2 style='color: #ffffff;'><u>AI Analysis </u> 🤖</h2>", unsafe_allow_html=True)
+            st.markdown(f"<p style='margin: 10px 0;'><b>Ranked Results:</b> {ranked_results}</p>", unsafe_allow_html=True)
+            st.markdown(f"<p style='margin: 10px 0;'><b>Why These Match:</b> {explanation}</p>", unsafe_allow_html=True)
+            st.markdown("<p style='margin: 10px 0; color: #e74c3c;'><i>**Note**: This is a demo, not medical advice. Consult a doctor.</i></p>", unsafe_allow_html=True)
+
+            # Queue the email report; a background worker invokes the Lambda, so nobody waits on SMTP
+            if email:
+                payload = json.dumps({
+                    'to_email': email,
+                    'user_input': user_input,
+                    'age_group': age_group,
+                    'sex': sex,
+                    'ranked_results': ranked_results,
+                    'explanation': explanation,
+                    'trials': [{
+                        'nct_number': row[0],
+                        'title': row[1],
+                        'conditions': row[2],
+                        'summary': row[3],
+                        'distance': row[6]
+                    } for row in results],
+                    'static_map_url': static_map_url
+                })
+                job_id = get_email_queue().submit(payload)
+                st.session_state.setdefault('email_jobs', []).append((job_id, email))
+                st.success(f"Formatted report queued for {email} 📧 Delivery status is in the sidebar.")
+                logging.info(f"Queued email job {job_id} for {email}")
+
         except Exception as e:
-            st.warning(f"Could not map trial locations: {str(e)}")
-            logging.error(f"Geocoding error: {str(e)}")
-            m = folium.Map(location=[0, 0], zoom_start=2, tiles='OpenStreetMap')
-            folium_static(m, width=700, height=400)
-        st.markdown("<h2 style='color: #ffffff;'><u>AI Analysis </u> 🤖</h2>", unsafe_allow_html=True)
-        st.markdown(f"<p style='margin: 10px 0;'><b>Ranked Results:</b> {ranked_results}</p>", unsafe_allow_html=True)
-        st.markdown(f"<p style='margin: 10px 0;'><b>Why These Match:</b> {explanation}</p>", unsafe_allow_html=True)
-        st.markdown("<p style='margin: 10px 0; color: #e74c3c;'><i>**Note**: This is a demo, not medical advice. Consult a doctor.</i></p>", unsafe_allow_html=True)
-
-        # Invoke Lambda if email provided
-        if email:
-            lambda_client = boto3.client(
-                'lambda',
-                region_name='us-east-1',              # Replace if different
-                aws_access_key_id='',                 # Replace
-                aws_secret_access_key='+'  # Replace
-            )
-            payload = json.dumps({
-                'to_email': email,
-                'user_input': user_input,
-                'age_group': age_group,
-                'sex': sex,
-                'ranked_results': ranked_results,
-                'explanation': explanation,
-                'trials': [{
-                    'nct_number': row[0],
-                    'title': row[1],
-                    'conditions': row[2],
-                    'summary': row[3],
-                    'distance': row[6]
-                } for row in results],
-                'static_map_url': static_map_url
-            })
-            log_area.markdown(f'<div class="log-message"><span class="success">📧 Sending email report...</span></div>', unsafe_allow_html=True)
-            time.sleep(1)
-            response = lambda_client.invoke(
-                FunctionName='TiDB_hackathon',
-                InvocationType='RequestResponse',
-                Payload=payload
-            )
-            try:
-                result = json.loads(response['Payload'].read().decode('utf-8'))
-                if result:
-                    log_area.markdown(f'<div class="log-message"><span class="success">✅ Email sent to {email}!</span></div>', unsafe_allow_html=True)
-                    st.success(f"Formatted report emailed to {email}📧")
-                    logging.info(f"Emailed report to {email}")
-                else:
-                    st.error(f"Email failed: {result.get('body', 'Unknown error')}")
-                    logging.error(f"Lambda invoke failed: {result.get('body', 'Unknown error')}")
-            except json.JSONDecodeError:
-                st.error("Lambda response invalid.")
-                logging.error("Invalid Lambda response JSON.")
-
-    except Exception as e:
-        st.error(f"Error: {str(e)}")
-        logging.error(f"Error processing query: {str(e)}")
-
-st.write("Future Enhancement: Blockchain for secure data sharing (e.g., Ethereum smart contracts). 🔗")
\ No newline at end of file
+            st.error(f"Error: {str(e)}")
+            logging.error(f"Error processing query: {str(e)}")
+
+st.write("Future Enhancement: Blockchain for secure data sharing (e.g., Ethereum smart contracts). 🔗")
+
+# Delivery status of this session's email reports, refreshed on every rerun
+if st.session_state.get('email_jobs'):
+    st.sidebar.markdown("**Email reports 📧**")
+    icons = {'queued': '⏳', 'sending': '📤', 'retrying': '🔁', 'sent': '✅', 'dead': '❌'}
+    for job_id, to_email in reversed(st.session_state['email_jobs'][-5:]):
+        job = get_email_queue().status(job_id)
+        if job is None:
+            continue
+        note = f" (attempt {job['attempts']}: {job['error']})" if job['error'] and job['state'] != 'sent' else ""
+        st.sidebar.write(f"{icons.get(job['state'], '')} {to_email}: {job['state']}{note}")
+    st.sidebar.button("Refresh email status 🔄")
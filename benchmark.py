@@ -0,0 +1,1181 @@
+"""Timing reports for MedMatch's hot paths.
+
+Run one report at a time, e.g. `python benchmark.py embedding --runs 20`.
+"""
+import argparse
+import base64
+import collections
+import contextlib
+import importlib
+import io
+import json
+import os
+import random
+import re
+import socket
+import socketserver
+import statistics
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_QUERIES = [
+    "diabetes symptoms fatigue",
+    "type 2 diabetes insulin resistance",
+    "breast cancer HER2 positive",
+    "asthma in children",
+    "chronic kidney disease anemia",
+    "major depressive disorder treatment resistant",
+    "rheumatoid arthritis joint pain",
+    "hypertension older adults",
+]
+
+# Places for synthetic trial sites, as geocoding.site_query() reduces them
+SAMPLE_PLACES = {
+    'Boston, Massachusetts, United States': (42.3601, -71.0589),
+    'New York, New York, United States': (40.7128, -74.0060),
+    'Houston, Texas, United States': (29.7604, -95.3698),
+    'Chicago, Illinois, United States': (41.8781, -87.6298),
+    'Seattle, Washington, United States': (47.6062, -122.3321),
+    'Toronto, Ontario, Canada': (43.6532, -79.3832),
+    'London, United Kingdom': (51.5074, -0.1278),
+    'Paris, France': (48.8566, 2.3522),
+    'Berlin, Germany': (52.5200, 13.4050),
+    'Madrid, Spain': (40.4168, -3.7038),
+    'Tokyo, Japan': (35.6762, 139.6503),
+    'Sydney, New South Wales, Australia': (-33.8688, 151.2093),
+}
+
+
+def summarize(samples):
+    """Return p50/p95/p99/mean/max in milliseconds for a list of durations in seconds."""
+    ordered = sorted(samples)
+    p95_index = min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))
+    p99_index = min(len(ordered) - 1, int(round(0.99 * (len(ordered) - 1))))
+    return {
+        'n': len(ordered),
+        'p50_ms': statistics.median(ordered) * 1000,
+        'p95_ms': ordered[p95_index] * 1000,
+        'p99_ms': ordered[p99_index] * 1000,
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+def print_report(title, rows):
+    """Print a small fixed-width latency table; rows is a list of (label, summary) pairs."""
+    print(f"\n{title}")
+    print(f"{'case':<34}{'n':>6}{'p50 ms':>12}{'p95 ms':>12}{'mean ms':>12}{'max ms':>12}")
+    for label, s in rows:
+        print(f"{label:<34}{s['n']:>6}{s['p50_ms']:>12.2f}{s['p95_ms']:>12.2f}{s['mean_ms']:>12.2f}{s['max_ms']:>12.2f}")
+
+
+def bench_embedding(args):
+    """Cold (load model per search, the old app.py path) vs warm (shared service) query embedding."""
+    from sentence_transformers import SentenceTransformer
+    import embedding_service
+
+    queries = [SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)] for i in range(args.runs)]
+
+    cold = []
+    for query in queries[:args.cold_runs]:
+        start = time.perf_counter()
+        model = SentenceTransformer(embedding_service.MODEL_NAME)
+        model.encode(query).tolist()
+        cold.append(time.perf_counter() - start)
+        del model
+
+    start = time.perf_counter()
+    embedding_service.warmup()
+    warmup_seconds = time.perf_counter() - start
+
+    warm = []
+    for query in queries:
+        start = time.perf_counter()
+        embedding_service.encode_query(query)
+        warm.append(time.perf_counter() - start)
+
+    print_report("Query embedding latency", [
+        ("cold: load model + encode", summarize(cold)),
+        ("warm: shared embedding_service", summarize(warm)),
+    ])
+    print(f"\nOne-time service warmup: {warmup_seconds * 1000:.1f} ms "
+          f"(load {embedding_service.stats['load_seconds'] * 1000:.1f} ms)")
+
+
+def synthetic_corpus(n, seed=0, topics=64):
+    """Return (metadata DataFrame, float32 embeddings) shaped like a preprocessed corpus.
+
+    Embeddings are clustered around `topics` random directions, like real trial text.
+    """
+    import numpy as np
+    import pandas as pd
+    import trial_store
+
+    rng = random.Random(seed)
+    words = "diabetes insulin fatigue cancer tumor asthma kidney heart pain therapy dose placebo cohort".split()
+    ages = ['ADULT, OLDER_ADULT', 'CHILD, ADULT, OLDER_ADULT', 'ADULT', 'CHILD', 'OLDER_ADULT']
+    rows = []
+    for i in range(n):
+        row = {c: ' '.join(rng.choices(words, k=6)) for c in trial_store.EXPORT_COLUMNS}
+        row['NCT Number'] = f"NCT{i:08d}"
+        row['Brief Summary'] = ' '.join(rng.choices(words, k=60))
+        row['Enrollment'] = float(rng.randint(10, 500))
+        row['Age'] = rng.choice(ages)
+        row['Sex'] = rng.choice(['ALL', 'ALL', 'ALL', 'MALE', 'FEMALE'])
+        row['Locations'] = '|'.join(f"{rng.choice(words).title()} Research Center, {place}"
+                                    for place in rng.sample(sorted(SAMPLE_PLACES), rng.randint(1, 4)))
+        row['text_for_embedding'] = row['Conditions'] + ' ' + row['Brief Summary']
+        rows.append(row)
+    np_rng = np.random.default_rng(seed)
+    centers = np_rng.standard_normal((topics, 384)).astype(np.float32)
+    embeddings = centers[np_rng.integers(0, topics, n)] + 0.6 * np_rng.standard_normal((n, 384)).astype(np.float32)
+    return pd.DataFrame(rows), embeddings.astype(np.float32)
+
+
+def write_sample_sites(corpus_dir):
+    """Geocode a synthetic corpus's sites from SAMPLE_PLACES, as geocoding.py would from Nominatim."""
+    import geocoding
+    return geocoding.write_sites(corpus_dir, geocoding.BatchGeocoder(geocoding.Gazetteer(SAMPLE_PLACES)))
+
+
+def write_spread_sites(corpus_dir, df, spread_degrees=1.5, seed=0):
+    """Like write_sample_sites, but each site scattered around its city, as real sites spread over a region."""
+    import numpy as np
+    import geocoding
+
+    rows = [(nct, index, site) for nct, locations in zip(df['NCT Number'], df['Locations'])
+            for index, site in enumerate(geocoding.split_sites(locations))]
+    centres = np.array([SAMPLE_PLACES[geocoding.site_query(site)] for _, _, site in rows])
+    points = centres + np.random.default_rng(seed).normal(0, spread_degrees, centres.shape)
+    sites = geocoding.pd.DataFrame(rows, columns=geocoding.SITE_COLUMNS[:3])
+    sites['latitude'], sites['longitude'] = np.clip(points[:, 0], -89.9, 89.9), (points[:, 1] + 180) % 360 - 180
+    sites.to_parquet(os.path.join(corpus_dir, geocoding.SITES_FILE), index=False)
+    return len(sites)
+
+
+def write_corpus(corpus_dir, df, embeddings, part_rows=20000):
+    """Write a complete trial_store corpus directory from in-memory data."""
+    import trial_store
+
+    os.makedirs(corpus_dir, exist_ok=True)
+    manifest = trial_store.new_manifest()
+    for start in range(0, len(df), part_rows):
+        manifest['parts'].append(trial_store.write_part(
+            corpus_dir, start // part_rows, df.iloc[start:start + part_rows], embeddings[start:start + part_rows]))
+    manifest['complete'] = True
+    trial_store.write_manifest(corpus_dir, manifest)
+    return manifest
+
+
+def bench_storage(args):
+    """Size and load time of the old CSV-with-JSON-embeddings file vs Parquet + mmap .npy parts."""
+    import numpy as np
+    import pandas as pd
+    import trial_store
+
+    df, embeddings = synthetic_corpus(args.rows)
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'preprocessed_trials.csv')
+        legacy = df.copy()
+        legacy['embedding'] = [json.dumps(vector) for vector in embeddings.tolist()]
+        legacy.to_csv(csv_path, index=False)
+        del legacy
+
+        corpus_dir = os.path.join(tmp, 'preprocessed_trials')
+        part = write_corpus(corpus_dir, df, embeddings, part_rows=len(df))['parts'][0]
+
+        csv_times, binary_times = [], []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            loaded = pd.read_csv(csv_path)
+            matrix = np.array([json.loads(v) for v in loaded['embedding']], dtype=np.float32)
+            csv_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            loaded, matrix = trial_store.load_part(corpus_dir, part)
+            float(matrix.sum())  # touch every page so the comparison includes the read
+            binary_times.append(time.perf_counter() - start)
+
+        csv_size = os.path.getsize(csv_path)
+        binary_size = sum(os.path.getsize(os.path.join(corpus_dir, part[k])) for k in ('file', 'embeddings'))
+
+    print_report(f"Corpus load time, {args.rows} trials", [
+        ("CSV + JSON embedding column", summarize(csv_times)),
+        ("Parquet + mmap float32 .npy", summarize(binary_times)),
+    ])
+    print(f"\nSize: CSV {csv_size / 1e6:.1f} MB vs Parquet+npy {binary_size / 1e6:.1f} MB "
+          f"({csv_size / binary_size:.1f}x smaller)")
+
+
+def add_tidb_args(parser):
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4000)
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--database', default='test')
+    parser.add_argument('--ssl-ca', default='', help='CA bundle for TiDB Cloud; empty for a local server')
+
+
+def tidb_pool(args):
+    import db_pool
+
+    config = {'host': args.host, 'port': args.port, 'user': args.user, 'password': args.password,
+              'database': args.database}
+    if args.ssl_ca:
+        config['ssl'] = {'ca': args.ssl_ca}
+    return db_pool.ConnectionPool(config, max_size=2)
+
+
+def uses_vector_index(pool, sql, params):
+    """Return (True if the plan reads TiDB's ANN index, plan rows)."""
+    plan = pool.fetchall("EXPLAIN " + sql, params)
+    return any('annIndex' in str(cell) for row in plan for cell in row), plan
+
+
+def bench_vector_query(args):
+    """EXPLAIN check and latency of the eligibility-column query vs the old sex = / age LIKE query."""
+    import embedding_service
+    import trial_search
+
+    pool = tidb_pool(args)
+    count = pool.fetchall("SELECT COUNT(*) FROM clinical_trials_latest")[0][0]
+    print(f"clinical_trials_latest holds {count} trials")
+
+    queries = [json.dumps(embedding_service.encode_query(q)) for q in SAMPLE_QUERIES]
+    new_params = trial_search.search_params(queries[0], args.age_group, args.sex, 5, 0.5, 50)
+    old_params = trial_search.legacy_search_params(queries[0], args.age_group, args.sex, 5, 0.5)
+
+    new_ann, new_plan = uses_vector_index(pool, trial_search.SEARCH_SQL, new_params)
+    old_ann, _ = uses_vector_index(pool, trial_search.LEGACY_SEARCH_SQL, old_params)
+    print("\nEXPLAIN, eligibility-column query:")
+    for row in new_plan:
+        print('  ' + '  '.join(str(cell) for cell in row))
+    print(f"\nVector index used: new query {'yes' if new_ann else 'NO'}, legacy query {'yes' if old_ann else 'no'}")
+
+    old_times, new_times = [], []
+    for i in range(args.runs):
+        q = queries[i % len(queries)]
+        start = time.perf_counter()
+        pool.fetchall(trial_search.LEGACY_SEARCH_SQL, trial_search.legacy_search_params(q, args.age_group, args.sex, 5, 0.5))
+        old_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        trial_search.search_tidb(pool, json.loads(q), args.age_group, args.sex)
+        new_times.append(time.perf_counter() - start)
+
+    print_report(f"Search latency ({args.age_group}/{args.sex})", [
+        ("legacy: sex = / age LIKE '%..%'", summarize(old_times)),
+        ("vector top-k + eligibility filter", summarize(new_times)),
+    ])
+    pool.close()
+
+
+def bench_backends(args):
+    """Latency and recall@k of the local exact scan, the local IVF index and (optionally) TiDB."""
+    import numpy as np
+    import trial_search
+
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus_dir = args.corpus
+        if corpus_dir is None:
+            df, embeddings = synthetic_corpus(args.synthetic)
+            corpus_dir = os.path.join(tmp, 'corpus')
+            write_corpus(corpus_dir, df, embeddings)
+            print(f"Built a synthetic corpus of {args.synthetic} trials")
+
+        start = time.perf_counter()
+        local = trial_search.LocalSearchBackend(corpus_dir)
+        load_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        local.build_ivf(args.nlist)
+        local.nprobe = args.nprobe
+        ivf_seconds = time.perf_counter() - start
+        print(f"Loaded {len(local)} trials in {load_seconds:.2f}s; IVF with {len(local.centroids)} lists "
+              f"ready in {ivf_seconds:.2f}s (nprobe {args.nprobe})")
+
+        # Queries near real trials: a stored embedding plus noise
+        rng = np.random.default_rng(1)
+        queries = []
+        for _ in range(args.queries):
+            global_id = int(rng.integers(len(local)))
+            part = int(np.searchsorted(local.offsets, global_id, side='right') - 1)
+            vector = np.asarray(local.embeddings[part][global_id - local.offsets[part]])
+            queries.append((vector + 0.3 * vector.std() * rng.standard_normal(vector.shape)).tolist())
+
+        cases = [('local exact', lambda q: local.search(q, args.age_group, args.sex, args.k, args.max_distance, exact=True)),
+                 ('local IVF', lambda q: local.search(q, args.age_group, args.sex, args.k, args.max_distance, exact=False))]
+        if args.tidb:
+            tidb = trial_search.TiDBSearchBackend(tidb_pool(args))
+            cases.append(('TiDB', lambda q: tidb.search(q, args.age_group, args.sex, args.k, args.max_distance)))
+
+        truth = None
+        rows = []
+        recalls = {}
+        for label, search in cases:
+            times, found = [], []
+            for q in queries:
+                start = time.perf_counter()
+                found.append({row[0] for row in search(q)})
+                times.append(time.perf_counter() - start)
+            if truth is None:
+                truth = found
+            recalls[label] = statistics.fmean(len(f & t) / len(t) if t else 1.0 for f, t in zip(found, truth))
+            rows.append((label, summarize(times)))
+
+    print_report(f"Search latency, k={args.k}, {args.age_group}/{args.sex}", rows)
+    print("\nRecall@k vs local exact: " + ', '.join(f"{label} {recall:.3f}" for label, recall in recalls.items()))
+
+
+def bench_result_cache(args):
+    """Exact and semantic hit latency of the app's result cache when it is full."""
+    import numpy as np
+    import result_cache
+
+    rng = np.random.default_rng(0)
+    cache = result_cache.ResultCache(max_entries=args.entries, semantic_distance=args.semantic_distance)
+    stored = []
+    for i in range(args.entries):
+        vector = rng.standard_normal(384).astype(np.float32)
+        query = f"{SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)]} {i}"
+        cache.put(query, 'ADULT', 'ALL', vector, {'results': [], 'explanation': query})
+        stored.append((query, vector))
+
+    exact, semantic = [], []
+    for i in range(args.runs):
+        query, vector = stored[int(rng.integers(len(stored)))]
+        start = time.perf_counter()
+        assert cache.lookup_exact(query.upper() + ',', 'ADULT', 'ALL') is not None
+        exact.append(time.perf_counter() - start)
+        nearby = (vector + 0.01 * rng.standard_normal(384)).tolist()
+        start = time.perf_counter()
+        cache.lookup_exact('unseen query', 'ADULT', 'ALL')
+        assert cache.lookup_similar(nearby, 'ADULT', 'ALL') is not None
+        semantic.append(time.perf_counter() - start)
+
+    print_report(f"Result cache hits, {args.entries} entries",
+                 [('exact (normalised text)', summarize(exact)), ('semantic (embedding)', summarize(semantic))])
+    print(f"\nMetrics: {json.dumps(cache.metrics())}")
+
+
+class _APIStandInHandler(BaseHTTPRequestHandler):
+    """Canned PubMed / RxNorm / MeSH / OpenFDA / Nominatim responses under /pubmed, /rxnav, /mesh, /openfda and /nominatim."""
+    protocol_version = 'HTTP/1.1'  # keep-alive, so pooled clients reuse connections
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.record('connections')
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        number = self.server.record(url.path)
+        time.sleep(self.server.latency + self.server.slow.get('/' + url.path.split('/')[1], 0))
+        if self.server.fail_every and number % self.server.fail_every == 0:
+            self._send(503, {'error': 'try again'})
+            return
+        if url.path == '/pubmed/esearch.fcgi':
+            retmax = int(params.get('retmax', ['5'])[0])
+            body = {'esearchresult': {'idlist': [str(30000000 + i) for i in range(retmax)]}}
+        elif url.path == '/pubmed/esummary.fcgi':
+            ids = params['id'][0].split(',')
+            body = {'result': dict({'uids': ids}, **{i: {'title': f'Trial outcomes in diabetes, article {i}'} for i in ids})}
+        elif url.path == '/rxnav/rxcui.json':
+            body = {'idGroup': {'rxnormId': ['6809']}}
+        elif url.path.startswith('/rxnav/rxcui/'):
+            body = {'properties': {'rxcui': '6809', 'name': 'metformin', 'tty': 'IN'}}
+        elif url.path == '/mesh':
+            body = {'results': {'bindings': [{'mesh': {'value': 'http://id.nlm.nih.gov/mesh/D003924'},
+                                              'label': {'value': 'Diabetes Mellitus, Type 2'}}]}}
+        elif url.path == '/nominatim':
+            body = [{'lat': '42.3601', 'lon': '-71.0589', 'display_name': 'Boston, Massachusetts'}]
+        elif url.path == '/openfda':
+            body = {'meta': {'results': {'total': 2}},
+                    'results': [{'patient': {'reaction': [{'reactionmeddrapt': 'NAUSEA'}, {'reactionmeddrapt': 'DIARRHOEA'}]}}] * 2}
+        else:
+            self._send(404, {'error': 'unknown path'})
+            return
+        self._send(200, body)
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class APIStandIn(ThreadingHTTPServer):
+    """Local HTTP stand-in for the enrichment APIs that counts requests and connections."""
+    daemon_threads = True
+
+    def __init__(self, latency=0.05, fail_every=0, slow=None):
+        super().__init__(('127.0.0.1', 0), _APIStandInHandler)
+        self.latency = latency
+        self.fail_every = fail_every
+        self.slow = slow or {}  # extra seconds per path prefix, e.g. {'/mesh': 6}
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def handle_error(self, request, client_address):
+        pass  # clients that time out hang up mid-response; that is the point of the slow paths
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def record(self, name):
+        with self._lock:
+            self.counts[name] += 1
+            if name != 'connections':
+                self.counts['requests'] += 1
+            return self.counts['requests']
+
+    def point_api_tools_here(self):
+        import api_tools
+        api_tools.PUBMED_URL = f"{self.url}/pubmed"
+        api_tools.RXNAV_URL = f"{self.url}/rxnav"
+        api_tools.MESH_URL = f"{self.url}/mesh"
+        api_tools.OPENFDA_URL = f"{self.url}/openfda"
+
+
+def legacy_search_pubmed(base_url, query, num_results=5):
+    """The api_tools PubMed path before pooling: bare requests.get and one esummary per ID."""
+    import requests
+    ids = requests.get(f"{base_url}/esearch.fcgi", params={'db': 'pubmed', 'term': query, 'retmax': num_results,
+                                                          'retmode': 'json'}, timeout=5).json()['esearchresult']['idlist']
+    return [requests.get(f"{base_url}/esummary.fcgi?db=pubmed&id={id}&retmode=json", timeout=5).json()['result'][id]
+            for id in ids]
+
+
+def legacy_search_rxnorm(base_url, drug_name):
+    import requests
+    rxcui = requests.get(f"{base_url}/rxcui.json", params={'name': drug_name}, timeout=5).json()['idGroup']['rxnormId'][0]
+    return requests.get(f"{base_url}/rxcui/{rxcui}/properties.json", timeout=5).json()
+
+
+def bench_api_tools(args):
+    """HTTP requests, connections and latency per enrichment call against a local API stand-in."""
+    import api_tools
+
+    tmp = tempfile.TemporaryDirectory()
+    # Uncached unless --cache, so every call reaches the stand-in; with it, all but the first call should hit
+    api_tools.API_CACHE_PATH = os.path.join(tmp.name, 'api_cache.sqlite3') if args.cache else None
+    server = APIStandIn(latency=args.latency_ms / 1000, fail_every=args.fail_every)
+    server.point_api_tools_here()
+    for bucket in api_tools._buckets.values():
+        bucket.rate = bucket.burst = 10000  # measure the HTTP path, not the per-source pacing
+    cases = [
+        ('PubMed, per-ID esummary (old)', lambda: legacy_search_pubmed(api_tools.PUBMED_URL, 'diabetes', args.num_results)),
+        ('PubMed, batched + pooled', lambda: api_tools.search_pubmed('diabetes', args.num_results)),
+        ('RxNorm, bare requests (old)', lambda: legacy_search_rxnorm(api_tools.RXNAV_URL, 'metformin')),
+        ('RxNorm, pooled', lambda: api_tools.search_rxnorm('metformin')),
+        ('MeSH, pooled', lambda: api_tools.search_mesh('diabetes')),
+        ('OpenFDA, pooled', lambda: api_tools.search_openfda('metformin')),
+    ]
+    rows, traffic = [], []
+    for label, call in cases:
+        before = dict(server.counts)
+        times, errors = [], 0
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            try:
+                result = call()
+                errors += isinstance(result, dict) and 'error' in result
+            except Exception:
+                errors += 1
+            times.append(time.perf_counter() - start)
+        rows.append((label, summarize(times)))
+        traffic.append((label, (server.counts['requests'] - before.get('requests', 0)) / args.runs,
+                        server.counts['connections'] - before.get('connections', 0), errors))
+    server.shutdown()
+
+    print_report(f"Enrichment calls, {args.latency_ms} ms simulated upstream latency", rows)
+    print(f"\n{'case':<34}{'requests/call':>14}{'connections':>13}{'failed calls':>14}")
+    for label, requests_per_call, connections, errors in traffic:
+        print(f"{label:<34}{requests_per_call:>14.1f}{connections:>13}{errors:>14}")
+    if args.cache:
+        print(f"\nAPI cache: {json.dumps(api_tools.api_cache().metrics())}")
+    tmp.cleanup()
+    if args.fail_every:
+        return  # retries make the request counts vary
+    # Batched PubMed is one esearch + one esummary per uncached call, and all pooled calls share one connection
+    measured = {label: (requests_per_call, connections, errors) for label, requests_per_call, connections, errors in traffic}
+    expected_requests = 2 / args.runs if args.cache else 2
+    problems = [f"{label}: {errors} failed calls" for label, (_, _, errors) in measured.items() if errors]
+    if abs(measured['PubMed, batched + pooled'][0] - expected_requests) > 1e-9:
+        problems.append(f"PubMed, batched + pooled: {measured['PubMed, batched + pooled'][0]:.1f} requests/call, "
+                        f"expected {expected_requests:.1f}")
+    pooled_connections = sum(connections for label, (_, connections, _) in measured.items() if 'pooled' in label)
+    if pooled_connections > 1:
+        problems.append(f"pooled calls opened {pooled_connections} connections, expected 1")
+    if problems:
+        raise SystemExit("Regression: " + "; ".join(problems))
+
+
+def bench_upstreams(args):
+    """Enrichment fan-outs with one upstream hanging: its circuit breaker should make it cost ~0 ms."""
+    import api_tools
+
+    api_tools.API_CACHE_PATH = None
+    api_tools.HTTP_TIMEOUT = args.timeout
+    for breaker in api_tools._breakers.values():
+        breaker.reset_timeout = args.reset
+    server = APIStandIn(latency=args.latency_ms / 1000, slow={f'/{args.slow}': args.timeout * 2})
+    server.point_api_tools_here()
+    queries = [{'api': 'search_pubmed', 'query': 'diabetes'}, {'api': 'search_rxnorm', 'drug_name': 'metformin'},
+               {'api': 'search_mesh', 'term': 'diabetes'}, {'api': 'search_openfda', 'drug_name': 'metformin'}]
+    slow_api = {'pubmed': 'search_pubmed', 'rxnorm': 'search_rxnorm', 'mesh': 'search_mesh', 'openfda': 'search_openfda'}[args.slow]
+
+    print(f"{args.slow} hangs; HTTP timeout {args.timeout}s, breaker opens after {api_tools.BREAKER_FAILURES} failures")
+    print(f"{'round':>5}{'fan-out ms':>12}{f'{args.slow} ms':>12}  {args.slow} breaker")
+    for round_number in range(args.rounds):
+        start = time.perf_counter()
+        slow_ms = None
+        # Generous deadline so the timeouts themselves are visible
+        for query, result, error in api_tools.run_enrichment(queries, 'diabetes', deadline=args.timeout * 4):
+            if query['api'] == slow_api:
+                slow_ms = (time.perf_counter() - start) * 1000
+        total_ms = (time.perf_counter() - start) * 1000
+        print(f"{round_number + 1:>5}{total_ms:>12.1f}{slow_ms:>12.1f}  {api_tools._breakers[args.slow].state}")
+    server.shutdown()
+    print(f"\nUpstreams: {json.dumps(api_tools.upstream_metrics())}")
+
+
+def bench_telemetry(args):
+    """Cost of one telemetry span, outside and inside a request trace."""
+    import telemetry
+
+    rows = []
+    for label, tracing in (('span', False), ('span inside trace()', True)):
+        telemetry.reset()
+        times = []
+        with telemetry.trace() if tracing else contextlib.nullcontext():
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                for _ in range(args.spans):
+                    with telemetry.span('bench', stage='noop'):
+                        pass
+                times.append((time.perf_counter() - start) / args.spans)
+        rows.append((label, summarize(times)))
+    print(f"\nPer-span overhead (microseconds, averaged over {args.spans} spans per sample)")
+    for label, s in rows:
+        print(f"{label:<34}p50 {s['p50_ms'] * 1000:.2f} us   p95 {s['p95_ms'] * 1000:.2f} us")
+    start = time.perf_counter()
+    text = telemetry.prometheus_text()
+    print(f"Prometheus export: {len(text.splitlines())} lines in {(time.perf_counter() - start) * 1000:.2f} ms")
+
+
+class _ChatStandInHandler(BaseHTTPRequestHandler):
+    """POST /v1/chat/completions in the OpenAI format, answering after the server's latency.
+
+    Requests offering tools get enrichment tool calls back until tool results are in the
+    conversation; stream=True answers as server-sent events, token_latency apart.
+    """
+    protocol_version = 'HTTP/1.1'
+    tool_calls = [('search_pubmed', {'query': 'type 2 diabetes fatigue', 'num_results': 5}),
+                  ('search_rxnorm', {'drug_name': 'metformin'}),
+                  ('search_mesh', {'term': 'diabetes'}),
+                  ('search_openfda', {'drug_name': 'metformin', 'limit': 5})]
+    answer = ("## Ranking\n1. **Trial A** studies your condition directly.\n2. **Trial B** is a >60% match.\n"
+              "## Explanation\n1. **Trial A** fits because it studies your condition.\n2. **Trial B** is close, with mild side effects.")
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        number = self.server.record('/v1/chat/completions')
+        time.sleep(self.server.latency)
+        wants_tools = request.get('tools') and not any(m['role'] == 'tool' for m in request['messages'])
+        if wants_tools:
+            calls = [{'index': i, 'id': f'call_{number}_{i}', 'type': 'function',
+                      'function': {'name': name, 'arguments': json.dumps(arguments)}}
+                     for i, (name, arguments) in enumerate(self.tool_calls)]
+            message, finish_reason = {'role': 'assistant', 'content': None, 'tool_calls': calls}, 'tool_calls'
+        else:
+            message, finish_reason = {'role': 'assistant', 'content': self.answer}, 'stop'
+        base = {'id': f"chatcmpl-{number}", 'created': int(time.time()), 'model': request['model']}
+        if not request.get('stream'):
+            self._send_json(dict(base, object='chat.completion',
+                                 choices=[{'index': 0, 'message': message, 'finish_reason': finish_reason}]))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        if wants_tools:
+            deltas = [{'role': 'assistant', 'tool_calls': calls}]
+        else:
+            # Roughly one token per word
+            deltas = [{'role': 'assistant', 'content': word} for word in re.findall(r'\S+\s*', self.answer)]
+        for i, delta in enumerate(deltas):
+            if i:
+                time.sleep(self.server.token_latency)
+            self._send_event(dict(base, object='chat.completion.chunk',
+                                  choices=[{'index': 0, 'delta': delta, 'finish_reason': None}]))
+        self._send_event(dict(base, object='chat.completion.chunk',
+                              choices=[{'index': 0, 'delta': {}, 'finish_reason': finish_reason}]))
+        self._send_chunk(b'data: [DONE]\n\n')
+        self._send_chunk(b'')
+
+    def _send_json(self, body):
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_event(self, body):
+        self._send_chunk(f"data: {json.dumps(body)}\n\n".encode())
+
+    def _send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class ChatStandIn(APIStandIn):
+    """Local OpenAI-compatible chat server; point an OpenAI client at .url + '/v1'."""
+
+    def __init__(self, latency=1.0, token_latency=0.02):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), _ChatStandInHandler)
+        self.latency = latency
+        self.token_latency = token_latency
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class LambdaStub:
+    """Stands in for the boto3 Lambda client: invoke() waits `latency` and reports the email as sent.
+
+    With fail_every=N, every Nth invocation reports an SMTP failure instead.
+    """
+
+    def __init__(self, latency=1.0, fail_every=0):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.invocations = 0
+        self._lock = threading.Lock()
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        with self._lock:
+            self.invocations += 1
+            fail = self.fail_every and self.invocations % self.fail_every == 0
+        if InvocationType == 'RequestResponse':
+            time.sleep(self.latency)
+        if fail:
+            body = json.dumps({'statusCode': 500, 'body': 'SMTP connection unexpectedly closed'})
+        else:
+            body = json.dumps({'statusCode': 200 if InvocationType == 'RequestResponse' else 202, 'body': 'Email sent'})
+        return {'StatusCode': 200, 'Payload': io.BytesIO(body.encode())}
+
+
+class _SMTPStandInHandler(socketserver.StreamRequestHandler):
+    """Just enough ESMTP for smtplib: EHLO, AUTH PLAIN, NOOP, MAIL, RCPT, DATA, RSET and QUIT."""
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.record('connections')
+
+    def _reply(self, *lines):
+        self.wfile.write(''.join(f"{line}\r\n" for line in lines).encode())
+
+    def handle(self):
+        time.sleep(self.server.connect_latency)  # TCP and TLS handshakes with the provider
+        self._reply('220 standin ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                self._reply('250-standin', '250-AUTH PLAIN', '250 OK')
+            elif verb == 'AUTH':
+                time.sleep(self.server.login_latency)
+                password = base64.b64decode(command.split()[2]).split(b'\0')[2].decode()
+                self._reply('235 Authenticated' if password == self.server.password else '535 Bad credentials')
+            elif verb in ('NOOP', 'MAIL', 'RCPT', 'RSET'):
+                self._reply('250 OK')
+            elif verb == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                time.sleep(self.server.message_latency)
+                self.server.record('messages')
+                self._reply('250 Queued')
+            elif verb == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('502 Not implemented')
+
+
+class SMTPStandIn(APIStandIn):
+    """In-process SMTP server with provider-like connection, login and per-message latency."""
+
+    def __init__(self, connect_latency=0.1, login_latency=0.1, message_latency=0.05, password='app-password'):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), _SMTPStandInHandler)
+        self.daemon_threads = True
+        self.connect_latency = connect_latency
+        self.login_latency = login_latency
+        self.message_latency = message_latency
+        self.password = password
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class SecretsStub:
+    """Stands in for the boto3 Secrets Manager client."""
+
+    def __init__(self, secrets, latency=0.05):
+        self.secrets = secrets
+        self.latency = latency
+        self.calls = 0
+
+    def get_secret_value(self, SecretId):
+        self.calls += 1
+        time.sleep(self.latency)
+        return {'SecretString': json.dumps(self.secrets)}
+
+
+def near_corpus_embedder(backend, noise=0.3, latency=0.0):
+    """Offline query embedder: a stored trial vector chosen by hashing the text, plus noise, so searches find trials."""
+    import hashlib
+    import numpy as np
+
+    def embed(text):
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], 'little')
+        rng = np.random.default_rng(seed)
+        global_id = int(rng.integers(len(backend)))
+        part = int(np.searchsorted(backend.offsets, global_id, side='right') - 1)
+        vector = np.asarray(backend.embeddings[part][global_id - backend.offsets[part]])
+        if latency:
+            time.sleep(latency)
+        return (vector + noise * vector.std() * rng.standard_normal(vector.shape)).tolist()
+    return embed
+
+
+def bench_e2e(args):
+    """The real match pipeline against local stand-ins for every external service, at a given concurrency."""
+    from concurrent.futures import ThreadPoolExecutor
+    from openai import OpenAI
+    import api_tools
+    import disk_cache
+    import email_jobs
+    import match_pipeline
+    import telemetry
+    import trial_search
+
+    tmp = tempfile.TemporaryDirectory()
+    corpus_dir = args.corpus
+    if corpus_dir is None:
+        df, embeddings = synthetic_corpus(args.synthetic)
+        corpus_dir = os.path.join(tmp.name, 'corpus')
+        write_corpus(corpus_dir, df, embeddings)
+        write_sample_sites(corpus_dir)
+    backend = trial_search.LocalSearchBackend(corpus_dir)
+
+    apis = APIStandIn(latency=args.api_latency_ms / 1000)
+    apis.point_api_tools_here()
+    api_tools.API_CACHE_PATH = os.path.join(tmp.name, 'api_cache.sqlite3') if args.api_cache else None
+    if not args.rate_limits:
+        for bucket in api_tools._buckets.values():
+            bucket.rate = bucket.burst = 10000
+    chat = ChatStandIn(latency=args.llm_latency_ms / 1000, token_latency=args.llm_token_ms / 1000)
+    email = LambdaStub(latency=args.email_latency_ms / 1000, fail_every=args.email_fail_every)
+    # As in the app: searches only enqueue the report, workers invoke the Lambda
+    email_queue = email_jobs.EmailQueue(
+        lambda payload: json.loads(email.invoke(FunctionName='TiDB_hackathon', InvocationType='RequestResponse',
+                                                Payload=payload)['Payload'].read()),
+        backoff=0.1, dead_letter_path=os.path.join(tmp.name, 'email_dead_letter.jsonl'))
+    email_job_ids = []
+    map_sites = []
+
+    if args.real_embedding:
+        import embedding_service
+        embedding_service.get_model()
+        embed = embedding_service.encode_query
+    else:
+        embed = near_corpus_embedder(backend, latency=args.embed_latency_ms / 1000)
+    llm_cache = disk_cache.DiskCache(os.path.join(tmp.name, 'llm_cache.sqlite3')) if args.llm_cache else None
+    pipeline = match_pipeline.MatchPipeline(backend, OpenAI(api_key='offline', base_url=f"{chat.url}/v1", max_retries=0),
+                                            embed=embed, llm_cache=llm_cache)
+
+    def one_request(i):
+        j = i % args.distinct_queries
+        query = f"{SAMPLE_QUERIES[j % len(SAMPLE_QUERIES)]} {j}"
+        start = time.perf_counter()
+        with telemetry.span('request'):
+            match = pipeline.run(query, args.age_group, args.sex, near=args.near)
+            map_sites.append(len(match['map_points']))
+            if args.email_latency_ms >= 0:
+                with telemetry.span('email'):
+                    email_job_ids.append(email_queue.submit(json.dumps({'ranked_results': match['ranked_results']})))
+        return time.perf_counter() - start, len(match['results']), match['prompt_tokens']
+
+    # One untimed request warms connections and imports
+    one_request(0)
+    telemetry.reset()
+    wall = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        outcomes = list(pool.map(one_request, range(args.requests)))
+    wall = time.perf_counter() - wall
+    # Delivery continues after the searches; wait for it so the email_job row is complete
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline and any(
+            email_queue.status(job_id)['state'] not in (email_jobs.SENT, email_jobs.DEAD) for job_id in email_job_ids):
+        time.sleep(0.05)
+
+    stages = telemetry.summary()
+    rows = []
+    for name, label_key in (('pipeline', 'stage'), ('api', 'function'), ('first_token', None), ('email', None), ('email_job', None), ('request', None)):
+        for labels, stats in sorted(stages.get(name, {}).items()):
+            label = dict(labels).get(label_key, name) if label_key else name
+            rows.append((f"{name}:{label}" if label_key else name, stats))
+    overall = summarize([seconds for seconds, _, _ in outcomes])
+    prompt_tokens = {key: statistics.mean(tokens[key] for _, _, tokens in outcomes) for key in ('before', 'after')}
+
+    print(f"\n{args.requests} searches at concurrency {args.concurrency} in {wall:.2f}s "
+          f"({args.requests / wall:.2f} searches/s); {sum(1 for _, n, _ in outcomes if n)} returned trials")
+    print(f"Stand-ins: LLM {args.llm_latency_ms} ms + {args.llm_token_ms} ms/token, APIs {args.api_latency_ms} ms, email {args.email_latency_ms} ms; "
+          f"{chat.counts['requests']} LLM and {apis.counts['requests']} API requests")
+    print(f"Kimi input tokens per search (estimated, all turns): {prompt_tokens['after']:.0f}, "
+          f"{prompt_tokens['before']:.0f} without prompt compaction")
+    print(f"Map: {statistics.mean(map_sites):.1f} trial sites per search from stored coordinates, "
+          f"{apis.counts['/nominatim']} geocoder requests")
+    if email_job_ids:
+        print(f"Email reports: {json.dumps(email_queue.metrics())}")
+    print(f"\n{'stage':<34}{'count':>7}{'errors':>8}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}")
+    for label, stats in rows:
+        print(f"{label:<34}{stats['count']:>7}{stats['errors']:>8}{stats['p50_ms']:>11.1f}{stats['p95_ms']:>11.1f}{stats['p99_ms']:>11.1f}")
+    print(f"{'overall':<34}{overall['n']:>7}{'':>8}{overall['p50_ms']:>11.1f}{overall['p95_ms']:>11.1f}{overall['p99_ms']:>11.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'config': {k: v for k, v in vars(args).items() if k != 'func'}, 'wall_seconds': wall,
+                       'overall': overall, 'prompt_tokens': prompt_tokens, 'stages': {label: stats for label, stats in rows}}, f, indent=2)
+    apis.shutdown()
+    chat.shutdown()
+    tmp.cleanup()
+    if args.max_p95_ms is not None and overall['p95_ms'] > args.max_p95_ms:
+        raise SystemExit(f"Regression: overall p95 {overall['p95_ms']:.1f} ms > {args.max_p95_ms} ms")
+
+
+def sample_report(i, trials=5):
+    """An email event shaped like the ones app.py queues."""
+    return {'to_email': f'patient{i}@example.com', 'user_input': 'diabetes symptoms fatigue', 'age_group': 'ADULT', 'sex': 'ALL',
+            'ranked_results': '1. **NCT00000001** fits best.\n2. **NCT00000002** is a >60% match.',
+            'explanation': '1. **Trial A** studies your condition.\n2. Side effects were mild in 10-20% of people.',
+            'trials': [{'nct_number': f'NCT{n:08d}', 'title': f'Trial {n} of metformin in adults', 'conditions': 'Type 2 Diabetes',
+                        'summary': 'A study of blood sugar control. ' * 8, 'distance': 0.1 + n / 100} for n in range(trials)],
+            'static_map_url': 'https://tile.openstreetmap.de/40.7,-74.0,10/600x300.png'}
+
+
+def bench_geocode(args):
+    """Ingestion-time geocoding of a corpus's sites (cold and cached) and the per-search site lookup that replaces it."""
+    import disk_cache
+    import geocoding
+    import match_pipeline
+    import trial_search
+
+    tmp = tempfile.TemporaryDirectory()
+    corpus_dir = os.path.join(tmp.name, 'corpus')
+    df, embeddings = synthetic_corpus(args.trials)
+    write_corpus(corpus_dir, df, embeddings)
+    apis = APIStandIn(latency=args.latency_ms / 1000)
+    cache = disk_cache.DiskCache(os.path.join(tmp.name, 'geocode_cache.sqlite3'))
+
+    print(f"\nGeocoding {args.trials} trials' sites via a Nominatim stand-in ({args.latency_ms} ms, {args.rate} requests/s)")
+    print(f"{'run':<22}{'sites':>8}{'places':>8}{'requests':>10}{'seconds':>10}")
+    for run in ('cold cache', 'warm cache'):
+        before = apis.counts['/nominatim']
+        batch = geocoding.BatchGeocoder(geocoding.NominatimGeocoder(f"{apis.url}/nominatim", rate=args.rate), cache)
+        start = time.perf_counter()
+        sites = geocoding.write_sites(corpus_dir, batch)
+        seconds = time.perf_counter() - start
+        print(f"{run:<22}{sites:>8}{batch.stats['queries']:>8}{apis.counts['/nominatim'] - before:>10}{seconds:>10.2f}")
+
+    backend = trial_search.LocalSearchBackend(corpus_dir)
+    results = [(f"NCT{i:08d}", 'title', '', '', '', '', 0.1) for i in random.Random(0).sample(range(args.trials), args.k)]
+    before = apis.counts['/nominatim']
+    samples = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        points, _ = match_pipeline.locate_trials(backend, results)
+        samples.append(time.perf_counter() - start)
+    print_report(f"Per-search map points for {args.k} trials ({len(points)} sites)", [
+        ("stored coordinates lookup", summarize(samples)),
+    ])
+    print(f"Geocoder requests during searches: {apis.counts['/nominatim'] - before} "
+          f"(previously one Nominatim call per search, top trial only)")
+
+
+def bench_near(args):
+    """"Near me" search: grid index vs a scan of every site, and search_near vs the exact nearby ranking."""
+    import proximity
+    import trial_search
+
+    tmp = tempfile.TemporaryDirectory()
+    corpus_dir = os.path.join(tmp.name, 'corpus')
+    df, embeddings = synthetic_corpus(args.trials)
+    write_corpus(corpus_dir, df, embeddings)
+    sites = write_spread_sites(corpus_dir, df)
+    backend = trial_search.LocalSearchBackend(corpus_dir, approximate=args.approximate)
+    grid = backend.site_grid
+    embed = near_corpus_embedder(backend)
+    places = [(name.split(',')[0], lat, lng) for name, (lat, lng) in SAMPLE_PLACES.items()][:args.places]
+    places.append(('Reykjavik (sparse)', 64.1466, -21.9426))
+
+    print(f"\n{args.trials} trials, {sites} sites; k={args.k}, {args.runs} queries per case, "
+          f"{'IVF' if args.approximate else 'exact'} search, spatial-first up to {backend.spatial_first_trials} nearby trials")
+    print(f"{'case':<28}{'nearby':>8}{'path':>12}{'grid ms':>10}{'scan ms':>10}{'near ms':>10}{'plain ms':>10}{'exact':>8}")
+    for name, lat, lng in places:
+        for radius_km in args.radius_km:
+            grid_times, scan_times, near_times, plain_times, exact = [], [], [], [], 0
+            for i in range(args.runs):
+                start = time.perf_counter()
+                nearby = grid.near(lat, lng, radius_km)
+                grid_times.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                scanned = proximity.nearest_by_trial(grid.ncts, grid.lats, grid.lngs, lat, lng, radius_km)
+                scan_times.append(time.perf_counter() - start)
+                assert scanned == nearby
+                query = embed(f"{name} {radius_km} {i}")
+                start = time.perf_counter()
+                results, _ = trial_search.search_near(backend, query, args.age_group, args.sex, lat, lng, radius_km, k=args.k)
+                near_times.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                backend.search(query, args.age_group, args.sex, k=args.k)
+                plain_times.append(time.perf_counter() - start)
+                reference = backend.search_among(query, args.age_group, args.sex, list(nearby), args.k)
+                exact += [row[0] for row in results] == [row[0] for row in reference]
+            path = 'over-fetch' if len(nearby) > backend.spatial_first_trials else 'spatial'
+            print(f"{f'{name} {radius_km:g} km':<28}{len(nearby):>8}{path:>12}"
+                  f"{statistics.median(grid_times) * 1000:>10.2f}{statistics.median(scan_times) * 1000:>10.2f}"
+                  f"{statistics.median(near_times) * 1000:>10.2f}{statistics.median(plain_times) * 1000:>10.2f}"
+                  f"{exact:>5}/{args.runs}")
+
+
+def bench_report_render(args):
+    """Email report rendering time at increasing trial counts; per-trial cost should stay flat."""
+    import report_render
+
+    print(f"{'trials':>7}{'ms/report':>12}{'us/trial':>11}{'KB':>8}")
+    for trials in args.trials:
+        report = sample_report(0, trials)
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for _ in range(args.runs):
+                html_body = report_render.render_report(report)
+            times.append((time.perf_counter() - start) / args.runs)
+        best = min(times)
+        print(f"{trials:>7}{best * 1000:>12.3f}{best * 1e6 / trials:>11.2f}{len(html_body) / 1024:>8.1f}")
+
+
+def bench_email_lambda(args):
+    """Per-email cost of lambda.py: fresh secrets and SMTP login per email vs a warm container vs one batch event."""
+    email_lambda = importlib.import_module('lambda')  # 'lambda' is a keyword, so no plain import
+    server = SMTPStandIn(args.connect_ms / 1000, args.login_ms / 1000, args.message_ms / 1000, password='first-password')
+    secrets = SecretsStub({'EMAIL': 'reports@example.com', 'PASSWORD': 'first-password'}, args.secrets_ms / 1000)
+    email_lambda.SMTP_HOST, email_lambda.SMTP_PORT, email_lambda.SMTP_STARTTLS = '127.0.0.1', server.server_address[1], False
+    email_lambda._secrets_client = secrets
+    reports = [sample_report(i, args.trials) for i in range(args.emails)]
+
+    def cold_container():
+        email_lambda.close_smtp()
+        email_lambda._secrets = None
+
+    def run(label, invoke):
+        before_connections, before_secrets = server.counts['connections'], secrets.calls
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # the handler prints its metrics record
+            statuses = invoke()
+        elapsed = time.perf_counter() - start
+        sent = sum(1 for status in statuses if status == 200)
+        rows.append((label, sent, server.counts['connections'] - before_connections, secrets.calls - before_secrets,
+                     elapsed * 1000 / max(1, len(reports))))
+
+    def one_by_one(fresh):
+        statuses = []
+        for report in reports:
+            if fresh:
+                cold_container()
+            statuses.append(email_lambda.lambda_handler(report, None)['statusCode'])
+        return statuses
+
+    def batch():
+        result = email_lambda.lambda_handler({'reports': reports}, None)
+        return [r['statusCode'] for r in result.get('results', [])]
+
+    def rotated():
+        # The password changes while the container still holds the old secrets and connection
+        server.password = secrets.secrets['PASSWORD'] = 'rotated-password'
+        email_lambda.close_smtp()
+        return one_by_one(fresh=False)
+
+    rows = []
+    cold_container()
+    run('fresh secrets + login per email', lambda: one_by_one(fresh=True))
+    cold_container()
+    run('warm container, one event per email', lambda: one_by_one(fresh=False))
+    cold_container()
+    run('warm container, one batch event', batch)
+    run('after a password rotation', rotated)
+    email_lambda.close_smtp()
+    server.shutdown()
+
+    print(f"SMTP stand-in: connect {args.connect_ms} ms, login {args.login_ms} ms, message {args.message_ms} ms; "
+          f"secrets {args.secrets_ms} ms; {args.emails} emails with {args.trials} trials each")
+    print(f"\n{'mode':<40}{'sent':>6}{'connections':>13}{'secrets calls':>15}{'ms/email':>10}")
+    for label, sent, connections, secret_calls, per_email in rows:
+        print(f"{label:<40}{sent:>6}{connections:>13}{secret_calls:>15}{per_email:>10.1f}")
+    # A warm batch should fetch the secrets once and send every email over one SMTP connection
+    label, sent, connections, secret_calls, _ = rows[2]
+    if (sent, connections, secret_calls) != (len(reports), 1, 1):
+        raise SystemExit(f"Regression: {label} sent {sent}/{len(reports)} emails with {connections} connections "
+                         f"and {secret_calls} secrets calls, expected 1 of each")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='report', required=True)
+
+    p = subparsers.add_parser('embedding', help='cold vs warm query embedding latency')
+    p.add_argument('--runs', type=int, default=50, help='warm encodes to time')
+    p.add_argument('--cold-runs', type=int, default=5, help='model loads to time')
+    p.set_defaults(func=bench_embedding)
+
+    p = subparsers.add_parser('storage', help='CSV vs Parquet + .npy corpus size and load time')
+    p.add_argument('--rows', type=int, default=20000)
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_storage)
+
+    p = subparsers.add_parser('vector-query', help='EXPLAIN and latency of the TiDB search query shapes')
+    add_tidb_args(p)
+    p.add_argument('--runs', type=int, default=40)
+    p.add_argument('--age-group', default='ADULT')
+    p.add_argument('--sex', default='FEMALE')
+    p.set_defaults(func=bench_vector_query)
+
+    p = subparsers.add_parser('backends', help='local exact vs IVF (vs TiDB) search latency and recall')
+    p.add_argument('--corpus', help='preprocessed corpus directory; omitted = synthetic corpus')
+    p.add_argument('--synthetic', type=int, default=100000, help='synthetic corpus size')
+    p.add_argument('--queries', type=int, default=100)
+    p.add_argument('--k', type=int, default=5)
+    p.add_argument('--max-distance', type=float, default=0.5)
+    p.add_argument('--age-group', default='ADULT')
+    p.add_argument('--sex', default='ALL')
+    p.add_argument('--nlist', type=int, help='IVF lists (default sqrt(corpus size))')
+    p.add_argument('--nprobe', type=int, default=16)
+    p.add_argument('--tidb', action='store_true', help='also query TiDB (same corpus must be loaded there)')
+    add_tidb_args(p)
+    p.set_defaults(func=bench_backends)
+
+    p = subparsers.add_parser('result-cache', help='exact and semantic hit latency of the result cache')
+    p.add_argument('--entries', type=int, default=256)
+    p.add_argument('--runs', type=int, default=500)
+    p.add_argument('--semantic-distance', type=float, default=0.05)
+    p.set_defaults(func=bench_result_cache)
+
+    p = subparsers.add_parser('api-tools', help='requests, connections and latency of the enrichment API calls')
+    p.add_argument('--runs', type=int, default=20)
+    p.add_argument('--latency-ms', type=float, default=50, help='simulated upstream latency per request')
+    p.add_argument('--num-results', type=int, default=5)
+    p.add_argument('--fail-every', type=int, default=0, help='answer every Nth request with 503 to exercise retries')
+    p.add_argument('--cache', action='store_true', help='enable the persistent API cache (in a temporary file)')
+    p.set_defaults(func=bench_api_tools)
+
+    p = subparsers.add_parser('upstreams', help='enrichment fan-out latency with one hanging upstream (circuit breaker)')
+    p.add_argument('--slow', choices=['pubmed', 'rxnorm', 'mesh', 'openfda'], default='mesh')
+    p.add_argument('--rounds', type=int, default=10)
+    p.add_argument('--timeout', type=float, default=0.5, help='HTTP timeout in seconds (the app uses 5)')
+    p.add_argument('--reset', type=float, default=30, help='seconds before an open breaker is probed')
+    p.add_argument('--latency-ms', type=float, default=50)
+    p.set_defaults(func=bench_upstreams)
+
+    p = subparsers.add_parser('telemetry', help='overhead of a tracing span')
+    p.add_argument('--spans', type=int, default=10000)
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(func=bench_telemetry)
+
+    p = subparsers.add_parser('geocode', help='ingestion-time site geocoding and the per-search stored-coordinate lookup')
+    p.add_argument('--trials', type=int, default=2000)
+    p.add_argument('--rate', type=float, default=20, help='geocoder requests per second (Nominatim allows 1)')
+    p.add_argument('--latency-ms', type=float, default=50)
+    p.add_argument('-k', type=int, default=5, help='trials per search')
+    p.add_argument('--runs', type=int, default=200)
+    p.set_defaults(func=bench_geocode)
+
+    p = subparsers.add_parser('near', help='"near me" search: site grid index and search_near on a synthetic corpus')
+    p.add_argument('--trials', type=int, default=100000)
+    p.add_argument('--places', type=int, default=4, help='sample cities to search around')
+    p.add_argument('--approximate', action='store_true', help='IVF local index, as an indexed backend like TiDB')
+    p.add_argument('--radius-km', type=float, nargs='+', default=[25, 100, 300])
+    p.add_argument('-k', type=int, default=5)
+    p.add_argument('--runs', type=int, default=20)
+    p.add_argument('--age-group', default='ADULT')
+    p.add_argument('--sex', default='ALL')
+    p.set_defaults(func=bench_near)
+
+    p = subparsers.add_parser('report-render', help='email report HTML rendering time at 5, 50 and 500 trials')
+    p.add_argument('--trials', type=int, nargs='+', default=[5, 50, 500])
+    p.add_argument('--runs', type=int, default=200, help='renders per timing')
+    p.add_argument('--repeat', type=int, default=5, help='timings per size; the best is reported')
+    p.set_defaults(func=bench_report_render)
+
+    p = subparsers.add_parser('email-lambda', help='per-email cost of the email Lambda handler against a local SMTP server')
+    p.add_argument('--emails', type=int, default=20)
+    p.add_argument('--trials', type=int, default=5, help='trials per report')
+    p.add_argument('--connect-ms', type=float, default=100, help='SMTP connect and TLS handshake')
+    p.add_argument('--login-ms', type=float, default=100)
+    p.add_argument('--message-ms', type=float, default=30)
+    p.add_argument('--secrets-ms', type=float, default=50, help='Secrets Manager round trip')
+    p.set_defaults(func=bench_email_lambda)
+
+    p = subparsers.add_parser('e2e', help='full match pipeline against local stand-ins, at a given concurrency')
+    p.add_argument('--requests', type=int, default=40)
+    p.add_argument('--concurrency', type=int, default=4)
+    p.add_argument('--distinct-queries', type=int, default=1000, help='queries repeat after this many (for cache runs)')
+    p.add_argument('--corpus', help='preprocessed corpus directory; omitted = synthetic corpus')
+    p.add_argument('--synthetic', type=int, default=20000)
+    p.add_argument('--age-group', default='ADULT')
+    p.add_argument('--sex', default='ALL')
+    p.add_argument('--llm-latency-ms', type=float, default=800, help='per model turn, before the first token')
+    p.add_argument('--llm-token-ms', type=float, default=20, help='between streamed tokens')
+    p.add_argument('--api-latency-ms', type=float, default=150)
+    p.add_argument('--embed-latency-ms', type=float, default=0, help='added to the offline embedder')
+    p.add_argument('--email-latency-ms', type=float, default=1500, help='-1 skips the email step')
+    p.add_argument('--email-fail-every', type=int, default=0, help='fail every Nth email delivery to exercise retries')
+    p.add_argument('--real-embedding', action='store_true', help='use the sentence-transformers model')
+    p.add_argument('--api-cache', action='store_true', help='enable the persistent API cache')
+    p.add_argument('--llm-cache', action='store_true', help='enable the Kimi response cache')
+    p.add_argument('--rate-limits', action='store_true', help='keep the per-upstream rate limits')
+    p.add_argument('--near', type=lambda text: tuple(float(v) for v in text.split(',')),
+                   help="'lat,lng,km': only trials with a site within km (e.g. 42.36,-71.06,100)")
+    p.add_argument('--json', help='write the report here, for comparing runs')
+    p.add_argument('--max-p95-ms', type=float, help='exit non-zero if overall p95 exceeds this')
+    p.set_defaults(func=bench_e2e)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,131 @@
+import argparse
+import os
+import time
+
+import numpy as np
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-import json
 
-df = pd.read_csv("ctg-studies.csv", low_memory=False)
+import embedding_service
+import trial_store
+
+
+def encode_texts(model, texts, batch_size=64, pool=None, progress_every=5000):
+    """Encode texts in length-sorted batches and return float32 vectors in input order.
+
+    Sorting by length keeps each batch's padding to a minimum; when a
+    sentence-transformers multi-process pool is given the sorted stream is fanned out over it.
+    """
+    texts = list(texts)
+    order = np.argsort([len(t) for t in texts], kind='stable')
+    sorted_texts = [texts[i] for i in order]
+    embeddings = np.empty((len(texts), embedding_service.EMBEDDING_DIM), dtype=np.float32)
+
+    start = time.perf_counter()
+    for offset in range(0, len(sorted_texts), progress_every):
+        chunk = sorted_texts[offset:offset + progress_every]
+        if pool is not None:
+            vectors = model.encode_multi_process(chunk, pool, batch_size=batch_size)
+        else:
+            vectors = model.encode(chunk, batch_size=batch_size)
+        embeddings[order[offset:offset + len(chunk)]] = vectors
+        done = offset + len(chunk)
+        elapsed = time.perf_counter() - start
+        print(f"  embedded {done}/{len(texts)} trials ({done / elapsed:.1f} trials/s)")
+    return embeddings
+
+
+def embed_chunk(model, chunk, cache, batch_size, pool):
+    """Embed a chunk, reusing vectors from an earlier corpus for text whose hash is unchanged."""
+    if cache is None:
+        return encode_texts(model, chunk['text_for_embedding'], batch_size, pool)
+    hits, cached = cache.lookup(chunk['content_hash'].tolist())
+    embeddings = np.empty((len(chunk), embedding_service.EMBEDDING_DIM), dtype=np.float32)
+    embeddings[hits] = cached
+    if not hits.all():
+        embeddings[~hits] = encode_texts(model, chunk['text_for_embedding'][~hits], batch_size, pool)
+    print(f"  reused {int(hits.sum())} cached embeddings, encoded {int((~hits).sum())}")
+    return embeddings
+
+
+def clean_chunk(chunk, seen):
+    """Drop duplicates (within the chunk and against earlier chunks) and incomplete trials."""
+    chunk = chunk.drop_duplicates(subset=['NCT Number'])
+    chunk = chunk[~chunk['NCT Number'].isin(seen)]
+    chunk = chunk.dropna(subset=['Conditions', 'Study Status', 'Brief Summary', 'Locations'])
+    return chunk.copy()
+
+
+def load_progress(output_dir, input_path, chunk_size):
+    """Return (manifest, seen NCT numbers), resuming from an earlier run when it matches."""
+    manifest = trial_store.read_manifest(output_dir)
+    source = {'input': os.path.abspath(input_path), 'input_size': os.path.getsize(input_path), 'chunk_size': chunk_size}
+    if manifest is None:
+        return trial_store.new_manifest(**source), set()
+    if {k: manifest.get(k) for k in source} != source:
+        raise ValueError(f"{output_dir} was written from a different export or chunk size; "
+                         "use a fresh --output directory.")
+    seen = set()
+    for part in trial_store.completed_parts(manifest):
+        seen.update(trial_store.read_part_column(output_dir, part, 'NCT Number'))
+    print(f"Resuming: {len(manifest['parts'])} chunks ({len(seen)} trials) already done.")
+    return manifest, seen
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clean a ClinicalTrials.gov export and embed each trial.")
+    parser.add_argument('--input', default='ctg-studies.csv')
+    parser.add_argument('--output', default='preprocessed_trials', help='corpus directory (parts + manifest.json)')
+    parser.add_argument('--chunk-size', type=int, default=20000, help='export rows read per chunk')
+    parser.add_argument('--batch-size', type=int, default=64, help='sentences per forward pass')
+    parser.add_argument('--workers', type=int, default=1, help='encoder processes; 0 uses every CPU core')
+    parser.add_argument('--embedding-cache', help='earlier corpus directory whose embeddings are reused for unchanged text')
+    args = parser.parse_args()
+    workers = args.workers or os.cpu_count()
+
+    os.makedirs(args.output, exist_ok=True)
+    manifest, seen = load_progress(args.output, args.input, args.chunk_size)
+    done_chunks = {p['chunk'] for p in manifest['parts']}
+
+    cache = trial_store.EmbeddingCache(args.embedding_cache) if args.embedding_cache else None
+    if cache is not None:
+        print(f"Loaded {len(cache)} cached embeddings from {args.embedding_cache}/.")
+
+    model = embedding_service.get_model()
+    pool = model.start_multi_process_pool(['cpu'] * workers) if workers > 1 else None
+    reader = pd.read_csv(args.input, usecols=trial_store.EXPORT_COLUMNS, dtype=trial_store.COLUMN_DTYPES,
+                         chunksize=args.chunk_size)
+    total_rows = sum(p['rows'] for p in manifest['parts'])
+    start = time.perf_counter()
+    embedded = 0
+    try:
+        for chunk_index, chunk in enumerate(reader):
+            if chunk_index in done_chunks:
+                continue
+            chunk = clean_chunk(chunk, seen)
+            part = {'chunk': chunk_index, 'file': None, 'rows': 0}
+            if len(chunk):
+                # Generate embeddings on combined text
+                chunk['text_for_embedding'] = chunk['Conditions'] + ' ' + chunk['Brief Summary']
+                chunk['content_hash'] = trial_store.content_hash(chunk['text_for_embedding'])
+                embeddings = embed_chunk(model, chunk, cache, args.batch_size, pool)
+                part = trial_store.write_part(args.output, chunk_index, chunk, embeddings)
+                seen.update(chunk['NCT Number'])
+                embedded += len(chunk)
+
+            manifest['parts'].append(part)
+            trial_store.write_manifest(args.output, manifest)
+            total_rows += len(chunk)
+            elapsed = time.perf_counter() - start
+            print(f"Chunk {chunk_index}: {len(chunk)} trials written "
+                  f"({total_rows} total, {embedded / max(elapsed, 1e-9):.1f} trials/s this run)")
+    finally:
+        if pool is not None:
+            model.stop_multi_process_pool(pool)
 
-df = df.drop_duplicates(subset=['NCT Number'])
-df = df.dropna(subset=['Conditions', 'Study Status', 'Brief Summary', 'Locations'])
+    manifest['complete'] = True
+    trial_store.write_manifest(args.output, manifest)
+    print(f"Preprocessed {total_rows} diverse trials into {args.output}/.")
 
-# Generate embeddings on combined text
-model = SentenceTransformer('all-MiniLM-L6-v2')
-df['text_for_embedding'] = df['Conditions'] + ' ' + df['Brief Summary']
-df['embedding'] = df['text_for_embedding'].apply(lambda x: json.dumps(model.encode(x).tolist()))
 
-df.to_csv('preprocessed_trials.csv', index=False)
-print(f"Preprocessed {len(df)} diverse trials.")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,82 @@
-import pandas as pd
+"""Load the preprocessed trial corpus, and its geocoded sites, into TiDB.
+
+Parts are written by several connections in parallel. --mode sync only upserts
+changed trials and deletes dropped ones. For a local TiDB (`tiup playground`)
+pass --host 127.0.0.1 --port 4000 --ssl-ca ''.
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import mysql.connector
-# import json
-
-df = pd.read_csv('preprocessed_trials.csv')
-
-conn = mysql.connector.connect(
-  host = "",                        # add your connector details here
-  port = 4000,
-  user = ".root",
-  password = "",
-  database = "test",
-  ssl_ca = ".pem",
-  ssl_verify_cert = True,
-  ssl_verify_identity = True
-)
-cursor = conn.cursor()
-
-cursor.execute("""
+import numpy as np
+import pandas as pd
+
+import eligibility
+import geocoding
+import proximity
+import trial_store
+
+DB_CONFIG = {
+    'host': "",                        # add your connector details here
+    'port': 4000,
+    'user': ".root",
+    'password': "",
+    'database': "test",
+    'ssl_ca': ".pem",
+}
+
+# (table column, export column) in insert order; embedding is appended from the .npy matrix
+TABLE_COLUMNS = [
+    ('nct_number', 'NCT Number'),
+    ('study_title', 'Study Title'),
+    ('study_url', 'Study URL'),
+    ('acronym', 'Acronym'),
+    ('study_status', 'Study Status'),
+    ('brief_summary', 'Brief Summary'),
+    ('study_results', 'Study Results'),
+    ('conditions', 'Conditions'),
+    ('interventions', 'Interventions'),
+    ('primary_outcome_measures', 'Primary Outcome Measures'),
+    ('secondary_outcome_measures', 'Secondary Outcome Measures'),
+    ('other_outcome_measures', 'Other Outcome Measures'),
+    ('sponsor', 'Sponsor'),
+    ('collaborators', 'Collaborators'),
+    ('sex', 'Sex'),
+    ('age', 'Age'),
+    ('phases', 'Phases'),
+    ('enrollment', 'Enrollment'),
+    ('funder_type', 'Funder Type'),
+    ('study_type', 'Study Type'),
+    ('study_design', 'Study Design'),
+    ('other_ids', 'Other IDs'),
+    ('start_date', 'Start Date'),
+    ('primary_completion_date', 'Primary Completion Date'),
+    ('completion_date', 'Completion Date'),
+    ('first_posted', 'First Posted'),
+    ('results_first_posted', 'Results First Posted'),
+    ('last_update_posted', 'Last Update Posted'),
+    ('locations', 'Locations'),
+    ('study_documents', 'Study Documents'),
+    ('text_for_embedding', 'text_for_embedding'),
+    ('content_hash', 'content_hash'),
+]
+# Normalised eligibility columns derived from Age / Sex for cheap filtering after the vector top-k
+DERIVED_COLUMNS = [
+    ('age_mask', lambda df: eligibility.age_masks(df['Age'])),
+    ('sex_code', lambda df: eligibility.sex_codes(df['Sex'])),
+]
+INSERT_COLUMNS = [column for column, _ in TABLE_COLUMNS] + [column for column, _ in DERIVED_COLUMNS] + ['embedding']
+# Columns passed through as-is; every other one gets the quote doubling the loader has always applied
+RAW_COLUMNS = {'NCT Number', 'Enrollment', 'Start Date', 'Primary Completion Date', 'Completion Date',
+               'First Posted', 'Results First Posted', 'Last Update Posted', 'content_hash'}
+
+CREATE_TABLE_SQL = """
     CREATE TABLE IF NOT EXISTS clinical_trials_latest (
         nct_number VARCHAR(20) PRIMARY KEY,
         study_title TEXT,
@@ -49,70 +109,365 @@ cursor.execute("""
         locations TEXT,
         study_documents TEXT,
         text_for_embedding TEXT,
+        content_hash CHAR(64),
+        age_mask TINYINT UNSIGNED,  -- CHILD=1 | ADULT=2 | OLDER_ADULT=4
+        sex_code ENUM('ALL', 'MALE', 'FEMALE'),
         embedding VECTOR(384)
     );
-""")
-
-cursor.execute("ALTER TABLE clinical_trials_latest ADD VECTOR INDEX vec_idx ((VEC_COSINE_DISTANCE(embedding))) ADD_COLUMNAR_REPLICA_ON_DEMAND;")
-conn.commit()
-
-# Batch insert
-batch_size = 200
-for i in range(0, len(df), batch_size):
-    batch = df.iloc[i:i + batch_size]
-    values = []
-    for _, row in batch.iterrows():
-        def safe_text(val):
-            return val.replace("'", "''") if pd.notna(val) else None
-        
-        values.append((
-            row['NCT Number'],
-            safe_text(row['Study Title']),
-            safe_text(row['Study URL']),
-            safe_text(row['Acronym']),
-            safe_text(row['Study Status']),
-            safe_text(row['Brief Summary']),
-            safe_text(row['Study Results']),
-            safe_text(row['Conditions']),
-            safe_text(row['Interventions']),
-            safe_text(row['Primary Outcome Measures']),
-            safe_text(row['Secondary Outcome Measures']),
-            safe_text(row['Other Outcome Measures']),
-            safe_text(row['Sponsor']),
-            safe_text(row['Collaborators']),
-            safe_text(row['Sex']),
-            safe_text(row['Age']),
-            safe_text(row['Phases']),
-            row['Enrollment'] if pd.notna(row['Enrollment']) else None,
-            safe_text(row['Funder Type']),
-            safe_text(row['Study Type']),
-            safe_text(row['Study Design']),
-            safe_text(row['Other IDs']),
-            row['Start Date'] if pd.notna(row['Start Date']) else None,
-            row['Primary Completion Date'] if pd.notna(row['Primary Completion Date']) else None,
-            row['Completion Date'] if pd.notna(row['Completion Date']) else None,
-            row['First Posted'] if pd.notna(row['First Posted']) else None,
-            row['Results First Posted'] if pd.notna(row['Results First Posted']) else None,
-            row['Last Update Posted'] if pd.notna(row['Last Update Posted']) else None,
-            safe_text(row['Locations']),
-            safe_text(row['Study Documents']),
-            safe_text(row['text_for_embedding']),
-            row['embedding']
-        ))
-
-    sql = """
-        INSERT IGNORE INTO clinical_trials_latest 
-        (nct_number, study_title, study_url, acronym, study_status, brief_summary, study_results, conditions, interventions, 
-         primary_outcome_measures, secondary_outcome_measures, other_outcome_measures, sponsor, collaborators, sex, age, 
-         phases, enrollment, funder_type, study_type, study_design, other_ids, start_date, primary_completion_date, 
-         completion_date, first_posted, results_first_posted, last_update_posted, locations, study_documents, 
-         text_for_embedding, embedding) 
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    """
-    cursor.executemany(sql, values)
+"""
+# One row per trial site, geocoded at ingestion time (geocoding.py) so searches never call a geocoder
+CREATE_SITES_SQL = """
+    CREATE TABLE IF NOT EXISTS trial_sites (
+        nct_number VARCHAR(20) NOT NULL,
+        site_index SMALLINT UNSIGNED NOT NULL,
+        site TEXT,
+        latitude DOUBLE,
+        longitude DOUBLE,
+        grid_cell INT UNSIGNED,  -- proximity.grid_cells() key, for "near me" range scans
+        PRIMARY KEY (nct_number, site_index),
+        KEY grid_idx (grid_cell)
+    );
+"""
+# One row, rewritten after every load, so searchers can detect new data without scanning the trials
+CREATE_VERSION_SQL = """
+    CREATE TABLE IF NOT EXISTS corpus_version (
+        id TINYINT UNSIGNED PRIMARY KEY,
+        version VARCHAR(64) NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    );
+"""
+SITE_INSERT_COLUMNS = geocoding.SITE_COLUMNS + ['grid_cell']
+# Bring tables created by earlier versions of this script up to date
+MIGRATIONS = [
+    "ALTER TABLE clinical_trials_latest ADD COLUMN IF NOT EXISTS content_hash CHAR(64)",
+    "ALTER TABLE clinical_trials_latest ADD COLUMN IF NOT EXISTS age_mask TINYINT UNSIGNED",
+    "ALTER TABLE clinical_trials_latest ADD COLUMN IF NOT EXISTS sex_code ENUM('ALL', 'MALE', 'FEMALE')",
+    # Same rules as eligibility.py, for rows loaded before the columns existed
+    """UPDATE clinical_trials_latest SET
+        age_mask = IFNULL(NULLIF(
+            (UPPER(age) REGEXP '(^|[^A-Z_])CHILD([^A-Z_]|$)')
+            + 2 * (UPPER(age) REGEXP '(^|[^A-Z_])ADULT([^A-Z_]|$)')
+            + 4 * (UPPER(age) REGEXP '(^|[^A-Z_])OLDER_ADULT([^A-Z_]|$)'), 0), 7),
+        sex_code = CASE WHEN UPPER(TRIM(sex)) IN ('MALE', 'FEMALE') THEN UPPER(TRIM(sex)) ELSE 'ALL' END
+    WHERE age_mask IS NULL OR sex_code IS NULL""",
+    "ALTER TABLE trial_sites ADD COLUMN IF NOT EXISTS grid_cell INT UNSIGNED",
+    "CREATE INDEX IF NOT EXISTS grid_idx ON trial_sites (grid_cell)",
+    # Same key as proximity.grid_cells(), for sites loaded before the column existed
+    f"""UPDATE trial_sites SET
+        grid_cell = LEAST(GREATEST(FLOOR((latitude + 90) / {proximity.CELL_DEGREES}), 0), {proximity.LAT_CELLS - 1})
+            * {proximity.LNG_CELLS} + MOD(FLOOR((longitude + 180) / {proximity.CELL_DEGREES}), {proximity.LNG_CELLS})
+    WHERE grid_cell IS NULL AND latitude IS NOT NULL""",
+]
+
+
+def connect(config, **extra):
+    params = {k: v for k, v in config.items() if k != 'ssl_ca'}
+    if config.get('ssl_ca'):
+        params.update(ssl_ca=config['ssl_ca'], ssl_verify_cert=True, ssl_verify_identity=True)
+    return mysql.connector.connect(**params, **extra)
+
+
+def create_schema(conn, vector_index=True):
+    cursor = conn.cursor()
+    cursor.execute(CREATE_TABLE_SQL)
+    cursor.execute(CREATE_SITES_SQL)
+    cursor.execute(CREATE_VERSION_SQL)
+    for statement in MIGRATIONS:
+        cursor.execute(statement)
+    if vector_index:
+        cursor.execute("SHOW INDEX FROM clinical_trials_latest WHERE Key_name = 'vec_idx'")
+        if not cursor.fetchall():
+            cursor.execute("ALTER TABLE clinical_trials_latest ADD VECTOR INDEX vec_idx ((VEC_COSINE_DISTANCE(embedding))) ADD_COLUMNAR_REPLICA_ON_DEMAND;")
+    conn.commit()
+    cursor.close()
+
+
+def build_columns(df, embeddings):
+    """Return one Python list per INSERT_COLUMNS entry, with NaN mapped to None."""
+    columns = []
+    for _, source in TABLE_COLUMNS:
+        values = df[source]
+        # An entirely empty export column round-trips through Parquet as float NaN, so check the dtype
+        if source not in RAW_COLUMNS and not pd.api.types.is_float_dtype(values):
+            values = values.str.replace("'", "''", regex=False)
+        columns.append(values.astype(object).where(values.notna(), None).tolist())
+    for _, derive in DERIVED_COLUMNS:
+        columns.append(derive(df).tolist())
+    # TiDB takes vectors as '[x, y, ...]' text
+    columns.append([json.dumps(vector) for vector in embeddings.tolist()])
+    return columns
+
+
+def build_rows(df, embeddings):
+    """Row tuples for executemany, built column-wise rather than with iterrows."""
+    return list(zip(*build_columns(df, embeddings)))
+
+
+def tsv_escape(values):
+    """Escape a column for LOAD DATA's default FIELDS ESCAPED BY '\\' format."""
+    out = []
+    for value in values:
+        if value is None:
+            out.append('\\N')
+        elif isinstance(value, str):
+            out.append(value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r'))
+        else:
+            out.append(repr(value))
+    return out
+
+
+def insert_executemany(cursor, df, embeddings):
+    placeholders = ', '.join(['%s'] * len(INSERT_COLUMNS))
+    sql = f"INSERT IGNORE INTO clinical_trials_latest ({', '.join(INSERT_COLUMNS)}) VALUES ({placeholders})"
+    cursor.executemany(sql, build_rows(df, embeddings))
+
+
+def insert_multirow(cursor, df, embeddings):
+    """One INSERT statement carrying every row of the batch."""
+    rows = build_rows(df, embeddings)
+    row_placeholder = '(' + ', '.join(['%s'] * len(INSERT_COLUMNS)) + ')'
+    sql = (f"INSERT IGNORE INTO clinical_trials_latest ({', '.join(INSERT_COLUMNS)}) VALUES "
+           + ', '.join([row_placeholder] * len(rows)))
+    cursor.execute(sql, [value for row in rows for value in row])
+
+
+def upsert_multirow(cursor, df, embeddings):
+    """Multi-row INSERT that overwrites existing trials instead of ignoring them."""
+    rows = build_rows(df, embeddings)
+    row_placeholder = '(' + ', '.join(['%s'] * len(INSERT_COLUMNS)) + ')'
+    updates = ', '.join(f"{column} = VALUES({column})" for column in INSERT_COLUMNS[1:])
+    sql = (f"INSERT INTO clinical_trials_latest ({', '.join(INSERT_COLUMNS)}) VALUES "
+           + ', '.join([row_placeholder] * len(rows))
+           + f" ON DUPLICATE KEY UPDATE {updates}")
+    cursor.execute(sql, [value for row in rows for value in row])
+
+
+def load_infile(cursor, df, embeddings):
+    """Stream the batch through a temporary TSV with LOAD DATA LOCAL INFILE."""
+    columns = [tsv_escape(values) for values in build_columns(df, embeddings)]
+    with tempfile.NamedTemporaryFile('w', suffix='.tsv', delete=False, encoding='utf-8') as f:
+        f.write('\n'.join('\t'.join(row) for row in zip(*columns)))
+        path = f.name
+    try:
+        cursor.execute(
+            f"LOAD DATA LOCAL INFILE %s IGNORE INTO TABLE clinical_trials_latest "
+            f"FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({', '.join(INSERT_COLUMNS)})",
+            (path,)
+        )
+    finally:
+        os.remove(path)
+
+
+LOAD_METHODS = {
+    'executemany': insert_executemany,
+    'multirow': insert_multirow,
+    'infile': load_infile,
+    'upsert': upsert_multirow,
+}
+
+
+class BulkLoader:
+    """Runs batch writes over a fixed number of connections, one per worker thread."""
+
+    def __init__(self, config, method='multirow', workers=4):
+        self.config = config
+        self.load = LOAD_METHODS[method]
+        self.workers = workers
+        self.extra = {'allow_local_infile': True} if method == 'infile' else {}
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = connect(self.config, **self.extra)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def write_batch(self, df, embeddings):
+        conn = self._connection()
+        cursor = conn.cursor()
+        try:
+            self.load(cursor, df, embeddings)
+            conn.commit()
+        finally:
+            cursor.close()
+        return len(df)
+
+    def run(self, parts, batch_size):
+        """Load an iterable of (metadata, embeddings) parts and return (rows, seconds)."""
+        total_rows = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for part_number, (df, embeddings) in enumerate(parts, start=1):
+                futures = [
+                    executor.submit(self.write_batch, df.iloc[i:i + batch_size], embeddings[i:i + batch_size])
+                    for i in range(0, len(df), batch_size)
+                ]
+                for future in as_completed(futures):
+                    total_rows += future.result()
+                elapsed = time.perf_counter() - start
+                print(f"Part {part_number}: {len(df)} rows loaded "
+                      f"({total_rows} total, {total_rows / max(elapsed, 1e-9):.0f} rows/s)")
+        for conn in self._connections:
+            conn.close()
+        return total_rows, time.perf_counter() - start
+
+
+def load_sites(config, corpus_dir, ncts=None, batch_size=500):
+    """Replace the stored sites of ncts (every trial in the sites file when None) with the corpus's geocoded sites."""
+    sites = geocoding.read_sites(corpus_dir)
+    if sites is None:
+        print(f"No {geocoding.SITES_FILE} in {corpus_dir}; run geocoding.py to store trial sites for the map.")
+        return 0
+    if ncts is None:
+        ncts = set(sites['nct_number'])
+    sites = sites[sites['nct_number'].isin(ncts)].copy()
+    located = sites['latitude'].notna() & sites['longitude'].notna()
+    sites['grid_cell'] = None
+    sites.loc[located, 'grid_cell'] = proximity.grid_cells(sites.loc[located, 'latitude'], sites.loc[located, 'longitude'])
+    by_trial = {nct: rows for nct, rows in sites.groupby('nct_number')}
+    conn = connect(config)
+    cursor = conn.cursor()
+    ncts = sorted(ncts)
+    written = 0
+    for i in range(0, len(ncts), batch_size):
+        batch = ncts[i:i + batch_size]
+        cursor.execute(f"DELETE FROM trial_sites WHERE nct_number IN ({', '.join(['%s'] * len(batch))})", batch)
+        rows = [(nct, int(index), site, None if pd.isna(lat) else float(lat), None if pd.isna(lng) else float(lng),
+                 None if cell is None else int(cell))
+                for nct in batch if nct in by_trial
+                for _, index, site, lat, lng, cell in by_trial[nct][SITE_INSERT_COLUMNS].itertuples(index=False)]
+        if rows:
+            cursor.executemany(f"INSERT INTO trial_sites ({', '.join(SITE_INSERT_COLUMNS)}) VALUES (%s, %s, %s, %s, %s, %s)", rows)
+        conn.commit()
+        written += len(rows)
+    cursor.close()
+    conn.close()
+    return written
+
+
+def mark_version(config):
+    """Record a new corpus version; result caches in front of the table drop their entries when it changes."""
+    conn = connect(config)
+    cursor = conn.cursor()
+    cursor.execute("REPLACE INTO corpus_version (id, version) VALUES (1, %s)", (uuid.uuid4().hex,))
     conn.commit()
-    print(f"Inserted batch {i//batch_size + 1} of {len(df)//batch_size + 1}")
+    cursor.close()
+    conn.close()
+
+
+def fetch_existing(conn):
+    """Map nct_number -> (last_update_posted as 'YYYY-MM-DD' or None, content_hash) for stored trials."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT nct_number, last_update_posted, content_hash FROM clinical_trials_latest")
+    existing = {nct: (updated.isoformat() if updated else None, digest) for nct, updated, digest in cursor}
+    cursor.close()
+    return existing
+
+
+def changed_parts(corpus_dir, existing, stats):
+    """Yield each part reduced to new or changed trials that are not withdrawn; fill stats as a side effect."""
+    for df, embeddings in trial_store.iter_parts(corpus_dir):
+        ncts = df['NCT Number'].tolist()
+        updated = pd.to_datetime(df['Last Update Posted'], format='ISO8601', errors='coerce').dt.strftime('%Y-%m-%d')
+        updated = updated.astype(object).where(updated.notna(), None).tolist()
+        withdrawn = (df['Study Status'] == 'WITHDRAWN').to_numpy()
+        is_new = np.array([nct not in existing for nct in ncts], dtype=bool)
+        changed = np.array([existing.get(nct) != (u, h) for nct, u, h in zip(ncts, updated, df['content_hash'])],
+                           dtype=bool)
+
+        stats['seen'].update(ncts)
+        stats['withdrawn'].update(df['NCT Number'][withdrawn])
+        stats['new'] += int((is_new & ~withdrawn).sum())
+        stats['updated'] += int((changed & ~is_new & ~withdrawn).sum())
+        stats['unchanged'] += int((~changed & ~withdrawn).sum())
+
+        keep = changed & ~withdrawn
+        stats['written'].update(df['NCT Number'][keep])
+        if keep.any():
+            yield df[keep], embeddings[keep]
+
+
+def delete_trials(conn, ncts, batch_size=500):
+    cursor = conn.cursor()
+    ncts = sorted(ncts)
+    for i in range(0, len(ncts), batch_size):
+        batch = ncts[i:i + batch_size]
+        cursor.execute(f"DELETE FROM clinical_trials_latest WHERE nct_number IN ({', '.join(['%s'] * len(batch))})", batch)
+        cursor.execute(f"DELETE FROM trial_sites WHERE nct_number IN ({', '.join(['%s'] * len(batch))})", batch)
+        conn.commit()
+    cursor.close()
+
+
+def sync(config, corpus_dir, batch_size, workers):
+    """Bring the table in line with a corpus, writing only the trials that differ."""
+    conn = connect(config)
+    existing = fetch_existing(conn)
+    print(f"{len(existing)} trials already stored.")
+
+    stats = {'seen': set(), 'withdrawn': set(), 'written': set(), 'new': 0, 'updated': 0, 'unchanged': 0}
+    loader = BulkLoader(config, method='upsert', workers=workers)
+    rows, seconds = loader.run(changed_parts(corpus_dir, existing, stats), batch_size)
+
+    # Only a complete export can tell us which trials disappeared
+    stale = stats['withdrawn'] & existing.keys()
+    if trial_store.read_manifest(corpus_dir).get('complete'):
+        stale |= existing.keys() - stats['seen']
+    else:
+        print("Corpus is from an unfinished preprocessing run; only withdrawn trials are deleted.")
+    delete_trials(conn, stale)
+    conn.close()
+    sites = load_sites(config, corpus_dir, stats['written'])
+    if rows or stale or sites:
+        mark_version(config)
+
+    print(f"Sync complete in {seconds:.1f}s: {stats['new']} new, {stats['updated']} updated, "
+          f"{stats['unchanged']} unchanged, {len(stale)} deleted ({rows} rows, {sites} sites written).")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--corpus', default='preprocessed_trials', help='output directory of clean_trials_data.py')
+    parser.add_argument('--mode', choices=['full', 'sync'], default='full',
+                        help='full: load every trial; sync: upsert changed trials and delete withdrawn ones')
+    parser.add_argument('--host', default=DB_CONFIG['host'])
+    parser.add_argument('--port', type=int, default=DB_CONFIG['port'])
+    parser.add_argument('--user', default=DB_CONFIG['user'])
+    parser.add_argument('--password', default=DB_CONFIG['password'])
+    parser.add_argument('--database', default=DB_CONFIG['database'])
+    parser.add_argument('--ssl-ca', default=DB_CONFIG['ssl_ca'], help="CA bundle path; '' for a local server without TLS")
+    parser.add_argument('--method', choices=sorted(LOAD_METHODS), default='multirow', help='write method for --mode full')
+    parser.add_argument('--batch-size', type=int, default=200, help='rows per statement / LOAD DATA file')
+    parser.add_argument('--workers', type=int, default=4, help='parallel writer connections')
+    parser.add_argument('--skip-vector-index', action='store_true', help='do not create the TiFlash vector index')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = {'host': args.host, 'port': args.port, 'user': args.user, 'password': args.password,
+              'database': args.database, 'ssl_ca': args.ssl_ca}
+
+    conn = connect(config)
+    create_schema(conn, vector_index=not args.skip_vector_index)
+    conn.close()
+
+    if args.mode == 'sync':
+        sync(config, args.corpus, args.batch_size, args.workers)
+        return
+
+    loader = BulkLoader(config, method=args.method, workers=args.workers)
+    rows, seconds = loader.run(trial_store.iter_parts(args.corpus), args.batch_size)
+    print(f"Ingestion complete! {rows} rows in {seconds:.1f}s ({rows / max(seconds, 1e-9):.0f} rows/s, "
+          f"{args.method}, {args.workers} workers x {args.batch_size} rows)")
+    sites = load_sites(config, args.corpus)
+    mark_version(config)
+    print(f"{sites} trial sites stored.")
+
 
-cursor.close()
-conn.close()
-print("Ingestion complete!")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
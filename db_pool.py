@@ -0,0 +1,144 @@
+import collections
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import pymysql
+
+# Errors after which a connection is thrown away rather than returned to the pool
+CONNECTION_ERRORS = (pymysql.err.OperationalError, pymysql.err.InterfaceError)
+
+
+class ConnectionPool:
+    """Thread-safe pool of pymysql connections shared by every Streamlit session in the process.
+
+    Idle connections are reused most-recent-first, pinged before reuse once they have sat idle
+    for ping_after_idle seconds, and closed once idle for longer than max_idle.
+    """
+
+    def __init__(self, connect_kwargs, max_size=10, max_idle=300, ping_after_idle=5, acquire_timeout=10):
+        self.connect_kwargs = connect_kwargs
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.ping_after_idle = ping_after_idle
+        self.acquire_timeout = acquire_timeout
+        self._idle = collections.deque()  # (connection, released_at), most recent on the right
+        self._size = 0
+        self._cond = threading.Condition()
+        self._acquire_times = collections.deque(maxlen=1000)
+        self.stats = {'acquired': 0, 'created': 0, 'recycled': 0, 'discarded': 0, 'waited': 0}
+
+    def _recycle_idle(self, now):
+        while self._idle and now - self._idle[0][1] > self.max_idle:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            self.stats['recycled'] += 1
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def acquire(self):
+        """Borrow a live connection, opening one if the pool is below max_size."""
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.acquire_timeout
+        conn = None
+        idle_for = 0
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._recycle_idle(now)
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                    idle_for = now - released_at
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise TimeoutError(f"No TiDB connection free within {self.acquire_timeout}s")
+                self.stats['waited'] += 1
+                self._cond.wait(remaining)
+        try:
+            if conn is None:
+                conn = pymysql.connect(**self.connect_kwargs)
+                self.stats['created'] += 1
+            elif idle_for > self.ping_after_idle:
+                conn.ping(reconnect=True)
+        except Exception:
+            self._forget(conn)
+            raise
+        elapsed = time.perf_counter() - start
+        with self._cond:
+            self.stats['acquired'] += 1
+            self._acquire_times.append(elapsed)
+        return conn
+
+    def _forget(self, conn):
+        with self._cond:
+            self._size -= 1
+            self.stats['discarded'] += 1
+            self._cond.notify()
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def release(self, conn, broken=False):
+        if broken or not conn.open:
+            self._forget(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except CONNECTION_ERRORS:
+            self.release(conn, broken=True)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def fetchall(self, sql, params=None):
+        """Run one query and return all rows, retrying once on a fresh connection if the old one died."""
+        for attempt in range(2):
+            try:
+                with self.connection() as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute(sql, params)
+                        return cursor.fetchall()
+            except CONNECTION_ERRORS as e:
+                if attempt:
+                    raise
+                logging.warning(f"TiDB connection lost ({e}); retrying on a new connection")
+
+    def metrics(self):
+        """Pool size and connection-acquire latency (milliseconds over the last 1000 borrows)."""
+        with self._cond:
+            times = sorted(self._acquire_times)
+            metrics = dict(self.stats, size=self._size, idle=len(self._idle))
+        if times:
+            metrics['acquire_ms_p50'] = times[len(times) // 2] * 1000
+            metrics['acquire_ms_p95'] = times[min(len(times) - 1, int(len(times) * 0.95))] * 1000
+            metrics['acquire_ms_max'] = times[-1] * 1000
+        return metrics
+
+    def close(self):
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                try:
+                    conn.close()
+                except Exception:
+                    pass
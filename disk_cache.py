@@ -0,0 +1,141 @@
+"""SQLite-backed JSON cache shared by every app process on a host.
+
+Entries live in one table keyed on (namespace, key) with a per-entry expiry, so
+each caller picks its own TTL. The database runs in WAL mode, which lets several
+Streamlit workers read while one writes. Once the stored values pass max_bytes,
+the least recently used entries are evicted. Any SQLite error is logged and
+treated as a miss: the cache can never fail a search.
+"""
+import collections
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    negative INTEGER NOT NULL DEFAULT 0,
+    expires_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+)
+"""
+
+
+class DiskCache:
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, touch_interval=60, evict_every=100):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval  # refresh last_used at most this often, to keep hits read-only
+        self.evict_every = evict_every
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.stats = collections.defaultdict(lambda: {'hits': 0, 'negative_hits': 0, 'misses': 0, 'stores': 0})
+        self.evictions = 0
+        self.errors = 0
+        with self._connection() as conn:
+            conn.execute(SCHEMA)
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+
+    def _connection(self):
+        # sqlite3 connections are per thread; the enrichment pool calls in from many threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, namespace, stat):
+        with self._lock:
+            self.stats[namespace][stat] += 1
+
+    def get(self, namespace, key):
+        """(found, value). Expired entries are misses; cached negative results count as negative hits."""
+        now = time.time()
+        try:
+            conn = self._connection()
+            row = conn.execute("SELECT value, expires_at, last_used, negative FROM entries WHERE namespace = ? AND key = ?",
+                               (namespace, key)).fetchone()
+            if row is None or row[1] < now:
+                self._count(namespace, 'misses')
+                return False, None
+            if now - row[2] > self.touch_interval:
+                with conn:
+                    conn.execute("UPDATE entries SET last_used = ? WHERE namespace = ? AND key = ?", (now, namespace, key))
+        except sqlite3.Error as e:
+            self._error(e)
+            self._count(namespace, 'misses')
+            return False, None
+        self._count(namespace, 'negative_hits' if row[3] else 'hits')
+        return True, json.loads(row[0])
+
+    def put(self, namespace, key, value, ttl, negative=False):
+        """Store value for ttl seconds; negative marks a "not found" answer for the hit statistics."""
+        now = time.time()
+        payload = json.dumps(value)
+        try:
+            conn = self._connection()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (namespace, key, payload, len(payload), int(negative), now + ttl, now))
+        except sqlite3.Error as e:
+            self._error(e)
+            return
+        with self._lock:
+            self.stats[namespace]['stores'] += 1
+            self._puts += 1
+            evict = self._puts % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones until the cache is under 90% of max_bytes."""
+        try:
+            conn = self._connection()
+            with conn:
+                removed = conn.execute("DELETE FROM entries WHERE expires_at < ?", (time.time(),)).rowcount
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+                if total > self.max_bytes:
+                    excess = total - int(self.max_bytes * 0.9)
+                    victims = []
+                    for rowid, size in conn.execute("SELECT rowid, size FROM entries ORDER BY last_used"):
+                        victims.append((rowid,))
+                        excess -= size
+                        if excess <= 0:
+                            break
+                    conn.executemany("DELETE FROM entries WHERE rowid = ?", victims)
+                    removed += len(victims)
+        except sqlite3.Error as e:
+            self._error(e)
+            return
+        with self._lock:
+            self.evictions += removed
+
+    def _error(self, e):
+        with self._lock:
+            self.errors += 1
+        logging.warning(f"Disk cache {self.path}: {e}")
+
+    def metrics(self):
+        """Per-namespace hit rates for this process plus the shared store's size."""
+        with self._lock:
+            namespaces = {}
+            for namespace, stats in self.stats.items():
+                lookups = stats['hits'] + stats['negative_hits'] + stats['misses']
+                hit_rate = (stats['hits'] + stats['negative_hits']) / lookups if lookups else 0.0
+                namespaces[namespace] = dict(stats, hit_rate=hit_rate)
+            metrics = {'namespaces': namespaces, 'evictions': self.evictions, 'errors': self.errors}
+        try:
+            entries, size = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            metrics.update(entries=entries, bytes=size)
+        except sqlite3.Error as e:
+            self._error(e)
+        return metrics
@@ -0,0 +1,36 @@
+"""Structured eligibility columns derived from the export's free-text Sex and Age fields.
+
+age_mask is a bitmask of the age groups a trial accepts and sex_code is one of
+SEX_CODES, where 'ALL' means the trial takes every sex. A blank field in the
+export means the trial does not restrict on it.
+"""
+AGE_GROUP_BITS = {'CHILD': 1, 'ADULT': 2, 'OLDER_ADULT': 4}
+ANY_AGE = 7
+SEX_CODES = ('ALL', 'MALE', 'FEMALE')
+
+# ADULT must not match inside OLDER_ADULT
+_AGE_PATTERNS = {group: rf'(?<![A-Z_]){group}(?![A-Z_])' for group in AGE_GROUP_BITS}
+
+
+def age_masks(ages):
+    """Vectorised age_mask for a pandas Series of export Age values."""
+    upper = ages.fillna('').str.upper()
+    mask = sum(upper.str.contains(pattern, regex=True).astype('int64') * AGE_GROUP_BITS[group]
+               for group, pattern in _AGE_PATTERNS.items())
+    return mask.where(mask != 0, ANY_AGE)
+
+
+def sex_codes(sexes):
+    """Vectorised sex_code for a pandas Series of export Sex values."""
+    upper = sexes.fillna('').str.strip().str.upper()
+    return upper.where(upper.isin(['MALE', 'FEMALE']), 'ALL')
+
+
+def patient_age_mask(age_group):
+    """Bits a trial's age_mask must share with a patient in age_group ('ALL' accepts any trial)."""
+    return ANY_AGE if age_group == 'ALL' else AGE_GROUP_BITS[age_group]
+
+
+def accepted_sex_codes(sex):
+    """sex_code values open to a patient of this sex; trials marked ALL always qualify."""
+    return SEX_CODES if sex == 'ALL' else ('ALL', sex)
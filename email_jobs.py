@@ -0,0 +1,113 @@
+"""Email report delivery off the request path.
+
+EmailQueue.submit() records a job and returns its ID immediately. A small pool
+of worker threads hands each job to the send function; in the app, that is a
+RequestResponse invocation of the email Lambda. Failed attempts are retried
+with exponential backoff. After max_attempts the job is marked dead and its
+payload and last error are appended to a JSON-lines dead-letter file, from
+which it can be replayed. status(job_id) lets the UI poll a job while the
+user carries on.
+"""
+import collections
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+
+import telemetry
+
+QUEUED, SENDING, RETRYING, SENT, DEAD = 'queued', 'sending', 'retrying', 'sent', 'dead'
+
+
+class EmailQueue:
+    def __init__(self, send, workers=2, max_attempts=4, backoff=2.0, dead_letter_path=None, max_jobs=1000):
+        self.send = send  # send(payload) -> result dict; raises or returns a non-200 statusCode on failure
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.dead_letter_path = dead_letter_path
+        self.max_jobs = max_jobs  # finished jobs beyond this are forgotten, oldest first
+        self._jobs = collections.OrderedDict()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()
+        for i in range(workers):
+            threading.Thread(target=self._work, daemon=True, name=f'email-{i}').start()
+
+    def submit(self, payload):
+        """Queue one report; returns its job ID without waiting for delivery."""
+        job_id = uuid.uuid4().hex[:12]
+        now = time.time()
+        with self._lock:
+            self._jobs[job_id] = {'job_id': job_id, 'state': QUEUED, 'attempts': 0, 'error': None,
+                                  'submitted_at': now, 'updated_at': now, 'payload': payload}
+            self.stats['submitted'] += 1
+            self._forget_finished()
+        self._queue.put(job_id)
+        return job_id
+
+    def status(self, job_id):
+        """The job's state, attempts, last error and timestamps, or None for an unknown job."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return {k: v for k, v in job.items() if k != 'payload'} if job else None
+
+    def metrics(self):
+        with self._lock:
+            states = collections.Counter(job['state'] for job in self._jobs.values())
+            return dict(self.stats, backlog=self._queue.qsize(), **{f'jobs_{state}': n for state, n in states.items()})
+
+    def _update(self, job_id, **changes):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(changes, updated_at=time.time())
+            return dict(job)
+
+    def _forget_finished(self):
+        # Caller holds the lock
+        excess = len(self._jobs) - self.max_jobs
+        for job_id in [job_id for job_id, job in self._jobs.items() if job['state'] in (SENT, DEAD)][:max(0, excess)]:
+            del self._jobs[job_id]
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                job = self._jobs[job_id]
+                job['state'], job['attempts'] = SENDING, job['attempts'] + 1
+                attempt, payload = job['attempts'], job['payload']
+            try:
+                with telemetry.span('email_job'):
+                    result = self.send(payload)
+                    if not isinstance(result, dict) or result.get('statusCode') != 200:
+                        raise RuntimeError(result.get('body', 'Unknown error') if isinstance(result, dict) else result)
+            except Exception as e:
+                self._failed(job_id, attempt, str(e))
+                continue
+            job = self._update(job_id, state=SENT, error=None, result=result)
+            with self._lock:
+                self.stats['sent'] += 1
+            logging.info(f"Email job {job_id} sent after {attempt} attempt(s) in {job['updated_at'] - job['submitted_at']:.1f}s")
+
+    def _failed(self, job_id, attempt, error):
+        if attempt < self.max_attempts:
+            delay = self.backoff * 2 ** (attempt - 1)
+            self._update(job_id, state=RETRYING, error=error)
+            with self._lock:
+                self.stats['retries'] += 1
+            logging.warning(f"Email job {job_id} attempt {attempt} failed: {error}; retrying in {delay:.1f}s")
+            timer = threading.Timer(delay, self._queue.put, (job_id,))
+            timer.daemon = True
+            timer.start()
+            return
+        job = self._update(job_id, state=DEAD, error=error)
+        with self._lock:
+            self.stats['dead'] += 1
+        logging.error(f"Email job {job_id} failed after {attempt} attempts: {error}")
+        if self.dead_letter_path:
+            try:
+                with self._lock, open(self.dead_letter_path, 'a') as f:
+                    f.write(json.dumps(job, default=str) + '\n')
+            except OSError as e:
+                logging.error(f"Could not write email dead letter {job_id}: {e}")
@@ -0,0 +1,66 @@
+import logging
+import threading
+import time
+
+from sentence_transformers import SentenceTransformer
+
+MODEL_NAME = 'all-MiniLM-L6-v2'
+EMBEDDING_DIM = 384
+
+_model = None
+_load_lock = threading.Lock()
+_encode_lock = threading.Lock()
+_ready = threading.Event()
+_warmup_thread = None
+stats = {'load_seconds': None, 'warmup_seconds': None}
+
+
+def get_model():
+    """Return the process-wide SentenceTransformer, loading it on first use."""
+    global _model
+    if _model is None:
+        with _load_lock:
+            if _model is None:
+                start = time.perf_counter()
+                _model = SentenceTransformer(MODEL_NAME)
+                stats['load_seconds'] = time.perf_counter() - start
+                logging.info(f"Loaded embedding model {MODEL_NAME} in {stats['load_seconds']:.2f}s")
+    return _model
+
+
+def warmup():
+    """Load the model and run one throwaway encode so the first real query is warm."""
+    model = get_model()
+    if not _ready.is_set():
+        start = time.perf_counter()
+        with _encode_lock:
+            model.encode("warmup")
+        stats['warmup_seconds'] = time.perf_counter() - start
+        _ready.set()
+        logging.info(f"Embedding model warm after {stats['warmup_seconds']:.3f}s warmup encode")
+    return stats
+
+
+def start_background_warmup():
+    """Kick off warmup() in a daemon thread; safe to call on every Streamlit rerun."""
+    global _warmup_thread
+    with _load_lock:
+        if _warmup_thread is None:
+            _warmup_thread = threading.Thread(target=warmup, name='embedding-warmup', daemon=True)
+            _warmup_thread.start()
+    return _warmup_thread
+
+
+def is_ready():
+    """True once the model is loaded and has served its warmup encode."""
+    return _ready.is_set()
+
+
+def encode_query(text):
+    """Embed a single query and return it as a list of floats."""
+    model = get_model()
+    with _encode_lock:
+        embedding = model.encode(text)
+    if len(embedding) != EMBEDDING_DIM:
+        raise ValueError("Embedding dimension mismatch.")
+    return embedding.tolist()
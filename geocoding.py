@@ -0,0 +1,228 @@
+"""Trial-site geocoding, done once at ingestion time instead of per search.
+
+The export's Locations field lists a trial's sites separated by '|', each
+written as "Facility, City, State, Zip, Country". split_sites() separates them,
+and site_query() reduces each one to the place part that geocoders resolve
+reliably. BatchGeocoder looks up each unique query once, serving repeats from a
+DiskCache. Not-found answers are cached too, with a shorter TTL, and live
+lookups go through Nominatim no faster than its one-request-per-second policy.
+Gazetteer is a local place table with the same lookup interface, for offline
+runs and benchmarks.
+
+Run `python geocoding.py --corpus preprocessed_trials` after clean_trials_data.py.
+It writes trial_sites.parquet next to the corpus parts, with one row per site
+(nct_number, site_index, site, latitude, longitude). dat_ingestion_to_TiDB.py
+loads that file into the trial_sites table, and the local search backend reads it directly.
+locate_place() resolves the patient's own location for "near me" searches.
+"""
+import argparse
+import csv
+import logging
+import os
+import re
+import time
+
+import pandas as pd
+import requests
+
+import disk_cache
+import proximity
+import trial_store
+import upstream
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+USER_AGENT = 'TrialMatchingDemo/1.0 (your_email@example.com)'  # Replace; Nominatim requires a contact
+NOMINATIM_RATE = 1.0  # requests per second allowed by the public Nominatim usage policy
+SITES_FILE = 'trial_sites.parquet'
+SITE_COLUMNS = ['nct_number', 'site_index', 'site', 'latitude', 'longitude']
+CACHE_NAMESPACE = 'geocode'
+CACHE_TTL = 180 * 24 * 3600  # places do not move
+NEGATIVE_CACHE_TTL = 14 * 24 * 3600
+
+_ZIP = re.compile(r'\d')
+
+
+def split_sites(locations):
+    """The individual sites of an export Locations value, without blanks or repeats."""
+    if not isinstance(locations, str):
+        return []
+    return list(dict.fromkeys(site.strip() for site in locations.split('|') if site.strip()))
+
+
+def site_query(site):
+    """The geocodable part of a site: drops the facility name and any postcode, keeping city, state and country."""
+    parts = [part.strip() for part in site.split(',') if part.strip()]
+    if len(parts) >= 3:
+        parts = parts[1:]
+    return ', '.join(part for part in parts if not _ZIP.search(part)) or site.strip()
+
+
+class Gazetteer:
+    """Place name -> (lat, lng) from a local table; falls back to the coarser trailing parts of a query."""
+
+    def __init__(self, places):
+        self.places = {self._key(name): (float(lat), float(lng)) for name, (lat, lng) in places.items()}
+        self.lookups = 0
+
+    @staticmethod
+    def _key(name):
+        return ', '.join(part.strip().lower() for part in name.split(','))
+
+    @classmethod
+    def from_csv(cls, path):
+        """A CSV with place, latitude, longitude columns."""
+        with open(path, newline='', encoding='utf-8') as f:
+            return cls({row['place']: (row['latitude'], row['longitude']) for row in csv.DictReader(f)})
+
+    def geocode(self, query):
+        self.lookups += 1
+        parts = self._key(query).split(', ')
+        for start in range(len(parts)):
+            point = self.places.get(', '.join(parts[start:]))
+            if point is not None:
+                return point
+        return None
+
+
+class NominatimGeocoder:
+    def __init__(self, url=None, rate=NOMINATIM_RATE, user_agent=USER_AGENT, timeout=10, max_wait=3600):
+        self.url = url or NOMINATIM_URL
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = user_agent
+        self.timeout = timeout
+        # One token, no burst: requests are spaced 1/rate apart however the batch is driven.
+        # Batch ingestion waits as long as it takes; callers on a request path pass a small max_wait.
+        self.bucket = upstream.TokenBucket(rate, burst=1, max_wait=max_wait)
+        self.lookups = 0
+
+    def geocode(self, query):
+        """(lat, lng) of the best match, or None when Nominatim has no match.
+
+        Raises on transport errors, and upstream.RateLimited when no request slot frees up within max_wait.
+        """
+        self.bucket.acquire()
+        self.lookups += 1
+        response = self.session.get(self.url, params={'q': query, 'format': 'json', 'limit': 1}, timeout=self.timeout)
+        response.raise_for_status()
+        matches = response.json()
+        return (float(matches[0]['lat']), float(matches[0]['lon'])) if matches else None
+
+
+class BatchGeocoder:
+    """Geocode many queries, each unique query once, remembering answers in a DiskCache across runs."""
+
+    def __init__(self, geocoder, cache=None):
+        self.geocoder = geocoder
+        self.cache = cache
+        self._seen = {}  # answers from this run, so repeats across parts skip even the cache
+        self.stats = {'queries': 0, 'cached': 0, 'geocoded': 0, 'not_found': 0, 'errors': 0}
+
+    def cached(self, query):
+        """(found, (lat, lng) or None) from the cache; counts the query."""
+        self.stats['queries'] += 1
+        found, point = self.cache.get(CACHE_NAMESPACE, query) if self.cache is not None else (False, None)
+        if found:
+            self.stats['cached'] += 1
+        return found, tuple(point) if point else None
+
+    def store(self, query, point):
+        """Remember a fresh answer, not-found included."""
+        self.stats['geocoded' if point else 'not_found'] += 1
+        if self.cache is not None:
+            self.cache.put(CACHE_NAMESPACE, query, list(point) if point else None,
+                           CACHE_TTL if point else NEGATIVE_CACHE_TTL, negative=point is None)
+
+    def geocode_many(self, queries, progress_every=100):
+        """{query: (lat, lng) or None}; failed lookups are None and are retried on the next run."""
+        results = {}
+        pending = []
+        for query in dict.fromkeys(queries):
+            if query in self._seen:
+                results[query] = self._seen[query]
+                continue
+            found, point = self.cached(query)
+            if found:
+                results[query] = point
+            else:
+                pending.append(query)
+        start = time.perf_counter()
+        for i, query in enumerate(pending, start=1):
+            try:
+                point = self.geocoder.geocode(query)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logging.warning(f"Geocoding {query!r} failed: {e}")
+                results[query] = None
+                continue
+            results[query] = point
+            self.store(query, point)
+            if i % progress_every == 0:
+                print(f"  geocoded {i}/{len(pending)} new places ({i / (time.perf_counter() - start):.1f}/s)")
+        self._seen.update(results)
+        return results
+
+
+def locate_place(text, geocoder, cache=None):
+    """(lat, lng) of a user-entered place or 'lat, lng' pair, or None if it cannot be found.
+
+    Unlike BatchGeocoder.geocode_many, geocoder errors (upstream.RateLimited included) propagate to the caller.
+    """
+    point = proximity.parse_point(text)
+    if point is not None or not (text or '').strip():
+        return point
+    query = ' '.join(text.split())
+    batch = BatchGeocoder(geocoder, cache)
+    found, point = batch.cached(query)
+    if not found:
+        point = geocoder.geocode(query)
+        batch.store(query, point)
+    return point
+
+
+def site_rows(df, geocoder):
+    """trial_sites rows for a frame with 'NCT Number' and 'Locations'; sites that did not geocode keep None coordinates."""
+    sites = [(nct, index, site) for nct, locations in zip(df['NCT Number'], df['Locations'])
+             for index, site in enumerate(split_sites(locations))]
+    points = geocoder.geocode_many(site_query(site) for _, _, site in sites)
+    rows = []
+    for nct, index, site in sites:
+        point = points[site_query(site)]
+        rows.append((nct, index, site, *(point or (None, None))))
+    return pd.DataFrame(rows, columns=SITE_COLUMNS)
+
+
+def write_sites(corpus_dir, geocoder):
+    """Geocode every site of a corpus into <corpus_dir>/trial_sites.parquet; returns the number of sites."""
+    frames = [site_rows(df, geocoder) for df, _ in trial_store.iter_parts(corpus_dir, columns=['NCT Number', 'Locations'])]
+    sites = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=SITE_COLUMNS)
+    path = os.path.join(corpus_dir, SITES_FILE)
+    sites.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+    return len(sites)
+
+
+def read_sites(corpus_dir):
+    """The corpus's geocoded sites, or None if geocoding.py has not been run on it."""
+    path = os.path.join(corpus_dir, SITES_FILE)
+    return pd.read_parquet(path) if os.path.exists(path) else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--corpus', default='preprocessed_trials', help='output directory of clean_trials_data.py')
+    parser.add_argument('--cache', default='geocode_cache.sqlite3', help="geocode cache shared across runs; '' disables it")
+    parser.add_argument('--gazetteer', help='CSV of place, latitude, longitude to use instead of Nominatim')
+    parser.add_argument('--nominatim-url', default=NOMINATIM_URL)
+    args = parser.parse_args()
+
+    geocoder = Gazetteer.from_csv(args.gazetteer) if args.gazetteer else NominatimGeocoder(args.nominatim_url)
+    batch = BatchGeocoder(geocoder, disk_cache.DiskCache(args.cache) if args.cache else None)
+    start = time.perf_counter()
+    sites = write_sites(args.corpus, batch)
+    print(f"{sites} sites written to {os.path.join(args.corpus, SITES_FILE)} in {time.perf_counter() - start:.1f}s; "
+          f"{batch.stats['queries']} unique places: {batch.stats['cached']} cached, {batch.stats['geocoded']} geocoded, "
+          f"{batch.stats['not_found']} not found, {batch.stats['errors']} errors")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+"""The MedMatch search pipeline, independent of Streamlit.
+
+MatchPipeline runs embed -> search -> one Kimi tool-calling conversation ->
+site lookup, with its collaborators passed in so scripts and benchmarks can use
+stand-ins. Each model turn can be cached (llm_cache) under a hash of its
+normalised inputs and PROMPT_VERSION. Progress and answer text are reported
+through the optional on_event and on_token callbacks.
+"""
+import hashlib
+import json
+import logging
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+
+import api_tools
+import prompt_builder
+import proximity
+import result_cache
+import telemetry
+import trial_search
+
+KIMI_MODEL = 'kimi-k2-0905-preview'
+SYSTEM_PROMPT = 'You are Kimi, an AI assistant provided by Moonshot AI.'
+RANKING_HEADING = '## Ranking'
+EXPLANATION_HEADING = '## Explanation'
+MAX_TOOL_ROUNDS = 2  # model turns allowed to request tools before it must answer
+PROMPT_VERSION = 2  # bump when the conversation prompts change, to retire cached answers
+LLM_CACHE_NAMESPACE = 'llm'
+LLM_CACHE_TTL = 24 * 3600
+
+# Function schemas of the enrichment APIs, in the OpenAI tools format
+TOOLS = [
+    {
+        'type': 'function',
+        'function': {
+            'name': 'search_pubmed',
+            'description': 'Search PubMed for articles on a query.',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'query': {'type': 'string', 'description': 'Search query.'},
+                    'num_results': {'type': 'integer', 'description': 'Number of results.', 'default': 5}
+                },
+                'required': ['query']
+            }
+        }
+    },
+    {
+        'type': 'function',
+        'function': {
+            'name': 'search_rxnorm',
+            'description': 'Map drug to RxNorm codes and therapeutic classes.',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'drug_name': {'type': 'string', 'description': 'Drug name to map.'}
+                },
+                'required': ['drug_name']
+            }
+        }
+    },
+    {
+        'type': 'function',
+        'function': {
+            'name': 'search_mesh',
+            'description': 'Link term to MeSH headings and count matches.',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'term': {'type': 'string', 'description': 'Medical term to search.'}
+                },
+                'required': ['term']
+            }
+        }
+    },
+    {
+        'type': 'function',
+        'function': {
+            'name': 'search_openfda',
+            'description': 'Fetch OpenFDA adverse events and stats for a drug.',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'drug_name': {'type': 'string', 'description': 'Drug name for adverse events.'},
+                    'limit': {'type': 'integer', 'description': 'Number of events.', 'default': 5}
+                },
+                'required': ['drug_name']
+            }
+        }
+    }
+]
+
+
+@dataclass
+class ProgressEvent:
+    stage: str  # embedding, search, llm, enrichment, api, locate
+    status: str  # started, finished, warning or failed
+    message: str
+    duration_ms: float = None
+    counts: dict = field(default_factory=dict)
+
+    def as_dict(self):
+        return asdict(self)
+
+
+def locate_trials(search_backend, results):
+    """Map points for every site of the results that was geocoded at ingestion; returns (points, warning text or None).
+
+    Each point is a dict of nct, title, site, lat and lng, in result order.
+    """
+    try:
+        sites = search_backend.sites([row[0] for row in results])
+    except Exception as e:
+        logging.error(f"Trial site lookup error: {str(e)}")
+        return [], f"Could not map trial locations: {str(e)}"
+    points = [{'nct': row[0], 'title': row[1], 'site': site, 'lat': lat, 'lng': lng}
+              for row in results for site, lat, lng in sites.get(row[0], [])]
+    if not points:
+        return [], "No mapped locations for these trials."
+    return points, None
+
+
+def split_answer(content):
+    """Split Kimi's final answer into (ranking, explanation) at the explanation heading."""
+    ranking, _, explanation = (content or '').partition(EXPLANATION_HEADING)
+    ranking = ranking.replace(RANKING_HEADING, '', 1).strip()
+    return ranking or "No ranking provided.", explanation.strip() or "No explanation provided."
+
+
+class MatchPipeline:
+    def __init__(self, search_backend, llm_client, model=KIMI_MODEL, embed=None,
+                 enrich=api_tools.run_enrichment, locate=None, k=5, max_distance=0.5,
+                 max_tool_rounds=MAX_TOOL_ROUNDS, llm_cache=None, llm_cache_ttl=LLM_CACHE_TTL):
+        self.search_backend = search_backend
+        self.llm_client = llm_client
+        self.model = model
+        self.embed_fn = embed
+        self.enrich = enrich
+        self.locate = locate or (lambda results: locate_trials(self.search_backend, results))
+        self.k = k
+        self.max_distance = max_distance
+        self.max_tool_rounds = max_tool_rounds
+        self.llm_cache = llm_cache
+        self.llm_cache_ttl = llm_cache_ttl
+
+    @contextmanager
+    def _stage(self, on_event, stage, message):
+        """Emit started, then finished (or failed) with the duration; the body sets outcome['message'/'counts'/'status']."""
+        on_event(ProgressEvent(stage, 'started', message))
+        outcome = {}
+        start = time.perf_counter()
+        try:
+            with telemetry.span('pipeline', stage=stage):
+                yield outcome
+        except Exception as e:
+            on_event(ProgressEvent(stage, 'failed', f"⚠ {stage} failed: {e}", (time.perf_counter() - start) * 1000))
+            raise
+        on_event(ProgressEvent(stage, outcome.get('status', 'finished'), outcome.get('message', message),
+                               (time.perf_counter() - start) * 1000, outcome.get('counts', {})))
+
+    def _converse(self, messages, use_tools, on_token):
+        """One streamed model turn; returns (content, tool calls as {id, name, arguments})."""
+        kwargs = {'tools': TOOLS, 'tool_choice': 'auto'} if use_tools else {}
+        stream = self.llm_client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=0.6,
+            stream=True,
+            **kwargs
+        )
+        content, calls = [], {}
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                content.append(delta.content)
+                on_token(delta.content)
+            # Tool calls arrive in fragments keyed by index: id and name once, arguments piecewise
+            for fragment in delta.tool_calls or []:
+                call = calls.setdefault(fragment.index, {'id': '', 'name': '', 'arguments': ''})
+                call['id'] = fragment.id or call['id']
+                if fragment.function is not None:
+                    call['name'] += fragment.function.name or ''
+                    call['arguments'] += fragment.function.arguments or ''
+        return ''.join(content), [calls[index] for index in sorted(calls)]
+
+    def _turn_key(self, user_input, trial_ids, age_group, sex, turn, tool_digests):
+        # The query is in the prompt and the explanation may quote it, so it is part of the key
+        parts = {'query': result_cache.normalise_query(user_input), 'trials': sorted(trial_ids),
+                 'age_group': age_group, 'sex': sex, 'model': self.model,
+                 'prompt_version': PROMPT_VERSION, 'turn': turn, 'tools': sorted(tool_digests)}
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def _run_tools(self, tool_calls, user_input, on_event):
+        """Run the requested tools concurrently, one event per call as it finishes.
+
+        Returns a (tool message, raw result tokens) pair per call.
+        """
+        queries, replies = [], []
+        for call in tool_calls:
+            try:
+                arguments = json.loads(call['arguments'] or '{}')
+            except json.JSONDecodeError as e:
+                reply = {'role': 'tool', 'tool_call_id': call['id'], 'content': json.dumps({'error': f"Invalid arguments: {e}"})}
+                replies.append((reply, prompt_builder.message_tokens(reply)))
+                continue
+            queries.append(dict(arguments, api=call['name'], tool_call_id=call['id']))
+        logging.info(f"Kimi requested tool calls: {json.dumps(queries)}")
+
+        api_names = ', '.join(dict.fromkeys(query['api'] for query in queries)) or 'no APIs'
+        with self._stage(on_event, 'enrichment', f"🌐 Fetching data from {api_names}...") as outcome:
+            start = time.perf_counter()
+            failed = 0
+            for query, result, error in self.enrich(queries, user_input):
+                api_name = query['api']
+                # Kimi gets the distilled facts; the raw result's size is kept for the token report
+                reply = {'role': 'tool', 'tool_call_id': query['tool_call_id'], 'content': prompt_builder.tool_result(api_name, result)}
+                raw_tokens = prompt_builder.message_tokens(dict(reply, content=json.dumps(result)))
+                replies.append((reply, raw_tokens))
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                if error is None:
+                    on_event(ProgressEvent('api', 'finished', f"✅ {api_name} data retrieved!", elapsed_ms, {'api': api_name}))
+                    logging.info(f"API call {api_name}: {json.dumps(result)}")
+                else:
+                    failed += 1
+                    on_event(ProgressEvent('api', 'warning', f"⚠ {api_name} failed: {error}", elapsed_ms, {'api': api_name}))
+                    logging.error(f"API call error for {api_name}: {error}")
+            outcome['counts'] = {'calls': len(queries), 'failed': failed}
+            outcome['message'] = f"🌐 Enrichment finished: {len(queries) - failed}/{len(queries)} API calls succeeded."
+        return replies
+
+    def embed(self, user_input, on_event=None):
+        on_event = on_event or (lambda event: None)
+        if self.embed_fn is None:
+            import embedding_service
+            embed_fn, cold = embedding_service.encode_query, not embedding_service.is_ready()
+        else:
+            embed_fn, cold = self.embed_fn, False
+        with self._stage(on_event, 'embedding', "🧠 Loading AI model..." if cold else "📊 Generating query embedding...") as outcome:
+            query_embedding = embed_fn(user_input)
+            outcome['message'] = "📊 Query embedding ready."
+        logging.info("Generated query embedding.")
+        return query_embedding
+
+    def run(self, user_input, age_group, sex, query_embedding=None, on_event=None, on_token=None, bypass_llm_cache=False,
+            near=None):
+        """Everything the results page and email need for one query.
+
+        Returns a dict of results, ranked_results, explanation, map_points (every
+        geocoded site of the results), map_point (the first of them), map_warning,
+        site_distances and prompt_tokens (estimated Kimi input tokens with and
+        without compaction, as 'after' and 'before'); results is empty (and nothing else is computed) when no trial matches.
+        near=(lat, lng, radius_km) keeps only trials with a site within the radius;
+        site_distances then maps each result's NCT number to its nearest site in km,
+        and map_points are ordered nearest first.
+        on_token receives Kimi's answer text piece by piece as it streams in.
+        bypass_llm_cache asks Kimi again without reading or storing cached turns.
+        """
+        run_start = time.perf_counter()
+        on_event = on_event or (lambda event: None)
+        on_token = on_token or (lambda text: None)
+        if query_embedding is None:
+            query_embedding = self.embed(user_input, on_event)
+
+        with self._stage(on_event, 'search', f"🔍 Searching {self.search_backend.name} database...") as outcome:
+            site_distances = {}
+            if near:
+                # Grid index over trial sites, combined with the vector search (see trial_search.search_near)
+                results, site_distances = trial_search.search_near(self.search_backend, query_embedding, age_group, sex,
+                                                                   *near, k=self.k, max_distance=self.max_distance)
+            else:
+                # Vector index top-k first, then eligibility filtering on the candidates
+                results = self.search_backend.search(query_embedding, age_group, sex, k=self.k, max_distance=self.max_distance)
+            outcome['counts'] = {'trials': len(results)}
+            if results:
+                outcome['message'] = f"✅ Found {len(results)} trials{f' within {near[2]:g} km' if near else ''}!"
+            else:
+                outcome['status'] = 'warning'
+                outcome['message'] = (f'⚠ No matching trials within {near[2]:g} km for "{user_input}". Try a larger radius.' if near
+                                      else f'⚠ No matching trials found for "{user_input}". Try different symptoms.')
+        if not results:
+            return {'results': [], 'ranked_results': '', 'explanation': '', 'map_points': [], 'map_point': None,
+                    'map_warning': None, 'site_distances': {}, 'prompt_tokens': {'before': 0, 'after': 0}}
+
+        # One Kimi conversation: the model calls the enrichment tools it needs, we run them
+        # locally in parallel and send the results back, then it streams ranking and explanation
+        def user_prompt(trials):
+            return (
+                f"Rank these clinical trials for the query '{user_input}' for a {age_group} {sex} patient: {trials}. "
+                "First call the PubMed, RxNorm, MeSH and OpenFDA tools you need, all in the same turn. "
+                f"Then answer with a '{RANKING_HEADING}' section ranking the trials by relevance, incorporating PubMed research, "
+                "RxNorm drug mappings, MeSH terms, and OpenFDA safety data, followed by an "
+                f"'{EXPLANATION_HEADING}' section explaining why the ranked trials match. "
+                "Write the explanation in simple, everyday language that a non-expert patient can understand. Avoid medical jargon (e.g., T2DM, MeSH, RxNorm, OpenFDA) and technical terms (e.g., r = 0.62, cytokine-release). Focus on clear benefits, risks, and why the trial fits their needs. Keep it short and friendly. If matches are poor, say 'No good matches found'"
+            )
+
+        messages = [
+            {'role': 'system', 'content': SYSTEM_PROMPT},
+            {'role': 'user', 'content': user_prompt(prompt_builder.compact_trials(results))}
+        ]
+        # (uncompacted, sent) estimated tokens per message; every turn resends the whole conversation
+        sizes = [(prompt_builder.message_tokens(messages[0]),) * 2,
+                 (prompt_builder.message_tokens(dict(messages[1], content=user_prompt(prompt_builder.raw_trials(results)))),
+                  prompt_builder.message_tokens(messages[1]))]
+        prompt_tokens = {'before': 0, 'after': 0}
+        first_token = []
+
+        def token(text):
+            if not first_token:
+                first_token.append(time.perf_counter())
+                telemetry.observe('first_token', first_token[0] - run_start)
+            on_token(text)
+
+        llm_cache = None if bypass_llm_cache else self.llm_cache
+        trial_ids = [row[0] for row in results]
+        tool_digests = []  # one per tool result, over the call and the distilled content Kimi saw
+        content = ''
+        for turn in range(self.max_tool_rounds + 1):
+            use_tools = turn < self.max_tool_rounds
+            message = "🤖 Contacting Kimi AI for ranking..." if turn == 0 else "🤖 Kimi is writing the ranking and explanation..."
+            key = self._turn_key(user_input, trial_ids, age_group, sex, turn, tool_digests)
+            found, cached = llm_cache.get(LLM_CACHE_NAMESPACE, key) if llm_cache is not None else (False, None)
+            with self._stage(on_event, 'llm', message) as outcome:
+                if found:
+                    content, tool_calls = cached['content'], cached['tool_calls']
+                    if content:
+                        token(content)
+                else:
+                    tools_tokens = prompt_builder.estimate_tokens(json.dumps(TOOLS)) if use_tools else 0
+                    prompt_tokens['before'] += tools_tokens + sum(before for before, _ in sizes)
+                    prompt_tokens['after'] += tools_tokens + sum(after for _, after in sizes)
+                    content, tool_calls = self._converse(messages, use_tools, token)
+                    if llm_cache is not None and (content or tool_calls):
+                        llm_cache.put(LLM_CACHE_NAMESPACE, key, {'content': content, 'tool_calls': tool_calls}, self.llm_cache_ttl)
+                outcome['counts'] = {'turn': turn + 1, 'tool_calls': len(tool_calls), 'cached': found}
+                if found:
+                    outcome['message'] = ("⚡ Reusing Kimi's tool requests from a recent search..." if tool_calls
+                                          else "⚡ Reusing Kimi's ranking and explanation from a recent search!")
+                else:
+                    outcome['message'] = (f"📝 Kimi requested {len(tool_calls)} tool calls..." if tool_calls
+                                          else "🎉 Ranking and explanation ready!")
+            if not tool_calls:
+                break
+            messages.append({'role': 'assistant', 'content': content, 'tool_calls': [
+                {'id': call['id'], 'type': 'function', 'function': {'name': call['name'], 'arguments': call['arguments']}}
+                for call in tool_calls]})
+            sizes.append((prompt_builder.message_tokens(messages[-1]),) * 2)
+            calls = {call['id']: call for call in tool_calls}
+            for reply, raw_tokens in self._run_tools(tool_calls, user_input, on_event):
+                messages.append(reply)
+                sizes.append((raw_tokens, prompt_builder.message_tokens(reply)))
+                call = calls.get(reply['tool_call_id'], {})
+                tool_digests.append(hashlib.sha256(json.dumps(
+                    [call.get('name'), call.get('arguments'), reply['content']]).encode()).hexdigest())
+        logging.info(f"Kimi input tokens (estimated, all turns): {prompt_tokens['after']}, "
+                     f"{prompt_tokens['before']} without compaction")
+
+        ranked_results, explanation = split_answer(content)
+        logging.info(f"Kimi ranked results with API data: {ranked_results}")
+        logging.info(f"Kimi generated explanation: {explanation}")
+
+        with self._stage(on_event, 'locate', "📍 Locating trial sites...") as outcome:
+            map_points, map_warning = self.locate(results)
+            if near:
+                # Closest sites first, so the map and the email centre on the patient's area
+                distances = proximity.haversine_km(near[0], near[1], [p['lat'] for p in map_points], [p['lng'] for p in map_points])
+                map_points = [point for _, point in sorted(zip(distances.tolist(), map_points), key=lambda pair: pair[0])]
+            outcome['counts'] = {'sites': len(map_points), 'trials': len({point['nct'] for point in map_points})}
+            if map_warning:
+                outcome['status'] = 'warning'
+                outcome['message'] = f"⚠ {map_warning}"
+            else:
+                outcome['message'] = f"📍 {len(map_points)} trial sites located."
+        map_point = (map_points[0]['lat'], map_points[0]['lng']) if map_points else None
+
+        return {
+            'results': results,
+            'ranked_results': ranked_results,
+            'explanation': explanation,
+            'map_points': map_points,
+            'map_point': map_point,
+            'map_warning': map_warning,
+            'site_distances': site_distances,
+            'prompt_tokens': prompt_tokens,
+        }
@@ -0,0 +1,115 @@
+"""Compact, token-budgeted payloads for the Kimi conversation.
+
+Kimi only needs a few fields from each trial and a few facts from each
+enrichment call to rank and explain matches. Trials are sent as short records
+with trimmed summaries, and summaries are cut further until the trials fit
+TRIAL_BUDGET_TOKENS. Tool results are distilled to counts, top reactions,
+PubMed titles and MeSH headings instead of the raw API JSON. Token counts are
+estimated at CHARS_PER_TOKEN characters per token, which is close enough for
+budgeting and needs no tokenizer.
+"""
+import collections
+import json
+
+CHARS_PER_TOKEN = 4
+TRIAL_BUDGET_TOKENS = 1200  # all candidate trials together
+TOOL_BUDGET_TOKENS = 200  # each tool result
+SUMMARY_CHARS = (400, 240, 120, 0)  # tried in turn until the trials fit the budget
+FIELD_CHARS = {'title': 160, 'conditions': 120, 'interventions': 120}
+MAX_ITEMS = 5  # titles, headings and reactions per tool result
+
+
+def estimate_tokens(text):
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def message_tokens(message):
+    """Estimated input tokens of one chat message, role and tool-call fields included."""
+    return estimate_tokens(json.dumps(message, ensure_ascii=False))
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def trim(text, limit):
+    """text cut to at most limit characters at a word boundary, with an ellipsis when cut."""
+    text = ' '.join(str(text or '').split())
+    if len(text) <= limit:
+        return text
+    cut = text[:max(0, limit - 1)].rsplit(' ', 1)[0]
+    return cut + '…' if cut else ''
+
+
+def raw_trials(results):
+    """The uncompacted trial payload (full summaries and interventions), kept for token comparisons."""
+    return json.dumps([{
+        'nct_number': row[0],
+        'title': row[1],
+        'conditions': row[2],
+        'summary': row[3],
+        'interventions': row[5],
+        'distance': row[6]
+    } for row in results])
+
+
+def compact_trial(row, summary_chars):
+    record = {'id': row[0]}
+    for field, index in (('title', 1), ('conditions', 2), ('interventions', 5)):
+        value = trim(row[index], FIELD_CHARS[field])
+        if value:
+            record[field] = value
+    if summary_chars:
+        record['summary'] = trim(row[3], summary_chars)
+    record['distance'] = round(float(row[6]), 3)
+    return record
+
+
+def compact_trials(results, budget=TRIAL_BUDGET_TOKENS):
+    """JSON for the search results within budget tokens.
+
+    Summaries are shortened step by step; if even summary-less records do not fit,
+    the most distant trials are left out, always keeping the best match.
+    """
+    for summary_chars in SUMMARY_CHARS:
+        payload = _dumps([compact_trial(row, summary_chars) for row in results])
+        if estimate_tokens(payload) <= budget:
+            return payload
+    records = [compact_trial(row, 0) for row in results]
+    while len(records) > 1 and estimate_tokens(_dumps(records)) > budget:
+        records.pop()
+    return _dumps(records)
+
+
+def distill(api_name, result):
+    """The facts Kimi uses from one enrichment result."""
+    if not isinstance(result, dict) or 'error' in result:
+        return {'error': trim(result.get('error') if isinstance(result, dict) else result, 160)}
+    if api_name == 'search_pubmed':
+        articles = result.get('results', [])
+        return {'articles': len(articles), 'titles': [trim(article.get('title'), 120) for article in articles[:MAX_ITEMS]]}
+    if api_name == 'search_rxnorm':
+        properties = result.get('properties', {})
+        return {'rxcui': result.get('rxcui'), 'name': properties.get('name'), 'type': properties.get('tty'),
+                'therapeutic_classes': result.get('therapeutic_classes_count')}
+    if api_name == 'search_mesh':
+        return {'matches': result.get('match_count', 0),
+                'headings': [term.get('label') for term in result.get('terms', [])[:MAX_ITEMS]]}
+    if api_name == 'search_openfda':
+        reactions = collections.Counter(
+            reaction['reactionmeddrapt'] for event in result.get('events', [])
+            for reaction in event.get('patient', {}).get('reaction', []) if 'reactionmeddrapt' in reaction)
+        return {'reports': len(result.get('events', [])), 'distinct_reactions': result.get('unique_reactions_count', len(reactions)),
+                'top_reactions': [[name, count] for name, count in reactions.most_common(MAX_ITEMS)]}
+    return result
+
+
+def tool_result(api_name, result, budget=TOOL_BUDGET_TOKENS):
+    """JSON of the distilled result within budget tokens, dropping list items from the end if needed."""
+    facts = distill(api_name, result)
+    payload = _dumps(facts)
+    lists = [value for value in facts.values() if isinstance(value, list)] if isinstance(facts, dict) else []
+    while estimate_tokens(payload) > budget and any(lists):
+        max(lists, key=len).pop()
+        payload = _dumps(facts)
+    return payload
@@ -0,0 +1,132 @@
+"""Distances between patients and trial sites, and a grid index over site coordinates.
+
+Sites are bucketed into CELL_DEGREES x CELL_DEGREES cells of latitude and
+longitude. Each cell has an integer key, and within a latitude row the keys are
+consecutive in longitude. A radius query therefore needs only a few key ranges:
+one per latitude row the circle touches, or two where it crosses the
+antimeridian. Only the sites in those ranges are measured. SiteGrid holds the
+keys sorted in memory for the local backend. The trial_sites table stores the
+same key in its indexed grid_cell column, so TiDB answers with range scans.
+"""
+import math
+import re
+
+import numpy as np
+
+CELL_DEGREES = 0.5  # about 55 km of latitude; a 100 km radius touches 5 rows of a few cells each
+LAT_CELLS = int(180 / CELL_DEGREES)
+LNG_CELLS = int(360 / CELL_DEGREES)
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+_POINT = re.compile(r'^\s*(-?\d+(?:\.\d+)?)\s*[,; ]\s*(-?\d+(?:\.\d+)?)\s*$')
+
+
+def parse_point(text):
+    """(lat, lng) from text like '42.36, -71.06', or None if it is not a coordinate pair."""
+    match = _POINT.match(text or '')
+    if not match:
+        return None
+    lat, lng = float(match.group(1)), float(match.group(2))
+    return (lat, lng) if -90 <= lat <= 90 and -180 <= lng <= 180 else None
+
+
+def haversine_km(lat, lng, lats, lngs):
+    """Great-circle distances in km from (lat, lng) to each of lats/lngs."""
+    lat1, lng1 = math.radians(lat), math.radians(lng)
+    lat2, lng2 = np.radians(np.asarray(lats, dtype=np.float64)), np.radians(np.asarray(lngs, dtype=np.float64))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _lat_cell(lats):
+    return np.clip(np.floor((np.asarray(lats, dtype=np.float64) + 90) / CELL_DEGREES), 0, LAT_CELLS - 1).astype(np.int64)
+
+
+def grid_cells(lats, lngs):
+    """Grid cell key of each point: latitude row * LNG_CELLS + longitude column."""
+    columns = np.floor((np.asarray(lngs, dtype=np.float64) + 180) / CELL_DEGREES).astype(np.int64) % LNG_CELLS
+    return _lat_cell(lats) * LNG_CELLS + columns
+
+
+def _extent(lat, lng, radius_km):
+    """(south, north, longitude half-width) in degrees of the box around a circle of radius_km."""
+    delta_lat = radius_km / KM_PER_DEGREE
+    south, north = max(-90.0, lat - delta_lat), min(90.0, lat + delta_lat)
+    # The circle is widest in longitude at its poleward edge
+    widest = math.cos(math.radians(max(abs(south), abs(north))))
+    return south, north, radius_km / (KM_PER_DEGREE * widest) if widest > 1e-9 else 360.0
+
+
+def bounding_box(lat, lng, radius_km):
+    """(south, north, [(west, east), ...]) degrees enclosing the circle; two longitude spans across the antimeridian."""
+    south, north, delta_lng = _extent(lat, lng, radius_km)
+    west, east = lng - delta_lng, lng + delta_lng
+    if north >= 90 or south <= -90 or delta_lng >= 180:
+        spans = [(-180.0, 180.0)]
+    elif west < -180:
+        spans = [(west + 360, 180.0), (-180.0, east)]
+    elif east > 180:
+        spans = [(west, 180.0), (-180.0, east - 360)]
+    else:
+        spans = [(west, east)]
+    return south, north, spans
+
+
+def cell_ranges(lat, lng, radius_km):
+    """Inclusive (first, last) key ranges covering every cell within radius_km of (lat, lng)."""
+    south, north, delta_lng = _extent(lat, lng, radius_km)
+    first = math.floor((lng - delta_lng + 180) / CELL_DEGREES)
+    last = math.floor((lng + delta_lng + 180) / CELL_DEGREES)
+    if north >= 90 or south <= -90 or last - first + 1 >= LNG_CELLS:
+        columns = [(0, LNG_CELLS - 1)]
+    elif first % LNG_CELLS <= last % LNG_CELLS:
+        columns = [(first % LNG_CELLS, last % LNG_CELLS)]
+    else:
+        columns = [(first % LNG_CELLS, LNG_CELLS - 1), (0, last % LNG_CELLS)]
+    ranges = []
+    for row in range(int(_lat_cell(south)), int(_lat_cell(north)) + 1):
+        for start, end in columns:
+            start, end = row * LNG_CELLS + start, row * LNG_CELLS + end
+            if ranges and start == ranges[-1][1] + 1:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+    return ranges
+
+
+def nearest_by_trial(ncts, lats, lngs, lat, lng, radius_km):
+    """{nct_number: km to its nearest site} for the trials with a site within radius_km of (lat, lng)."""
+    ncts = np.asarray(ncts, dtype=object)
+    distances = haversine_km(lat, lng, lats, lngs)
+    keep = np.flatnonzero(distances <= radius_km)
+    # Farthest first, so each trial's entry ends up holding its nearest site
+    keep = keep[np.argsort(-distances[keep], kind='stable')]
+    return dict(zip(ncts[keep].tolist(), distances[keep].tolist()))
+
+
+class SiteGrid:
+    """Site coordinates sorted by grid cell, answering radius queries from a few contiguous slices."""
+
+    def __init__(self, ncts, lats, lngs):
+        lats, lngs = np.asarray(lats, dtype=np.float64), np.asarray(lngs, dtype=np.float64)
+        keys = grid_cells(lats, lngs)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.lats = lats[order]
+        self.lngs = lngs[order]
+        self.ncts = np.asarray(ncts, dtype=object)[order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def candidates(self, lat, lng, radius_km):
+        """Indices of the sites in the cells the circle touches (a superset of the sites within it)."""
+        slices = [np.arange(np.searchsorted(self.keys, first, side='left'), np.searchsorted(self.keys, last, side='right'))
+                  for first, last in cell_ranges(lat, lng, radius_km)]
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+
+    def near(self, lat, lng, radius_km):
+        """{nct_number: km to its nearest site} within radius_km of (lat, lng)."""
+        ids = self.candidates(lat, lng, radius_km)
+        return nearest_by_trial(self.ncts[ids], self.lats[ids], self.lngs[ids], lat, lng, radius_km)
@@ -0,0 +1,218 @@
+"""HTML rendering of the email report, for the email Lambda.
+
+The split page template, the row f-string and the markdown regexes are compiled when
+the module is imported, which happens once per Lambda container. render_report()
+then only substitutes values, with all the rows built in a single join. Trial fields and the patient's
+query are HTML-escaped. Kimi's ranking and explanation are escaped before the
+light markdown conversion, so any HTML in them is shown as text and not injected.
+"""
+import html
+import re
+
+BOLD = re.compile(r'\*\*(.*?)\*\*')
+BULLET = re.compile(r'^- (.*?)(<br>|$)')
+NUMBERED = re.compile(r'(\d+\.\s)(.*?)(<br>|$)')
+FIGURE = re.compile(r'(\d+-\d+%|&gt;\d+%|\d+\.\d+)')  # '>' is already escaped to &gt; here
+
+PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Clinical Trial Matches</title>
+    <link href="https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css" rel="stylesheet">
+    <style>
+        body {
+            font-family: 'Roboto', 'Helvetica Neue', 'Arial', sans-serif;
+            background-color: #f0f4f8;
+            color: #333;
+        }
+        .container {
+            background-color: #ffffff;
+            border-radius: 10px;
+            box-shadow: 0 2px 10px rgba(0, 0, 0, 0.1);
+            overflow: hidden;
+        }
+        .header {
+            background: linear-gradient(90deg, #1e88e5, #4fc3f7);
+            color: white;
+            padding: 20px;
+            text-align: center;
+        }
+        .header h1 {
+            font-size: 28px;
+            font-weight: 700;
+            margin: 0;
+        }
+        .section {
+            padding: 20px;
+            border-bottom: 1px solid #e2e8f0;
+        }
+        .table-row {
+            animation: fadeIn 0.6s ease-in;
+        }
+        @keyframes fadeIn {
+            0% { opacity: 0; transform: translateY(10px); }
+            100% { opacity: 1; transform: translateY(0); }
+        }
+        .table-row:hover {
+            background-color: #e3f2fd;
+            transition: background-color 0.3s ease;
+        }
+        table {
+            border-collapse: collapse;
+            width: 100%;
+        }
+        th, td {
+            border: 1px solid #e2e8f0;
+            padding: 12px;
+            text-align: left;
+        }
+        th {
+            background-color: #1e88e5;
+            color: white;
+            font-weight: 600;
+        }
+        img {
+            max-width: 100%;
+            height: auto;
+            border-radius: 8px;
+        }
+        .button {
+            display: inline-block;
+            padding: 10px 20px;
+            background-color: #4fc3f7;
+            color: white;
+            text-decoration: none;
+            border-radius: 5px;
+            margin-top: 10px;
+            transition: background-color 0.3s ease;
+        }
+        .button:hover {
+            background-color: #039be5;
+        }
+        .footer {
+            background-color: #f8fafc;
+            padding: 15px;
+            text-align: center;
+            font-size: 14px;
+            color: #4a5568;
+        }
+        ul {
+            list-style-type: disc;
+            padding-left: 20px;
+        }
+        .list-decimal {
+            list-style-type: decimal;
+            padding-left: 20px;
+        }
+        @media only screen and (max-width: 600px) {
+            th, td {
+                font-size: 13px;
+                padding: 8px;
+            }
+            .section {
+                padding: 15px;
+            }
+            .header h1 {
+                font-size: 22px;
+            }
+        }
+    </style>
+</head>
+<body class="bg-gray-100">
+    <div class="max-w-4xl mx-auto my-8 container">
+        <div class="header">
+            <h1>Clinical Trial Matches for '$user_input' 🩺</h1>
+        </div>
+        <div class="section">
+            <p class="text-base text-gray-700 mb-4">
+                <strong class="text-blue-700">Age Group:</strong> $age_group | <strong class="text-blue-700">Sex:</strong> $sex
+            </p>
+        </div>
+        <div class="section">
+            <h2 class="text-xl font-semibold text-blue-800 mb-3">Ranked Trials</h2>
+            <p class="text-gray-600 mb-4">$ranked_results</p>
+        </div>
+        <div class="section">
+            <h2 class="text-xl font-semibold text-blue-800 mb-3">Why These Match</h2>
+            <p class="text-gray-600 mb-4">$explanation</p>
+        </div>
+        <div class="section">
+            <h2 class="text-xl font-semibold text-blue-800 mb-3">Trial Locations 📍</h2>
+            $map_image
+            $map_link
+        </div>
+        <div class="section">
+            <h2 class="text-xl font-semibold text-blue-800 mb-3">Matches</h2>
+            <table class="min-w-full bg-white border border-gray-200">
+                <thead>
+                    <tr>
+                        <th class="py-3 px-4">Trial ID</th>
+                        <th class="py-3 px-4">Title</th>
+                        <th class="py-3 px-4">Conditions</th>
+                        <th class="py-3 px-4">Summary</th>
+                        <th class="py-3 px-4">Similarity</th>
+                    </tr>
+                </thead>
+                <tbody>
+$rows
+                </tbody>
+            </table>
+        </div>
+        <div class="footer">
+            <p class="italic"><strong>Note:</strong> This is a demo, not medical advice. Consult a doctor.</p>
+        </div>
+    </div>
+</body>
+</html>
+"""
+# The page as alternating literal text and $placeholder names, split once at import
+_PAGE_PARTS = re.split(r'\$(\w+)', PAGE)
+
+
+def _text(value):
+    # Element content only needs &, < and > escaped
+    return html.escape(str(value if value is not None else ''), quote=False)
+
+
+def _row(trial):
+    # An f-string compiles to a single string build, the fastest per-row template in CPython
+    return f"""                    <tr class="table-row">
+                        <td class="border-gray-200">{_text(trial['nct_number'])}</td>
+                        <td class="border-gray-200">{_text(trial['title'])}</td>
+                        <td class="border-gray-200">{_text(trial['conditions'])}</td>
+                        <td class="border-gray-200">{_text(trial['summary'])}</td>
+                        <td class="border-gray-200">{float(trial['distance']):.4f}</td>
+                    </tr>
+"""
+
+
+def ranking_html(text):
+    text = BOLD.sub(r'<b>\1</b>', html.escape(text or '', quote=False)).replace('\n', '<br>')
+    text = BULLET.sub(r'<li>\1</li>', text)
+    return f'<ul class="list-disc pl-6">{text}</ul>'
+
+
+def explanation_html(text):
+    text = BOLD.sub(r'<b>\1</b>', html.escape(text or '', quote=False)).replace('\n', '<br>')
+    text = FIGURE.sub(r'<span class="text-blue-600">\1</span>', NUMBERED.sub(r'<li>\1\2</li>', text))
+    return f'<ul class="list-decimal pl-6">{text}</ul>'
+
+
+def render_report(report):
+    """The HTML email body for one report (the fields the app sends)."""
+    static_map_url = html.escape(report.get('static_map_url') or '')  # goes into attributes, so quotes too
+    values = dict(
+        user_input=_text(report['user_input']),
+        age_group=_text(report['age_group']),
+        sex=_text(report['sex']),
+        ranked_results=ranking_html(report['ranked_results']),
+        explanation=explanation_html(report['explanation']),
+        map_image=f"<img src='{static_map_url}' alt='Trial Location Map' class='shadow-sm mb-4'>" if static_map_url else "<p>No map available</p>",
+        map_link=f"<a href='{static_map_url}' class='button'>View Map</a>" if static_map_url else "<p>Map unavailable</p>",
+        rows=''.join(map(_row, report['trials'])),
+    )
+    parts = _PAGE_PARTS.copy()
+    parts[1::2] = [values[name] for name in parts[1::2]]
+    return ''.join(parts)
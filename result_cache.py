@@ -0,0 +1,129 @@
+"""In-process cache of finished searches, in front of the app.py match pipeline.
+
+Entries are keyed on the normalised query text plus age group, sex and the
+optional "near me" area. A new query can also be served by a cached one whose
+embedding lies within semantic_distance (cosine) for the same age group, sex
+and area. Entries expire after ttl_seconds. A background thread polls version_fn
+and drops the whole cache when the corpus version changes, so lookups never wait
+on the database.
+"""
+import collections
+import re
+import threading
+import time
+
+import numpy as np
+
+_NON_WORD = re.compile(r'[^0-9a-z]+')
+
+
+def normalise_query(text):
+    """'Diabetes, fatigue ' and 'diabetes fatigue' map to the same key text."""
+    return _NON_WORD.sub(' ', text.lower()).strip()
+
+
+class ResultCache:
+    def __init__(self, max_entries=256, ttl_seconds=6 * 3600, semantic_distance=0.05,
+                 version_fn=None, version_check_seconds=60):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.semantic_distance = semantic_distance
+        self.version_fn = version_fn
+        self.version_check_seconds = version_check_seconds
+        self._entries = collections.OrderedDict()  # key -> (stored_at, unit embedding or None, value)
+        self._lock = threading.Lock()
+        self._version = None
+        self.stats = {'hits': 0, 'semantic_hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'invalidations': 0,
+                      'version_errors': 0}
+        if version_fn is not None:
+            threading.Thread(target=self._watch_version, daemon=True, name='result-cache-version').start()
+
+    @staticmethod
+    def key(query, age_group, sex, near=None):
+        return normalise_query(query), age_group, sex, near
+
+    def check_version(self):
+        """Poll version_fn once, outside the lock, and flush the cache if the version moved."""
+        try:
+            version = self.version_fn()
+        except Exception:
+            with self._lock:
+                self.stats['version_errors'] += 1
+            return
+        with self._lock:
+            if version != self._version:
+                if self._version is not None:
+                    self._entries.clear()
+                    self.stats['invalidations'] += 1
+                self._version = version
+
+    def _watch_version(self):
+        while True:
+            self.check_version()
+            time.sleep(self.version_check_seconds)
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if now - entry[0] > self.ttl_seconds:
+            del self._entries[key]
+            self.stats['expired'] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def lookup_exact(self, query, age_group, sex, near=None):
+        """Cached value for this exact (normalised) query, or None. Misses are counted by lookup_similar."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(self.key(query, age_group, sex, near), now)
+            if entry is None:
+                return None
+            self.stats['hits'] += 1
+            return entry[2]
+
+    def lookup_similar(self, embedding, age_group, sex, near=None):
+        """Cached value of the nearest earlier query within semantic_distance, or None (a miss)."""
+        now = time.monotonic()
+        with self._lock:
+            if self.semantic_distance:
+                candidates = [(key, entry[1]) for key, entry in self._entries.items()
+                              if key[1:] == (age_group, sex, near) and entry[1] is not None
+                              and now - entry[0] <= self.ttl_seconds]
+                if candidates:
+                    query = np.asarray(embedding, dtype=np.float32)
+                    query = query / max(np.linalg.norm(query), 1e-12)
+                    distances = 1.0 - np.stack([vector for _, vector in candidates]) @ query
+                    best = int(np.argmin(distances))
+                    if distances[best] <= self.semantic_distance:
+                        key = candidates[best][0]
+                        self._entries.move_to_end(key)
+                        self.stats['semantic_hits'] += 1
+                        return self._entries[key][2]
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, query, age_group, sex, embedding, value, near=None):
+        vector = None
+        if embedding is not None:
+            vector = np.asarray(embedding, dtype=np.float32)
+            vector = vector / max(np.linalg.norm(vector), 1e-12)
+        with self._lock:
+            key = self.key(query, age_group, sex, near)
+            self._entries[key] = (time.monotonic(), vector, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.stats['invalidations'] += 1
+
+    def metrics(self):
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['semantic_hits'] + self.stats['misses']
+            hit_rate = (self.stats['hits'] + self.stats['semantic_hits']) / lookups if lookups else 0.0
+            return dict(self.stats, entries=len(self._entries), hit_rate=hit_rate)
@@ -0,0 +1,243 @@
+"""Lightweight in-process tracing: timed spans aggregated into latency histograms.
+
+span(name, **labels) times a block. Every span feeds a per-(name, labels)
+series with Prometheus histogram buckets, an error counter and a window of
+recent samples for p50/p95/p99. Inside a trace() block the span is also
+appended to that request's JSON trace, including spans run on pool threads
+submitted with contextvars.copy_context(). prometheus_text() renders
+everything, together with any gauges from register_collector(), in the
+Prometheus text format. It is served by start_http_server() or written out
+by write_prometheus().
+"""
+import collections
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = 'medmatch'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+WINDOW = 2048  # recent samples per series kept for quantiles
+
+_current_trace = contextvars.ContextVar('medmatch_trace', default=None)
+_lock = threading.Lock()
+_series = {}
+_collectors = {}
+
+
+class _Series:
+    __slots__ = ('buckets', 'count', 'sum', 'errors', 'recent')
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+        self.recent = collections.deque(maxlen=WINDOW)
+
+
+def observe(name, seconds, error=False, **labels):
+    """Record one duration for the series (name, labels)."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        series = _series.get(key)
+        if series is None:
+            series = _series[key] = _Series()
+        series.count += 1
+        series.sum += seconds
+        series.errors += error
+        series.recent.append(seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                series.buckets[i] += 1
+                break
+
+
+@contextmanager
+def span(name, **labels):
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except Exception:  # not BaseException: Streamlit's st.stop() and rerun signals are not errors
+        error = True
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        observe(name, seconds, error, **labels)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, labels, start, seconds, error)
+
+
+def timed(name, **labels):
+    """Decorator form of span()."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class Trace:
+    def __init__(self, trace_id, attributes):
+        self.trace_id = trace_id
+        self.attributes = attributes
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, labels, start, seconds, error):
+        record = {'name': name, 'labels': labels, 'start_ms': round((start - self.started) * 1000, 3),
+                  'duration_ms': round(seconds * 1000, 3), 'error': error, 'thread': threading.current_thread().name}
+        with self._lock:
+            self.spans.append(record)
+
+    def as_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s['start_ms'])
+        return {'trace_id': self.trace_id, 'started_at': self.started_at, 'attributes': self.attributes,
+                'duration_ms': round((time.perf_counter() - self.started) * 1000, 3), 'spans': spans}
+
+
+@contextmanager
+def trace(trace_dir=None, **attributes):
+    """Collect this request's spans; with trace_dir set, write them to <trace_dir>/<trace_id>.json at the end."""
+    current = Trace(uuid.uuid4().hex, attributes)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+        if trace_dir:
+            os.makedirs(trace_dir, exist_ok=True)
+            with open(os.path.join(trace_dir, f"{current.trace_id}.json"), 'w') as f:
+                json.dump(current.as_dict(), f, default=str)
+
+
+def register_collector(name, fn):
+    """fn() returns a (possibly nested) dict whose numeric leaves are exported as gauges medmatch_<name>_<path>."""
+    with _lock:
+        _collectors[name] = fn
+
+
+def _quantile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summary():
+    """{name: {labels: {count, errors, p50_ms, p95_ms, p99_ms}}} over each series' recent window."""
+    with _lock:
+        snapshot = [(name, labels, s.count, s.errors, sorted(s.recent)) for (name, labels), s in _series.items()]
+    out = collections.defaultdict(dict)
+    for name, labels, count, errors, ordered in snapshot:
+        if ordered:
+            out[name][labels] = {'count': count, 'errors': errors,
+                                 **{f'p{int(q * 100)}_ms': _quantile(ordered, q) * 1000 for q in (0.5, 0.95, 0.99)}}
+    return dict(out)
+
+
+def _metric_name(*parts):
+    return '_'.join(''.join(c if c.isalnum() else '_' for c in str(part)) for part in (PREFIX,) + parts)
+
+
+def _labels(pairs, **extra):
+    pairs = list(pairs) + list(extra.items())
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _flatten(value, path=()):
+    if isinstance(value, dict):
+        for key, inner in value.items():
+            yield from _flatten(inner, path + (key,))
+    elif isinstance(value, (int, float)):  # includes bools; strings and None are skipped
+        yield path, float(value)
+
+
+def prometheus_text():
+    with _lock:
+        snapshot = [(name, labels, list(s.buckets), s.count, s.sum, s.errors, sorted(s.recent))
+                    for (name, labels), s in sorted(_series.items())]
+        collectors = list(_collectors.items())
+    families = collections.defaultdict(list)
+    for entry in snapshot:
+        families[entry[0]].append(entry[1:])
+    lines = []
+    # Each metric family's samples must be contiguous
+    for name, entries in families.items():
+        seconds, recent, errors_total = (_metric_name(name, 'seconds'), _metric_name(name, 'recent_seconds'),
+                                         _metric_name(name, 'errors_total'))
+        lines.append(f"# TYPE {seconds} histogram")
+        for labels, buckets, count, total, _, _ in entries:
+            cumulative = 0
+            for bound, n in zip(BUCKETS, buckets):
+                cumulative += n
+                lines.append(f"{seconds}_bucket{_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{seconds}_bucket{_labels(labels, le='+Inf')} {count}")
+            lines.append(f"{seconds}_sum{_labels(labels)} {total:.6f}")
+            lines.append(f"{seconds}_count{_labels(labels)} {count}")
+        lines.append(f"# TYPE {recent} summary")
+        for labels, _, _, _, _, ordered in entries:
+            for q in (0.5, 0.95, 0.99):
+                lines.append(f"{recent}{_labels(labels, quantile=q)} {_quantile(ordered, q):.6f}")
+        lines.append(f"# TYPE {errors_total} counter")
+        for labels, _, _, _, errors, _ in entries:
+            lines.append(f"{errors_total}{_labels(labels)} {errors}")
+    for collector, fn in collectors:
+        try:
+            values = list(_flatten(fn()))
+        except Exception as e:
+            lines.append(f"# collector {collector} failed: {e}")
+            continue
+        for path, value in values:
+            lines.append(f"# TYPE {_metric_name(collector, *path)} gauge")
+            lines.append(f"{_metric_name(collector, *path)} {value:g}")
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path):
+    """Atomically write the current metrics, e.g. for node_exporter's textfile collector."""
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(tmp, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        payload = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_http_server(port, host='127.0.0.1'):
+    """Serve /metrics from a daemon thread; returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='metrics').start()
+    return server
+
+
+def reset():
+    with _lock:
+        _series.clear()
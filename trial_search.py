@@ -0,0 +1,469 @@
+"""Trial search backends: TiDB vector search and a local in-process index.
+
+Every backend's search() returns (nct_number, study_title, conditions,
+brief_summary, locations, interventions, cosine distance) rows, nearest first,
+filtered to the patient's age group and sex. sites() returns trials' stored site
+coordinates, and search_near() restricts a search to trials with a site nearby.
+"""
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+import eligibility
+import geocoding
+import proximity
+import trial_store
+
+RESULT_COLUMNS = 'nct_number, study_title, conditions, brief_summary, locations, interventions'
+
+# Besides the eligible rows, the farthest candidate is always returned (eligible = 0 unless it qualifies),
+# so the caller knows whether a larger fetch could still reach trials within max_distance
+SEARCH_SQL = f"""
+    SELECT {RESULT_COLUMNS}, distance, eligible, farthest, fetched
+    FROM (
+        SELECT {RESULT_COLUMNS}, distance,
+        distance < %s AND (age_mask & %s) != 0 AND sex_code IN %s AS eligible,
+        MAX(distance) OVER () AS farthest,
+        COUNT(*) OVER () AS fetched,
+        ROW_NUMBER() OVER (ORDER BY distance DESC) AS from_farthest
+        FROM (
+            SELECT {RESULT_COLUMNS}, age_mask, sex_code,
+            VEC_COSINE_DISTANCE(embedding, %s) AS distance
+            FROM clinical_trials_latest
+            ORDER BY distance ASC
+            LIMIT %s
+        ) AS nearest
+    ) AS candidates
+    WHERE eligible OR from_farthest = 1
+    ORDER BY distance ASC
+    LIMIT %s
+"""
+
+# The query app.py ran before eligibility columns existed; kept for benchmark comparisons
+LEGACY_SEARCH_SQL = f"""
+    SELECT {RESULT_COLUMNS},
+    VEC_COSINE_DISTANCE(embedding, %s) AS distance
+    FROM clinical_trials_latest
+    WHERE sex = %s AND age LIKE %s AND VEC_COSINE_DISTANCE(embedding, %s) < %s
+    ORDER BY distance ASC
+    LIMIT %s
+"""
+
+
+def search_params(query_embedding_json, age_group, sex, k, max_distance, fetch):
+    return (max_distance, eligibility.patient_age_mask(age_group), eligibility.accepted_sex_codes(sex),
+            query_embedding_json, fetch, k)
+
+
+def legacy_search_params(query_embedding_json, age_group, sex, k, max_distance):
+    return (query_embedding_json, sex, f'%{age_group}%', query_embedding_json, max_distance, k)
+
+
+SITES_SQL = """
+    SELECT nct_number, site, latitude, longitude FROM trial_sites
+    WHERE nct_number IN ({placeholders}) AND latitude IS NOT NULL
+    ORDER BY nct_number, site_index
+"""
+# Sites within a radius: grid_cell ranges for the index, then a bounding box and the exact great-circle distance
+SITE_KM_SQL = f"""{2 * proximity.EARTH_RADIUS_KM} * ASIN(SQRT(LEAST(1,
+    POW(SIN(RADIANS(latitude - %s) / 2), 2)
+    + COS(RADIANS(%s)) * COS(RADIANS(latitude)) * POW(SIN(RADIANS(longitude - %s) / 2), 2))))"""
+SITES_NEAR_SQL = f"""
+    SELECT nct_number, MIN(km) AS km
+    FROM (
+        SELECT nct_number, {SITE_KM_SQL} AS km
+        FROM trial_sites
+        WHERE ({{cells}}) AND latitude BETWEEN %s AND %s AND ({{spans}})
+    ) AS sites
+    WHERE km <= %s
+    GROUP BY nct_number
+"""
+# Exact distances for a known candidate set, e.g. the trials near the patient
+SEARCH_AMONG_SQL = f"""
+    SELECT {RESULT_COLUMNS}, distance
+    FROM (
+        SELECT {RESULT_COLUMNS}, age_mask, sex_code,
+        VEC_COSINE_DISTANCE(embedding, %s) AS distance
+        FROM clinical_trials_latest
+        WHERE nct_number IN ({{placeholders}})
+    ) AS candidates
+    WHERE distance < %s AND (age_mask & %s) != 0 AND sex_code IN %s
+    ORDER BY distance ASC
+    LIMIT %s
+"""
+# The same ranking over every trial with a site in SITES_NEAR_SQL, in one statement however many there are
+SEARCH_NEARBY_SQL = f"""
+    SELECT {RESULT_COLUMNS}, distance
+    FROM (
+        SELECT {RESULT_COLUMNS}, age_mask, sex_code,
+        VEC_COSINE_DISTANCE(embedding, %s) AS distance
+        FROM clinical_trials_latest
+        WHERE nct_number IN (SELECT nct_number FROM ({{nearby}}) AS nearby)
+    ) AS candidates
+    WHERE distance < %s AND (age_mask & %s) != 0 AND sex_code IN %s
+    ORDER BY distance ASC
+    LIMIT %s
+"""
+SEARCH_AMONG_BATCH = 1000  # candidate IDs per SEARCH_AMONG_SQL statement
+SPATIAL_FIRST_TRIALS = 2000  # indexed backends score at most this many nearby trials directly instead of filtering the top-k
+NEAR_OVERFETCH = 20
+NEAR_MAX_FETCH = 1000
+
+
+def group_sites(rows):
+    """{nct_number: [(site, lat, lng), ...]} from (nct_number, site, lat, lng) rows."""
+    sites = {}
+    for nct, site, lat, lng in rows:
+        sites.setdefault(nct, []).append((site, float(lat), float(lng)))
+    return sites
+
+
+def sites_near_query(lat, lng, radius_km):
+    """SITES_NEAR_SQL and its parameters for the circle of radius_km around (lat, lng)."""
+    ranges = proximity.cell_ranges(lat, lng, radius_km)
+    south, north, spans = proximity.bounding_box(lat, lng, radius_km)
+    sql = SITES_NEAR_SQL.format(cells=' OR '.join(['grid_cell BETWEEN %s AND %s'] * len(ranges)),
+                                spans=' OR '.join(['longitude BETWEEN %s AND %s'] * len(spans)))
+    params = ((lat, lat, lng) + tuple(key for pair in ranges for key in pair) + (south, north)
+              + tuple(degree for span in spans for degree in span) + (radius_km,))
+    return sql, params
+
+
+def search_tidb(pool, query_embedding, age_group, sex, k=5, max_distance=0.5, overfetch=10, max_fetch=1000):
+    """Top-k eligible trials as (nct, title, conditions, summary, locations, interventions, distance) rows."""
+    query_embedding_json = json.dumps(query_embedding)
+    fetch = min(k * overfetch, max_fetch)
+    while True:
+        candidates = pool.fetchall(SEARCH_SQL, search_params(query_embedding_json, age_group, sex, k, max_distance, fetch))
+        rows = [tuple(row[:7]) for row in candidates if row[7]]
+        # Stop once more candidates could only be farther than max_distance (or the table ran out)
+        exhausted = not candidates or candidates[0][8] >= max_distance or candidates[0][9] < fetch
+        if len(rows) >= k or exhausted or fetch >= max_fetch:
+            return rows[:k]
+        fetch = min(fetch * 4, max_fetch)
+
+
+def search_near(backend, query_embedding, age_group, sex, lat, lng, radius_km, k=5, max_distance=0.5):
+    """Top-k eligible trials with a site within radius_km of (lat, lng), plus {nct_number: km to its nearest site}.
+
+    With few trials nearby (backend.spatial_first_trials) they are scored directly.
+    Otherwise the vector top-k is over-fetched and filtered to the nearby trials. If
+    that leaves fewer than k, the nearby trials are scored directly after all
+    (search_nearby()), unless the backend's search is exhaustive (backend.exhaustive_search).
+    """
+    nearby = backend.nearby(lat, lng, radius_km)
+    if not nearby:
+        return [], {}
+    if len(nearby) > backend.spatial_first_trials:
+        fetch = k * NEAR_OVERFETCH
+        while True:
+            rows = backend.search(query_embedding, age_group, sex, k=fetch, max_distance=max_distance)
+            results = [row for row in rows if row[0] in nearby][:k]
+            exhausted = backend.exhaustive_search and len(rows) < fetch
+            if len(results) >= k or exhausted or fetch >= NEAR_MAX_FETCH:
+                break
+            fetch = min(fetch * 4, NEAR_MAX_FETCH)
+        # Filters, fetch caps and IVF probing can all hide nearby trials from the vector top-k
+        if len(results) < k and not exhausted:
+            results = backend.search_nearby(query_embedding, age_group, sex, lat, lng, radius_km, k, max_distance)
+    else:
+        results = backend.search_among(query_embedding, age_group, sex, list(nearby), k, max_distance)
+    return results, {row[0]: nearby[row[0]] for row in results}
+
+
+class TiDBSearchBackend:
+    name = 'TiDB'
+    spatial_first_trials = SPATIAL_FIRST_TRIALS
+    exhaustive_search = False  # the vector index and the fetch cap can both leave eligible trials out
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def search(self, query_embedding, age_group, sex, k=5, max_distance=0.5):
+        return search_tidb(self.pool, query_embedding, age_group, sex, k, max_distance)
+
+    def sites(self, nct_numbers):
+        """Geocoded sites of the given trials; trials without any are left out."""
+        nct_numbers = list(dict.fromkeys(nct_numbers))
+        if not nct_numbers:
+            return {}
+        return group_sites(self.pool.fetchall(SITES_SQL.format(placeholders=', '.join(['%s'] * len(nct_numbers))),
+                                              tuple(nct_numbers)))
+
+    def nearby(self, lat, lng, radius_km):
+        """{nct_number: km to its nearest site} for trials with a site within radius_km, via the grid_cell index."""
+        sql, params = sites_near_query(lat, lng, radius_km)
+        return {nct: float(km) for nct, km in self.pool.fetchall(sql, params)}
+
+    def search_among(self, query_embedding, age_group, sex, nct_numbers, k=5, max_distance=0.5):
+        """Top-k eligible trials among nct_numbers, scored exactly."""
+        query_embedding_json = json.dumps(query_embedding)
+        rows = []
+        for i in range(0, len(nct_numbers), SEARCH_AMONG_BATCH):
+            batch = tuple(nct_numbers[i:i + SEARCH_AMONG_BATCH])
+            rows.extend(self.pool.fetchall(
+                SEARCH_AMONG_SQL.format(placeholders=', '.join(['%s'] * len(batch))),
+                (query_embedding_json,) + batch + (max_distance, eligibility.patient_age_mask(age_group),
+                                                    eligibility.accepted_sex_codes(sex), k)))
+        return sorted(rows, key=lambda row: row[6])[:k]
+
+    def search_nearby(self, query_embedding, age_group, sex, lat, lng, radius_km, k=5, max_distance=0.5):
+        """Top-k eligible trials with a site within radius_km of (lat, lng), scored exactly in one statement."""
+        nearby_sql, nearby_params = sites_near_query(lat, lng, radius_km)
+        return self.pool.fetchall(SEARCH_NEARBY_SQL.format(nearby=nearby_sql),
+                                  (json.dumps(query_embedding),) + nearby_params
+                                  + (max_distance, eligibility.patient_age_mask(age_group),
+                                     eligibility.accepted_sex_codes(sex), k))
+
+    def corpus_version(self):
+        """Changes whenever ingestion adds, updates or deletes trials (the marker row it writes after each load)."""
+        rows = self.pool.fetchall("SELECT version FROM corpus_version WHERE id = 1")
+        if rows:
+            return rows[0][0]
+        # Tables loaded before the marker existed
+        count, updated = self.pool.fetchall("SELECT COUNT(*), MAX(last_update_posted) FROM clinical_trials_latest")[0]
+        return f"{count}:{updated}"
+
+
+# Export columns behind each result field, in row order
+LOCAL_RESULT_COLUMNS = ['NCT Number', 'Study Title', 'Conditions', 'Brief Summary', 'Locations', 'Interventions']
+SEX_CODE_IDS = {code: i for i, code in enumerate(eligibility.SEX_CODES)}
+
+
+def _normalise(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _kmeans(vectors, nlist, iterations=10, seed=0):
+    """Spherical k-means over unit vectors; returns unit-length centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        counts = np.bincount(assign, minlength=nlist)
+        filled = counts > 0
+        centroids[filled] = _normalise(sums[filled])
+    return centroids
+
+
+class LocalSearchBackend:
+    """Cosine search over a preprocessed corpus directory, held as memory-mapped float32 parts.
+
+    Exact search scores every eligible trial with one matrix-vector product per part.
+    build_ivf() adds an inverted-file index (k-means lists, nprobe lists searched per
+    query) for corpora where the exact scan is too slow; it is cached next to the parts.
+    """
+    name = 'local index'
+
+    def __init__(self, corpus_dir, approximate=False, nlist=None, nprobe=16):
+        self.corpus_dir = corpus_dir
+        self._manifest_mtime = os.path.getmtime(os.path.join(corpus_dir, trial_store.MANIFEST_NAME))
+        self.metadata = []
+        self.embeddings = []
+        self.inverse_norms = []
+        self.age_masks = []
+        self.sex_codes = []
+        for df, embeddings in trial_store.iter_parts(corpus_dir, columns=LOCAL_RESULT_COLUMNS + ['Age', 'Sex']):
+            self.metadata.append(df[LOCAL_RESULT_COLUMNS].to_numpy(dtype=object))
+            self.embeddings.append(embeddings)
+            self.inverse_norms.append((1.0 / np.maximum(np.linalg.norm(embeddings, axis=1), 1e-12)).astype(np.float32))
+            self.age_masks.append(eligibility.age_masks(df['Age']).to_numpy(dtype=np.uint8))
+            self.sex_codes.append(eligibility.sex_codes(df['Sex']).map(SEX_CODE_IDS).to_numpy(dtype=np.uint8))
+        self.offsets = np.cumsum([0] + [len(e) for e in self.embeddings])
+        sites = geocoding.read_sites(corpus_dir)
+        if sites is None:
+            logging.warning(f"No {geocoding.SITES_FILE} in {corpus_dir}; run geocoding.py to map trial sites")
+            self.trial_sites = {}
+            self.site_grid = proximity.SiteGrid([], [], [])
+        else:
+            sites = sites.dropna(subset=['latitude', 'longitude']).sort_values(['nct_number', 'site_index'])
+            self.trial_sites = group_sites(sites[['nct_number', 'site', 'latitude', 'longitude']].itertuples(index=False))
+            self.site_grid = proximity.SiteGrid(sites['nct_number'], sites['latitude'], sites['longitude'])
+        self._index = None
+        self.nprobe = nprobe
+        self.centroids = None
+        self.lists = None
+        if approximate:
+            self.build_ivf(nlist)
+        logging.info(f"Local search index: {len(self)} trials from {corpus_dir}"
+                     f"{f', IVF with {len(self.centroids)} lists' if self.centroids is not None else ''}")
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def corpus_version(self):
+        # The index is loaded once, so its version is the manifest it was loaded from
+        return self._manifest_mtime
+
+    def sites(self, nct_numbers):
+        return {nct: self.trial_sites[nct] for nct in nct_numbers if nct in self.trial_sites}
+
+    @property
+    def spatial_first_trials(self):
+        # An exact scan costs as much as scoring every trial, so filtering its top-k never beats scoring the nearby ones
+        return len(self) if self.lists is None else SPATIAL_FIRST_TRIALS
+
+    @property
+    def exhaustive_search(self):
+        # An exact scan returns every eligible trial within max_distance, up to k
+        return self.lists is None
+
+    def nearby(self, lat, lng, radius_km):
+        return self.site_grid.near(lat, lng, radius_km)
+
+    def search_among(self, query_embedding, age_group, sex, nct_numbers, k=5, max_distance=0.5):
+        """Top-k eligible trials among nct_numbers, scored exactly."""
+        if self._index is None:
+            self._index = pd.Index(np.concatenate([metadata[:, 0] for metadata in self.metadata]))
+        ids = self._index.get_indexer(list(nct_numbers))
+        ids = np.unique(ids[ids >= 0])
+        if not len(ids):
+            return []
+        q = _normalise(np.asarray(query_embedding, dtype=np.float32))
+        if len(ids) * 8 < len(self):
+            candidates = self._score(ids, q, age_group, sex, max_distance)
+        else:
+            # Many candidates: one masked pass over the parts is cheaper than gathering their rows
+            allowed = np.zeros(len(self), dtype=bool)
+            allowed[ids] = True
+            candidates = self._scan(q, age_group, sex, k, max_distance, allowed)
+        candidates.sort(key=lambda c: c[0])
+        return [self._row(part, row, distance) for distance, part, row in candidates[:k]]
+
+    def search_nearby(self, query_embedding, age_group, sex, lat, lng, radius_km, k=5, max_distance=0.5):
+        """Top-k eligible trials with a site within radius_km of (lat, lng), scored exactly."""
+        return self.search_among(query_embedding, age_group, sex, list(self.nearby(lat, lng, radius_km)), k, max_distance)
+
+    def _eligible(self, part, age_group, sex):
+        accepted = [SEX_CODE_IDS[code] for code in eligibility.accepted_sex_codes(sex)]
+        return ((self.age_masks[part] & eligibility.patient_age_mask(age_group)) != 0) & \
+            np.isin(self.sex_codes[part], accepted)
+
+    def _row(self, part, row, distance):
+        return tuple(None if isinstance(v, float) and np.isnan(v) else v for v in self.metadata[part][row]) + (float(distance),)
+
+    def build_ivf(self, nlist=None, sample_size=50000, seed=0):
+        """Train (or load the cached) IVF index: centroids plus the member rows of each list."""
+        nlist = nlist or max(1, int(np.sqrt(len(self))))
+        manifest_mtime = os.path.getmtime(os.path.join(self.corpus_dir, trial_store.MANIFEST_NAME))
+        cache_path = os.path.join(self.corpus_dir, f"ivf-{nlist}.npz")
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= manifest_mtime:
+            cached = np.load(cache_path)
+            self.centroids, order, bounds = cached['centroids'], cached['order'], cached['bounds']
+        else:
+            rng = np.random.default_rng(seed)
+            sample_ids = np.sort(rng.choice(len(self), min(sample_size, len(self)), replace=False))
+            self.centroids = _kmeans(_normalise(self._gather(sample_ids)), nlist, seed=seed)
+            assign = np.concatenate([
+                np.argmax((e @ self.centroids.T) * n[:, None], axis=1)
+                for e, n in zip(self.embeddings, self.inverse_norms)
+            ])
+            order = np.argsort(assign, kind='stable')
+            bounds = np.searchsorted(assign[order], np.arange(nlist + 1))
+            np.savez(cache_path, centroids=self.centroids, order=order, bounds=bounds)
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+
+    def _gather(self, global_ids):
+        """Rows of the concatenated corpus by global id, read from the part memmaps."""
+        parts = np.searchsorted(self.offsets, global_ids, side='right') - 1
+        out = np.empty((len(global_ids), self.embeddings[0].shape[1]), dtype=np.float32)
+        for part in np.unique(parts):
+            selected = parts == part
+            out[selected] = self.embeddings[part][global_ids[selected] - self.offsets[part]]
+        return out
+
+    def _scan(self, q, age_group, sex, k, max_distance, allowed=None):
+        """(distance, part, row) of up to k eligible trials per part, scoring every row (restricted to allowed global ids)."""
+        candidates = []
+        for part, (embeddings, inverse_norms) in enumerate(zip(self.embeddings, self.inverse_norms)):
+            distances = 1.0 - (embeddings @ q) * inverse_norms
+            eligible = self._eligible(part, age_group, sex) & (distances < max_distance)
+            if allowed is not None:
+                eligible &= allowed[self.offsets[part]:self.offsets[part + 1]]
+            keep = np.flatnonzero(eligible)
+            if len(keep) > k:
+                keep = keep[np.argpartition(distances[keep], k)[:k]]
+            candidates.extend((distances[row], part, row) for row in keep)
+        return candidates
+
+    def _score(self, ids, q, age_group, sex, max_distance):
+        """(distance, part, row) of the eligible trials among sorted global ids that lie within max_distance."""
+        candidates = []
+        parts = np.searchsorted(self.offsets, ids, side='right') - 1
+        distances = 1.0 - (self._gather(ids) @ q) * np.concatenate(
+            [self.inverse_norms[p][ids[parts == p] - self.offsets[p]] for p in np.unique(parts)])
+        for part in np.unique(parts):
+            selected = parts == part
+            rows = ids[selected] - self.offsets[part]
+            part_distances = distances[selected]
+            keep = self._eligible(part, age_group, sex)[rows] & (part_distances < max_distance)
+            candidates.extend(zip(part_distances[keep], [part] * int(keep.sum()), rows[keep]))
+        return candidates
+
+    def search(self, query_embedding, age_group, sex, k=5, max_distance=0.5, exact=None):
+        q = _normalise(np.asarray(query_embedding, dtype=np.float32))
+        if exact is None:
+            exact = self.lists is None
+        if exact:
+            candidates = self._scan(q, age_group, sex, k, max_distance)
+        else:
+            probe = np.argsort(-(self.centroids @ q))[:self.nprobe]
+            candidates = self._score(np.sort(np.concatenate([self.lists[c] for c in probe])), q, age_group, sex, max_distance)
+        candidates.sort(key=lambda c: c[0])
+        return [self._row(part, row, distance) for distance, part, row in candidates[:k]]
+
+
+class FallbackSearchBackend:
+    """Use the primary backend, switching to the fallback for any search the primary fails."""
+
+    def __init__(self, primary, fallback):
+        self.primary = primary
+        self.fallback = fallback
+        self.name = primary.name
+
+    def search(self, *args, **kwargs):
+        try:
+            return self.primary.search(*args, **kwargs)
+        except Exception as e:
+            logging.warning(f"{self.primary.name} search failed ({e}); using {self.fallback.name}")
+            return self.fallback.search(*args, **kwargs)
+
+    def _either(self, method, *args, **kwargs):
+        try:
+            return getattr(self.primary, method)(*args, **kwargs)
+        except Exception as e:
+            logging.warning(f"{self.primary.name} {method} failed ({e}); using {self.fallback.name}")
+            return getattr(self.fallback, method)(*args, **kwargs)
+
+    def sites(self, nct_numbers):
+        return self._either('sites', nct_numbers)
+
+    def nearby(self, lat, lng, radius_km):
+        return self._either('nearby', lat, lng, radius_km)
+
+    def search_among(self, *args, **kwargs):
+        return self._either('search_among', *args, **kwargs)
+
+    def search_nearby(self, *args, **kwargs):
+        return self._either('search_nearby', *args, **kwargs)
+
+    @property
+    def spatial_first_trials(self):
+        return self.primary.spatial_first_trials
+
+    @property
+    def exhaustive_search(self):
+        # Either backend may answer, so only claim it when both do
+        return self.primary.exhaustive_search and self.fallback.exhaustive_search
+
+    def corpus_version(self):
+        try:
+            return self.primary.corpus_version()
+        except Exception:
+            return self.fallback.corpus_version()
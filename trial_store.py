@@ -0,0 +1,163 @@
+"""On-disk layout of the preprocessed trial corpus shared by cleaning and ingestion.
+
+A corpus directory holds numbered parts plus manifest.json, which lists the
+export chunks already written so an interrupted preprocessing run can resume.
+Each part is a Parquet file of trial metadata and a float32 .npy matrix of
+embeddings aligned with it row for row; the matrix is memory-mapped on read.
+"""
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+# Export columns ingestion reads, with the dtypes they are parsed as
+COLUMN_DTYPES = {
+    'NCT Number': str,
+    'Study Title': str,
+    'Study URL': str,
+    'Acronym': str,
+    'Study Status': str,
+    'Brief Summary': str,
+    'Study Results': str,
+    'Conditions': str,
+    'Interventions': str,
+    'Primary Outcome Measures': str,
+    'Secondary Outcome Measures': str,
+    'Other Outcome Measures': str,
+    'Sponsor': str,
+    'Collaborators': str,
+    'Sex': str,
+    'Age': str,
+    'Phases': str,
+    'Enrollment': 'float64',
+    'Funder Type': str,
+    'Study Type': str,
+    'Study Design': str,
+    'Other IDs': str,
+    'Start Date': str,
+    'Primary Completion Date': str,
+    'Completion Date': str,
+    'First Posted': str,
+    'Results First Posted': str,
+    'Last Update Posted': str,
+    'Locations': str,
+    'Study Documents': str,
+}
+EXPORT_COLUMNS = list(COLUMN_DTYPES)
+MANIFEST_NAME = 'manifest.json'
+FORMAT_VERSION = 2
+EMBEDDING_DTYPE = np.float32
+
+
+def content_hash(texts):
+    """SHA-256 hex digest of each text_for_embedding value; equal hashes share an embedding."""
+    return [hashlib.sha256(text.encode('utf-8')).hexdigest() for text in texts]
+
+
+def part_name(chunk_index):
+    return f"part-{chunk_index:05d}"
+
+
+def read_manifest(corpus_dir):
+    """Return the corpus manifest, or None if nothing has been written yet."""
+    path = os.path.join(corpus_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f"{corpus_dir} uses an older corpus format; rerun clean_trials_data.py into a fresh directory.")
+    return manifest
+
+
+def new_manifest(**source):
+    return dict(source, format_version=FORMAT_VERSION, parts=[], complete=False)
+
+
+def write_manifest(corpus_dir, manifest):
+    """Atomically replace manifest.json so a crash never leaves it half-written."""
+    path = os.path.join(corpus_dir, MANIFEST_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def write_part(corpus_dir, chunk_index, df, embeddings):
+    """Write one processed chunk and return its manifest entry (temp files + rename).
+
+    The manifest is the commit point: a part only counts once its entry is recorded there.
+    """
+    name = part_name(chunk_index)
+    path = os.path.join(corpus_dir, name)
+    with open(path + '.npy.tmp', 'wb') as f:
+        np.save(f, np.ascontiguousarray(embeddings, dtype=EMBEDDING_DTYPE))
+    df.reset_index(drop=True).to_parquet(path + '.parquet.tmp', index=False)
+    os.replace(path + '.npy.tmp', path + '.npy')
+    os.replace(path + '.parquet.tmp', path + '.parquet')
+    return {'chunk': chunk_index, 'file': name + '.parquet', 'embeddings': name + '.npy', 'rows': len(df)}
+
+
+def completed_parts(manifest):
+    """Manifest entries for chunks that produced rows, in export order."""
+    return [p for p in (manifest or {}).get('parts', []) if p['file']]
+
+
+def read_part_column(corpus_dir, part, column):
+    """Read a single column of a part, e.g. to rebuild the NCT de-dup set on resume."""
+    return pd.read_parquet(os.path.join(corpus_dir, part['file']), columns=[column])[column]
+
+
+def load_part(corpus_dir, part, columns=None):
+    """Return (metadata DataFrame, read-only memory-mapped float32 embedding matrix) for a part."""
+    df = pd.read_parquet(os.path.join(corpus_dir, part['file']), columns=columns)
+    if 'content_hash' not in df and 'text_for_embedding' in df:
+        df['content_hash'] = content_hash(df['text_for_embedding'])  # corpora written before hashes were stored
+    embeddings = np.load(os.path.join(corpus_dir, part['embeddings']), mmap_mode='r')
+    if len(df) != len(embeddings):
+        raise ValueError(f"{part['file']} has {len(df)} rows but {len(embeddings)} embeddings.")
+    return df, embeddings
+
+
+def iter_parts(corpus_dir, columns=None):
+    """Yield (metadata, embeddings) for each written part of a corpus, one part at a time."""
+    manifest = read_manifest(corpus_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No {MANIFEST_NAME} in {corpus_dir}; run clean_trials_data.py first.")
+    if not manifest.get('complete'):
+        logging.warning(f"{corpus_dir} is from an unfinished preprocessing run")
+    for part in completed_parts(manifest):
+        yield load_part(corpus_dir, part, columns)
+
+
+class EmbeddingCache:
+    """Embeddings of an earlier corpus, looked up by content hash so unchanged trials are not re-encoded."""
+
+    def __init__(self, corpus_dir):
+        self.matrices = []
+        self.index = {}
+        manifest = read_manifest(corpus_dir)
+        for part in completed_parts(manifest):
+            stored = pq.read_schema(os.path.join(corpus_dir, part['file'])).names
+            df, embeddings = load_part(corpus_dir, part,
+                                       columns=['content_hash' if 'content_hash' in stored else 'text_for_embedding'])
+            part_id = len(self.matrices)
+            self.matrices.append(embeddings)
+            for row, digest in enumerate(df['content_hash']):
+                self.index[digest] = (part_id, row)
+
+    def __len__(self):
+        return len(self.index)
+
+    def lookup(self, hashes):
+        """Return (hit mask, vectors for the hits in order) for a sequence of content hashes."""
+        hits = np.array([h in self.index for h in hashes], dtype=bool)
+        vectors = np.empty((int(hits.sum()), self.matrices[0].shape[1] if self.matrices else 0), dtype=EMBEDDING_DTYPE)
+        for i, h in enumerate(h for h, hit in zip(hashes, hits) if hit):
+            part_id, row = self.index[h]
+            vectors[i] = self.matrices[part_id][row]
+        return hits, vectors
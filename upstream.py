@@ -0,0 +1,111 @@
+"""Per-upstream request pacing and failure isolation for the enrichment APIs.
+
+TokenBucket keeps a process at or below an upstream's published request rate.
+CircuitBreaker stops calling an upstream after consecutive failures. While it
+is open, calls fail immediately. After reset_timeout a single probe request is
+let through: if it succeeds the circuit closes, and if it fails the circuit
+opens again.
+"""
+import threading
+import time
+
+
+class RateLimited(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket:
+    """rate tokens per second, up to burst saved up; acquire() waits at most max_wait for one."""
+
+    def __init__(self, rate, burst=None, max_wait=2.0):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.max_wait = max_wait
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.stats = {'granted': 0, 'delayed': 0, 'rejected': 0}
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Reserve a token now, possibly going negative, so waiters are served in arrival order
+            wait = (1 - self._tokens) / self.rate if self._tokens < 1 else 0.0
+            if wait > self.max_wait:
+                self.stats['rejected'] += 1
+                raise RateLimited(f"rate limit of {self.rate}/s reached")
+            self._tokens -= 1
+            self.stats['granted'] += 1
+            if wait:
+                self.stats['delayed'] += 1
+        if wait:
+            time.sleep(wait)
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, rate_per_s=self.rate, tokens=round(self._tokens, 2))
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+    STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}  # numeric state for metrics backends
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.stats = {'successes': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go out now."""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.stats['rejected'] += 1
+            raise CircuitOpenError("upstream circuit open after repeated failures")
+
+    def cancel(self):
+        """The permitted call was never sent; let another caller take the half-open probe."""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.stats['successes'] += 1
+            self._failures = 0
+            self._probing = False
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.stats['failures'] += 1
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.stats['opened'] += 1
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self.stats, state=self.state, state_code=self.STATE_CODES[self.state],
+                           consecutive_failures=self._failures)
+            if self.state == self.OPEN:
+                metrics['retry_in_s'] = round(max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at)), 1)
+            return metrics